@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
 
+from osu_acc.fields import PackedArrayField
+
 
 class BreakPeriod(models.Model):
     """
@@ -8,8 +10,8 @@ class BreakPeriod(models.Model):
     """
     # Let Django automatically generate primary key
 
-    # Reference parent Beatmap
-    beatmap_id = models.CharField(max_length=64)
+    # Reference parent Beatmap, one per beatmap
+    beatmap_id = models.CharField(max_length=64, unique=True)
 
     starts = ArrayField(models.PositiveIntegerField(blank=True, null=True))
     ends = ArrayField(models.PositiveIntegerField(blank=True, null=True))
@@ -21,8 +23,8 @@ class TimingPoint(models.Model):
     """
     # Let Django automatically generate primary key
 
-    # Reference parent Beatmap
-    beatmap_id = models.CharField(max_length=64)
+    # Reference parent Beatmap, one per beatmap
+    beatmap_id = models.CharField(max_length=64, unique=True)
 
     offsets = ArrayField(models.IntegerField())
     ms_per_beats = ArrayField(models.DecimalField(max_digits=9, decimal_places=2))
@@ -34,13 +36,40 @@ class HitObject(models.Model):
     """
     # Let Django automatically generate primary key
 
-    # Reference parent Beatmap
-    beatmap_id = models.CharField(max_length=64)
+    # Reference parent Beatmap, one per beatmap
+    beatmap_id = models.CharField(max_length=64, unique=True)
+
+    # Packed arrays, loaded as NumPy arrays
+    x_coords = PackedArrayField(dtype='<i2')
+    y_coords = PackedArrayField(dtype='<i2')
+    hit_object_times = PackedArrayField(dtype='<i4', delta=True)
+    hit_object_types = PackedArrayField(dtype='<i2')
+
+    # Sliders: number of traversals and length in osu!pixels, 1 and 0 otherwise
+    hit_object_slides = PackedArrayField(dtype='<i2', default=list)
+    hit_object_lengths = PackedArrayField(dtype='<f4', default=list)
+
+    # Spinners: end time, the hit object's own time otherwise
+    hit_object_end_times = PackedArrayField(dtype='<i4', default=list)
+
+
+class Timeline(models.Model):
+    """
+    Represents every judgeable event of a beatmap, in chronological order.
+
+    Event kinds are defined in osu_acc.beatmap.timeline.
+    """
+    # Let Django automatically generate primary key
+
+    # Reference parent Beatmap, one per beatmap
+    beatmap_id = models.CharField(max_length=64, unique=True)
 
-    x_coords = ArrayField(models.DecimalField(max_digits=5, decimal_places=2))
-    y_coords = ArrayField(models.DecimalField(max_digits=5, decimal_places=2))
-    hit_object_times = ArrayField(models.DecimalField(max_digits=9, decimal_places=2))
-    hit_object_types = ArrayField(models.PositiveIntegerField())
+    # Packed arrays, loaded as NumPy arrays.
+    # Slider ticks fall between milliseconds, and float32 cannot hold hundredths of a
+    # millisecond past a few minutes, so times are kept in double precision.
+    event_times = PackedArrayField(dtype='<f8', compress=True)
+    event_kinds = PackedArrayField(dtype='<i2', compress=True)
+    event_objects = PackedArrayField(dtype='<i4', delta=True, compress=True)
 
 
 class Beatmap(models.Model):
@@ -50,15 +79,22 @@ class Beatmap(models.Model):
     # PRIMARY KEY
     beatmap_id = models.CharField(max_length=64, primary_key=True)
 
+    # MD5 hash of the .osu file, which replays reference their beatmap by.
+    # Null for beatmaps ingested before it was stored.
+    beatmap_md5 = models.CharField(max_length=32, null=True, unique=True)
+
     # ONE-TO-ONE
     break_period = models.OneToOneField(BreakPeriod, on_delete=models.CASCADE)
     timing_point = models.OneToOneField(TimingPoint, on_delete=models.CASCADE)
     hit_object = models.OneToOneField(HitObject, on_delete=models.CASCADE)
+    timeline = models.OneToOneField(Timeline, on_delete=models.CASCADE, null=True)
 
     # METADATA
     beatmap_creator = models.CharField(max_length=16)
     beatmap_difficulty = models.CharField(max_length=32)
     beatmap_cs = models.DecimalField(max_digits=3, decimal_places=1)
     beatmap_od = models.DecimalField(max_digits=3, decimal_places=1)
+    slider_multiplier = models.DecimalField(max_digits=4, decimal_places=2, default=1.4)
+    slider_tick_rate = models.DecimalField(max_digits=3, decimal_places=1, default=1)
     song_title = models.CharField(max_length=128)
     song_artist = models.CharField(max_length=64)
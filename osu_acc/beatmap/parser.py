@@ -0,0 +1,166 @@
+"""
+A module to parse .osu beatmap files.
+
+The file is read in a single pass, line by line, so it never has to be held
+in memory as a whole. Each line is split at most once, and only the sections
+the site stores are kept.
+
+The file format is described at the following link.
+https://osu.ppy.sh/help/wiki/osu!_File_Formats/Osu_(file_format)
+"""
+
+import io
+from decimal import Decimal
+
+
+# Sections stored as Key:Value pairs
+KEY_VALUE_SECTIONS = set(['General', 'Difficulty'])
+
+
+def parse_int(field):
+    """
+    Returns an integral field as an int.
+
+    Some editors write fractional coordinates and times, which are rounded
+    to the nearest integer rather than rejected.
+    """
+
+    return round(float(field))
+
+
+def parse_break_period(fields, break_fields):
+    """
+    Appends an [Events] line to break_fields if it is a break period.
+
+    Syntax: 2,start,end
+    The start and end fields are both an integral number of milliseconds,
+    from the beginning of the song,
+    defining the start and end point of the break period, respectively.
+    """
+
+    if fields[0] not in ('2', 'Break'):
+        return
+
+    break_fields['starts'].append(parse_int(fields[1]))
+    break_fields['ends'].append(parse_int(fields[2]))
+
+
+def parse_timing_point(fields, timing_point_fields):
+    """
+    Appends a [TimingPoints] line to timing_point_fields.
+
+    Syntax: Offset, Milliseconds per Beat, Meter,
+            Sample Set, Sample Index, Volume, Inherited, Kiai Mode
+    For our purposes, we only need the first two fields.
+    """
+
+    timing_point_fields['offsets'].append(parse_int(fields[0]))
+    timing_point_fields['ms_per_beats'].append(round(Decimal(fields[1]), 2))
+
+
+def parse_hit_object(fields, hit_object_fields):
+    """
+    Appends a [HitObjects] line to hit_object_fields.
+
+    Syntax: x,y,time,type,hitSound...,extras
+    Sliders:  x,y,time,type,hitSound,sliderType|curvePoints,repeat,pixelLength,...
+    Spinners: x,y,time,type,hitSound,endTime,...
+    """
+
+    obj_time = parse_int(fields[2])
+    obj_type = int(fields[3])
+
+    slides, length, end_time = 1, 0, obj_time
+
+    # Refer to the "Type" section of the file format
+    if obj_type & 0b11 == 0b10:
+        slides = int(fields[6])
+        length = round(Decimal(fields[7]), 2)
+    elif obj_type & 0b1011 == 0b1000:
+        end_time = parse_int(fields[5])
+
+    hit_object_fields['x_coords'].append(parse_int(fields[0]))
+    hit_object_fields['y_coords'].append(parse_int(fields[1]))
+    hit_object_fields['hit_object_times'].append(obj_time)
+    hit_object_fields['hit_object_types'].append(obj_type)
+    hit_object_fields['hit_object_slides'].append(slides)
+    hit_object_fields['hit_object_lengths'].append(length)
+    hit_object_fields['hit_object_end_times'].append(end_time)
+
+
+def parse_beatmap(lines):
+    """
+    Parses a beatmap file in a single pass.
+
+    Args:
+        lines (iterable(str)): The lines of the beatmap file, such as an open text file.
+
+    Returns:
+        beatmap (dict): The parsed sections:
+            'General' and 'Difficulty' map each key to its value, as strings.
+            'break_period', 'timing_point' and 'hit_object' hold typed columns,
+            keyed as the fields on the BreakPeriod, TimingPoint and HitObject models.
+    """
+
+    beatmap = {
+        'General': {},
+        'Difficulty': {},
+        'break_period': {
+            'starts': [],
+            'ends': [],
+        },
+        'timing_point': {
+            'offsets': [],
+            'ms_per_beats': [],
+        },
+        'hit_object': {
+            'x_coords': [],
+            'y_coords': [],
+            'hit_object_times': [],
+            'hit_object_types': [],
+            'hit_object_slides': [],
+            'hit_object_lengths': [],
+            'hit_object_end_times': [],
+        },
+    }
+
+    section = None
+
+    for line in lines:
+        line = line.strip()
+
+        if not line or line.startswith('//'):
+            continue
+
+        if line[0] == '[' and line[-1] == ']':
+            section = line[1:-1]
+            continue
+
+        if section in KEY_VALUE_SECTIONS:
+            key, _, value = line.partition(':')
+            beatmap[section][key.strip()] = value.strip()
+        elif section == 'Events':
+            parse_break_period(line.split(','), beatmap['break_period'])
+        elif section == 'TimingPoints':
+            parse_timing_point(line.split(','), beatmap['timing_point'])
+        elif section == 'HitObjects':
+            parse_hit_object(line.split(','), beatmap['hit_object'])
+
+    return beatmap
+
+
+def parse_beatmap_file(content):
+    """
+    Parses a beatmap file held in memory, such as a download, in a single pass.
+
+    Lines are decoded as they are read, so the file is never copied whole.
+
+    Args:
+        content (bytes): The contents of the beatmap file.
+
+    Returns:
+        beatmap (dict): The parsed sections, as returned by parse_beatmap().
+    """
+
+    with io.TextIOWrapper(io.BytesIO(content), encoding='utf-8-sig') as lines:
+        return parse_beatmap(lines)
@@ -0,0 +1,156 @@
+"""
+A module for the on-disk store of downloaded .osu beatmap files.
+
+Files are content-addressed by their MD5 hash, the same hash replays
+reference their beatmap by, so a beatmap file is only downloaded once
+however many times it is needed.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from functools import lru_cache
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class BeatmapStore():
+    """
+    Represents a directory of beatmap files, bounded in size.
+
+    Files are written atomically, so a reader never sees a partial file.
+    Once the store grows past max_bytes, the least recently used files are evicted.
+    """
+
+    __slots__ = ('_directory', '_max_bytes')
+
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+
+    @property
+    def directory(self):
+        return self._directory
+
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+
+    def path(self, md5):
+        """
+        Returns the path of the file with the given MD5 hash.
+
+        Files are spread over subdirectories by the first two characters of their hash.
+        """
+
+        return os.path.join(self._directory, md5[:2], md5 + '.osu')
+
+
+    def get(self, md5):
+        """
+        Returns the contents of the file with the given MD5 hash, or None if it is not stored.
+        """
+
+        path = self.path(md5)
+
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Mark the file as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return content
+
+
+    def put(self, content):
+        """
+        Stores a file, then evicts the least recently used files if the store is too large.
+
+        Args:
+            content (bytes): The contents of the file.
+
+        Returns:
+            md5 (str): The MD5 hash of the file.
+        """
+
+        md5 = hashlib.md5(content).hexdigest()
+        path = self.path(md5)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file in the same directory first,
+        # so the file appears under its final name whole, or not at all.
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+        self.evict()
+
+        return md5
+
+
+    def evict(self):
+        """
+        Removes the least recently used files until the store fits within max_bytes.
+        """
+
+        files = []
+        total_bytes = 0
+
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                if not name.endswith('.osu'):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                files.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        if total_bytes <= self._max_bytes:
+            return
+
+        for _, size, path in sorted(files):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            total_bytes -= size
+            logger.debug('Evicted %s from the beatmap store', path)
+
+            if total_bytes <= self._max_bytes:
+                break
+
+
+@lru_cache(maxsize=None)
+def get_beatmap_store():
+    """
+    Returns the beatmap store configured in settings.
+    """
+
+    return BeatmapStore(settings.OSU_ACC_BEATMAP_STORE_DIR,
+                        settings.OSU_ACC_BEATMAP_STORE_MAX_BYTES)
@@ -1,3 +1,196 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+
+from osu_acc.beatmap import parser
+from osu_acc.beatmap import timeline
+from osu_acc.beatmap.models import HitObject, Timeline, TimingPoint
+
+# A circle, sliders without ticks, with repeats and ticks and under an inherited
+# timing point that doubles the slider velocity, and a spinner
+TIMELINE_BEATMAP_FILE = b'''osu file format v14
+
+[Difficulty]
+SliderMultiplier:1.4
+SliderTickRate:1
+
+[TimingPoints]
+0,500,4,2,1,60,1,0
+5500,-50,4,2,1,60,0,0
+
+[HitObjects]
+256,192,1000,1,0,0:0:0:0:
+100,100,2000,2,0,B|200:100,1,140
+100,100,3000,2,0,L|450:100,2,350
+100,100,6000,2,0,L|380:100,1,280
+256,192,8000,12,0,9500,0:0:0:0:
+'''
+
+
+class PackedArrayFieldTest(TestCase):
+    """
+    Round-trips packed arrays through the DB, as stored and loaded by the DB driver.
+    """
+
+
+    def test_round_trip(self):
+        HitObject.objects.create(beatmap_id='1',
+                                 x_coords=[256, 100, 0],
+                                 y_coords=[192, 100, 384],
+                                 hit_object_times=[1000, 2000, 2500],
+                                 hit_object_types=[1, 2, 12],
+                                 hit_object_slides=[1, 2, 1],
+                                 hit_object_lengths=[0, 140.5, 0],
+                                 hit_object_end_times=[1000, 2000, 5000])
+
+        hit_object = HitObject.objects.get(beatmap_id='1')
+
+        self.assertIsInstance(hit_object.x_coords, np.ndarray)
+        np.testing.assert_array_equal(hit_object.x_coords, [256, 100, 0])
+        np.testing.assert_array_equal(hit_object.hit_object_times, [1000, 2000, 2500])
+        np.testing.assert_array_equal(hit_object.hit_object_lengths, [0, 140.5, 0])
+        np.testing.assert_array_equal(hit_object.hit_object_end_times, [1000, 2000, 5000])
+
+
+    def test_round_trip_empty(self):
+        HitObject.objects.create(beatmap_id='1',
+                                 x_coords=[],
+                                 y_coords=[],
+                                 hit_object_times=[],
+                                 hit_object_types=[])
+
+        hit_object = HitObject.objects.get(beatmap_id='1')
+
+        self.assertEqual(len(hit_object.hit_object_times), 0)
+        self.assertEqual(len(hit_object.hit_object_slides), 0)
+
+
+    def test_round_trip_timeline(self):
+        # Hundredths of a millisecond well past where float32 could hold them
+        Timeline.objects.create(beatmap_id='1',
+                                event_times=[1000, 1234567.89, 1234600.01],
+                                event_kinds=[0, 1, 4],
+                                event_objects=[0, 1, 1])
+
+        timeline_model = Timeline.objects.get(beatmap_id='1')
+
+        np.testing.assert_array_equal(timeline_model.event_times, [1000, 1234567.89, 1234600.01])
+        np.testing.assert_array_equal(timeline_model.event_kinds, [0, 1, 4])
+        np.testing.assert_array_equal(timeline_model.event_objects, [0, 1, 1])
+
+
+class TimelineTest(SimpleTestCase):
+    """
+    Compiles judgement timelines, checking each event against its hand-computed time.
+    """
+
+
+    def test_timing_index(self):
+        # An inherited point before the first uninherited one, and SVs outside 0.1x - 10x
+        timing_index = timeline.TimingIndex([0, 1000, 2000, 3000, 4000],
+                                            [-50, 400, -25, -2000, 300])
+
+        for time, expected in ((-100, (400, 2.0)),
+                               (500, (400, 2.0)),
+                               (1000, (400, 1.0)),
+                               (2500, (400, 4.0)),
+                               (3000, (400, 0.1)),
+                               (4000, (300, 1.0))):
+            with self.subTest(time=time):
+                self.assertEqual(timing_index.at(time), expected)
+
+        self.assertEqual(timeline.TimingIndex([], []).at(1000), (500.0, 1.0))
+
+
+    def test_slider_events(self):
+        # 140 osu!pixels per beat of 500 ms
+        for slides, length, tick_rate, expected in (
+                # Too short for a tick
+                (1, 140, 1, [(0, timeline.SLIDER_HEAD), (500, timeline.SLIDER_END)]),
+                # A tick 1/8 of a beat before the end is dropped, one just before is kept
+                (1, 157.5, 1, [(0, timeline.SLIDER_HEAD), (562.5, timeline.SLIDER_END)]),
+                (1, 158, 1, [(0, timeline.SLIDER_HEAD), (500, timeline.SLIDER_TICK),
+                             (564.2857142857143, timeline.SLIDER_END)]),
+                # Two ticks per beat
+                (1, 140, 2, [(0, timeline.SLIDER_HEAD), (250, timeline.SLIDER_TICK),
+                             (500, timeline.SLIDER_END)]),
+                # Ticks sit at the same places along the slider, so the
+                # reversed slide meets them in mirrored order
+                (2, 175, 2, [(0, timeline.SLIDER_HEAD), (250, timeline.SLIDER_TICK),
+                             (500, timeline.SLIDER_TICK), (625, timeline.SLIDER_REPEAT),
+                             (750, timeline.SLIDER_TICK), (1000, timeline.SLIDER_TICK),
+                             (1250, timeline.SLIDER_END)]),
+                (3, 140, 1, [(0, timeline.SLIDER_HEAD), (500, timeline.SLIDER_REPEAT),
+                             (1000, timeline.SLIDER_REPEAT), (1500, timeline.SLIDER_END)])):
+            with self.subTest(slides=slides, length=length, tick_rate=tick_rate):
+                events = timeline.get_slider_events(0, slides, length, 500, 1.0, 1.4, tick_rate)
+                self.assertEqual(len(events), len(expected))
+
+                for (time, kind), (expected_time, expected_kind) in zip(events, expected):
+                    self.assertAlmostEqual(time, expected_time)
+                    self.assertEqual(kind, expected_kind)
+
+
+    def test_compile_timeline(self):
+        beatmap = parser.parse_beatmap_file(TIMELINE_BEATMAP_FILE)
+        hit_object_model = HitObject(beatmap_id='1', **beatmap['hit_object'])
+        timing_point_model = TimingPoint(beatmap_id='1', **beatmap['timing_point'])
+
+        fields = timeline.compile_timeline(hit_object_model, timing_point_model,
+                                           beatmap['Difficulty']['SliderMultiplier'],
+                                           beatmap['Difficulty']['SliderTickRate'])
+
+        expected = [
+            (1000, timeline.HIT_CIRCLE, 0),
+            (2000, timeline.SLIDER_HEAD, 1),
+            (2500, timeline.SLIDER_END, 1),
+            # 1250 ms slides, with ticks 500 and 1000 ms from the head
+            (3000, timeline.SLIDER_HEAD, 2),
+            (3500, timeline.SLIDER_TICK, 2),
+            (4000, timeline.SLIDER_TICK, 2),
+            (4250, timeline.SLIDER_REPEAT, 2),
+            (4500, timeline.SLIDER_TICK, 2),
+            (5000, timeline.SLIDER_TICK, 2),
+            (5500, timeline.SLIDER_END, 2),
+            # Twice the slider velocity, so 280 osu!pixels take one beat
+            (6000, timeline.SLIDER_HEAD, 3),
+            (6500, timeline.SLIDER_END, 3),
+            (8000, timeline.SPINNER_START, 4),
+            (9500, timeline.SPINNER_END, 4),
+        ]
+
+        self.assertEqual(list(zip(fields['event_times'], fields['event_kinds'],
+                                  fields['event_objects'])), expected)
+
+
+class ParseBeatmapTest(SimpleTestCase):
+    """
+    Parses beatmap files as written by different editors.
+    """
+
+
+    def test_fractional_fields(self):
+        beatmap = parser.parse_beatmap_file(b'''osu file format v14
+
+[Events]
+2,10000.4,15000.6
+
+[TimingPoints]
+0.6,500,4,2,1,60,1,0
+
+[HitObjects]
+256.4,191.6,999.6,1,0,0:0:0:0:
+100,100,2000.2,2,0,B|200:100,1,140.125
+256,192,3000,12,0,4999.7,0:0:0:0:
+''')
+
+        self.assertEqual(beatmap['break_period'], {'starts': [10000], 'ends': [15001]})
+        self.assertEqual(beatmap['timing_point']['offsets'], [1])
+
+        hit_object = beatmap['hit_object']
+        self.assertEqual(hit_object['x_coords'], [256, 100, 256])
+        self.assertEqual(hit_object['y_coords'], [192, 100, 192])
+        self.assertEqual(hit_object['hit_object_times'], [1000, 2000, 3000])
+        self.assertEqual(hit_object['hit_object_end_times'], [1000, 2000, 5000])
+        self.assertEqual(hit_object['hit_object_lengths'][1], Decimal('140.12'))
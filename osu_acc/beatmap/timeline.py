@@ -0,0 +1,188 @@
+"""
+A module to compile a beatmap's judgement timeline.
+
+The timeline lists every judgeable event of a beatmap in chronological order:
+hit circles, slider heads, ticks, repeats and ends, and the start and end of spinners.
+It is built once when a beatmap is ingested, so replay analysis only
+has to merge replay frames against it.
+"""
+
+from bisect import bisect_right
+
+
+# =============================================================================
+# EVENT KINDS
+# =============================================================================
+
+HIT_CIRCLE = 0
+SLIDER_HEAD = 1
+SLIDER_TICK = 2
+SLIDER_REPEAT = 3
+SLIDER_END = 4
+SPINNER_START = 5
+SPINNER_END = 6
+
+# Events judged by whether a key is held down, rather than by a click
+HELD_KINDS = (SLIDER_TICK, SLIDER_REPEAT, SLIDER_END)
+
+
+class TimingIndex():
+    """
+    Resolves the beat length and slider velocity in effect at any time of a beatmap.
+
+    Uninherited timing points (positive ms per beat) set the beat length
+    and reset the slider velocity, inherited ones (negative ms per beat)
+    scale the slider velocity by -100 / ms per beat.
+
+    The timing point format is described at the following link.
+    https://osu.ppy.sh/help/wiki/osu!_File_Formats/Osu_(file_format)#timing-points
+    """
+
+    __slots__ = ('_offsets', '_beat_lengths', '_velocities')
+
+
+    def __init__(self, offsets, ms_per_beats):
+        self._offsets = []
+        self._beat_lengths = []
+        self._velocities = []
+
+        beat_length = None
+        velocity = 1.0
+
+        for offset, ms_per_beat in zip(offsets, ms_per_beats):
+            ms_per_beat = float(ms_per_beat)
+
+            if ms_per_beat > 0:
+                beat_length = ms_per_beat
+                velocity = 1.0
+            elif ms_per_beat < 0:
+                # osu! clamps slider velocity multipliers to 0.1x - 10x
+                velocity = 100 / min(max(-ms_per_beat, 10), 1000)
+
+            self._offsets.append(float(offset))
+            self._beat_lengths.append(beat_length)
+            self._velocities.append(velocity)
+
+        # Inherited timing points before the first uninherited one
+        # take its beat length
+        first_beat_length = next((b for b in self._beat_lengths if b is not None), 500.0)
+        self._beat_lengths = [first_beat_length if b is None else b for b in self._beat_lengths]
+
+
+    def at(self, time):
+        """
+        Returns the beat length, in ms, and the slider velocity multiplier in effect at time.
+        """
+
+        if not self._offsets:
+            return 500.0, 1.0
+
+        # Objects before the first timing point use the first timing point
+        i = max(bisect_right(self._offsets, time) - 1, 0)
+        return self._beat_lengths[i], self._velocities[i]
+
+
+def get_slider_events(time, slides, length, beat_length, velocity,
+                      slider_multiplier, slider_tick_rate):
+    """
+    Returns the (time, kind) events of a single slider, in chronological order.
+
+    Args:
+        time (float): The time of the slider head.
+        slides (int): The number of times the slider is traversed.
+        length (float): The length of the slider in osu!pixels.
+        beat_length (float): The beat length in effect, in ms.
+        velocity (float): The slider velocity multiplier in effect.
+        slider_multiplier (float): The beatmap's base slider velocity.
+        slider_tick_rate (float): The beatmap's number of slider ticks per beat.
+
+    Returns:
+        events (List(tuple)): The slider's events.
+    """
+
+    events = [(time, SLIDER_HEAD)]
+
+    px_per_beat = slider_multiplier * 100 * velocity
+    slide_duration = length / px_per_beat * beat_length
+
+    tick_interval = beat_length / slider_tick_rate if slider_tick_rate > 0 else 0
+    tick_offsets = []
+
+    # Ticks too close to the end of a slide are not generated
+    if tick_interval > 0:
+        tick_offset = tick_interval
+        while tick_offset < slide_duration - tick_interval / 8:
+            tick_offsets.append(tick_offset)
+            tick_offset += tick_interval
+
+    for slide in range(slides):
+        slide_start = time + slide * slide_duration
+
+        # Every other slide runs backwards along the slider
+        if slide % 2 == 0:
+            offsets = tick_offsets
+        else:
+            offsets = [slide_duration - offset for offset in reversed(tick_offsets)]
+
+        events.extend((slide_start + offset, SLIDER_TICK) for offset in offsets)
+
+        if slide < slides - 1:
+            events.append((slide_start + slide_duration, SLIDER_REPEAT))
+
+    events.append((time + slides * slide_duration, SLIDER_END))
+
+    return events
+
+
+def compile_timeline(hit_object_model, timing_point_model, slider_multiplier, slider_tick_rate):
+    """
+    Compiles the judgement timeline of a beatmap.
+
+    Args:
+        hit_object_model (beatmap.models.HitObject): The beatmap's hit objects.
+        timing_point_model (beatmap.models.TimingPoint): The beatmap's timing points.
+        slider_multiplier (Decimal or float): The beatmap's base slider velocity.
+        slider_tick_rate (Decimal or float): The beatmap's number of slider ticks per beat.
+
+    Returns:
+        fields (dict): The event times, kinds and owning hit object indices,
+        in chronological order, keyed as the fields on the Timeline model.
+    """
+
+    timing_index = TimingIndex(timing_point_model.offsets, timing_point_model.ms_per_beats)
+    slider_multiplier = float(slider_multiplier)
+    slider_tick_rate = float(slider_tick_rate)
+
+    events = []
+
+    for i, obj_type in enumerate(hit_object_model.hit_object_types):
+        obj_type = int(obj_type)
+        obj_time = float(hit_object_model.hit_object_times[i])
+
+        # Refer to the "Type" section of the link below
+        # https://osu.ppy.sh/help/wiki/osu!_File_Formats/Osu_(file_format)#hit-objects
+        if obj_type & 0b1011 == 0b1000:
+            events.append((obj_time, SPINNER_START, i))
+            events.append((float(hit_object_model.hit_object_end_times[i]), SPINNER_END, i))
+        elif obj_type & 0b11 == 0b10:
+            beat_length, velocity = timing_index.at(obj_time)
+            slider_events = get_slider_events(obj_time,
+                                              int(hit_object_model.hit_object_slides[i]),
+                                              float(hit_object_model.hit_object_lengths[i]),
+                                              beat_length,
+                                              velocity,
+                                              slider_multiplier,
+                                              slider_tick_rate)
+            events.extend((event_time, kind, i) for event_time, kind in slider_events)
+        else:
+            events.append((obj_time, HIT_CIRCLE, i))
+
+    # Slider events can run past the start of the next hit object
+    events.sort(key=lambda event: event[0])
+
+    fields = {}
+    fields['event_times'] = [round(event[0], 2) for event in events]
+    fields['event_kinds'] = [event[1] for event in events]
+    fields['event_objects'] = [event[2] for event in events]
+
+    return fields
@@ -0,0 +1,131 @@
+"""
+A module for model fields shared by all apps.
+"""
+
+import zlib
+from base64 import b64decode, b64encode
+
+import numpy as np
+from django.db import models
+
+
+class PackedArrayField(models.BinaryField):
+    """
+    Stores a one dimensional series as packed little-endian bytes, and loads it as a NumPy array.
+
+    The stored value is a single flags byte followed by the packed elements.
+    With delta=True, each element is stored as its difference from the previous one,
+    which keeps sorted integer series such as times small and compressible.
+    With compress=True, the elements are zlib compressed. The flags byte records
+    how a value was stored, so either option can be changed without rewriting rows.
+
+    Arrays loaded from the DB are read-only, as they are views of the fetched bytes
+    wherever possible.
+    """
+
+    description = 'Packed little-endian array'
+
+    FLAG_COMPRESSED = 0b01
+    FLAG_DELTA = 0b10
+
+    valid_dtypes = set(['<i2', '<i4', '<f4', '<f8'])
+
+
+    def __init__(self, *args, dtype='<f4', delta=False, compress=False, **kwargs):
+        if np.dtype(dtype).str not in self.valid_dtypes:
+            raise ValueError('Invalid dtype {d} passed to PackedArrayField'.format(d=dtype))
+
+        self.dtype = np.dtype(dtype)
+        self.delta = delta
+        self.compress = compress
+        super().__init__(*args, **kwargs)
+
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+
+        kwargs['dtype'] = self.dtype.str
+        if self.delta:
+            kwargs['delta'] = True
+        if self.compress:
+            kwargs['compress'] = True
+
+        return name, path, args, kwargs
+
+
+    def pack(self, value):
+        """
+        Returns value, an array-like, packed as bytes.
+        """
+
+        values = np.asarray(value, dtype=np.float64 if self.dtype.kind == 'f' else None)
+        flags = 0
+
+        if self.delta and len(values):
+            values = np.diff(values, prepend=0)
+            flags |= self.FLAG_DELTA
+
+        # Round rather than truncate floats stored as integers
+        if self.dtype.kind == 'i' and values.dtype.kind == 'f':
+            values = np.rint(values)
+
+        data = values.astype(self.dtype).tobytes()
+
+        if self.compress:
+            data = zlib.compress(data)
+            flags |= self.FLAG_COMPRESSED
+
+        return bytes([flags]) + data
+
+
+    def unpack(self, data):
+        """
+        Returns data, as packed by pack(), as a NumPy array.
+        """
+
+        # psycopg2 returns bytea as a memoryview of chars, so index it as bytes
+        data = memoryview(data).cast('B')
+        flags = data[0]
+        data = data[1:]
+
+        if flags & self.FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+
+        values = np.frombuffer(data, dtype=self.dtype)
+
+        if flags & self.FLAG_DELTA:
+            values = np.cumsum(values, dtype=self.dtype)
+
+        return values
+
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+
+        return self.unpack(value)
+
+
+    def to_python(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+
+        if isinstance(value, (bytes, memoryview)):
+            return self.unpack(value)
+
+        # Serialized values, as returned by value_to_string()
+        if isinstance(value, str):
+            return self.unpack(b64decode(value.encode('ascii')))
+
+        return np.asarray(value, dtype=self.dtype)
+
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, memoryview)):
+            return value
+
+        return self.pack(value)
+
+
+    def value_to_string(self, obj):
+        return b64encode(self.get_prep_value(self.value_from_object(obj))).decode('ascii')
@@ -0,0 +1,70 @@
+"""
+A module for locks coordinating concurrent work across threads and processes.
+"""
+
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+
+
+# In-process locks by key, with the number of threads holding or waiting on each
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def get_lock_id(key):
+    """
+    Returns the signed 64-bit integer Postgres advisory locks are identified by.
+    """
+
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+@contextmanager
+def local_lock(key):
+    """
+    Holds the in-process lock of key. Locks are dropped once no thread needs them.
+    """
+
+    with _locks_guard:
+        entry = _locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _locks[key]
+
+
+@contextmanager
+def single_flight(key):
+    """
+    Runs the enclosed block for one caller of key at a time, across threads and processes.
+
+    Threads of the same process wait on an in-process lock, so they do not each
+    hold a database connection while waiting. Processes wait on a Postgres
+    transaction-level advisory lock. The block runs within that transaction,
+    so whatever it writes is visible to the next caller once it is let in.
+
+    Callers should check whether the work was already done by a previous caller
+    first thing within the block.
+
+    Args:
+        key (str): Identifies the work to coordinate.
+    """
+
+    with local_lock(key):
+        with transaction.atomic():
+            # Other backends only get the in-process lock
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [get_lock_id(key)])
+
+            yield
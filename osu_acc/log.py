@@ -0,0 +1,28 @@
+"""
+A module for logging helpers shared by all apps.
+"""
+
+import logging
+import random
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only a fraction of the records below a given level.
+
+    Records at or above the level always pass, so warnings and errors
+    are never dropped while chatty debug output can be thinned out.
+    """
+
+
+    def __init__(self, rate=1.0, level='INFO'):
+        super().__init__()
+        self._rate = rate
+        self._level = logging.getLevelName(level) if isinstance(level, str) else level
+
+
+    def filter(self, record):
+        if record.levelno >= self._level:
+            return True
+
+        return random.random() < self._rate
@@ -0,0 +1,260 @@
+"""
+A module for the HTTP client shared by every call to osu!api and osu!web.
+
+Requests go through one keep-alive connection pool per process, with a timeout
+per endpoint and bounded retries with exponential backoff. Calls to osu!api
+are paced by a token bucket, so bursts of uploads never trip its rate limit.
+The base URLs come from settings, so the client can be pointed at a local stub server.
+"""
+
+import logging
+import os
+import threading
+import time
+from secrets import OSU_API_KEY
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class EndpointMetrics():
+    """
+    Represents the latency of every request made to an endpoint, retries included.
+    """
+
+    __slots__ = ('_num_requests', '_num_errors', '_total_seconds', '_max_seconds')
+
+
+    def __init__(self):
+        self._num_requests = 0
+        self._num_errors = 0
+        self._total_seconds = 0.0
+        self._max_seconds = 0.0
+
+
+    @property
+    def num_requests(self):
+        return self._num_requests
+
+
+    @property
+    def num_errors(self):
+        return self._num_errors
+
+
+    @property
+    def avg_seconds(self):
+        if not self._num_requests:
+            return None
+        return self._total_seconds / self._num_requests
+
+
+    @property
+    def max_seconds(self):
+        return self._max_seconds
+
+
+    def add(self, seconds, failed):
+        self._num_requests += 1
+        self._num_errors += failed
+        self._total_seconds += seconds
+        self._max_seconds = max(self._max_seconds, seconds)
+
+
+class TokenBucket():
+    """
+    Represents a token bucket rate limiter.
+
+    Tokens refill at rate per second, up to capacity, so bursts of up to capacity
+    calls go through at once and sustained traffic is held to rate calls per second.
+    """
+
+    __slots__ = ('_rate', '_capacity', '_tokens', '_updated', '_lock')
+
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    @property
+    def rate(self):
+        return self._rate
+
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+
+    def acquire(self):
+        """
+        Takes a token, waiting for one to refill if the bucket is empty.
+
+        Returns:
+            waited (float): The number of seconds waited.
+        """
+
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity,
+                                   self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+
+                wait = (1 - self._tokens) / self._rate
+
+            time.sleep(wait)
+            waited += wait
+
+
+# Sessions are not shared across processes, as pooled sockets do not survive a fork
+_sessions = {}
+_metrics = {}
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns this process's pooled session.
+    """
+
+    pid = os.getpid()
+
+    with _lock:
+        if pid not in _sessions:
+            retry = Retry(total=settings.OSU_ACC_HTTP_RETRIES,
+                          backoff_factor=settings.OSU_ACC_HTTP_BACKOFF,
+                          status_forcelist=RETRY_STATUSES)
+            adapter = HTTPAdapter(pool_connections=settings.OSU_ACC_HTTP_POOL_SIZE,
+                                  pool_maxsize=settings.OSU_ACC_HTTP_POOL_SIZE,
+                                  max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[pid] = session
+
+        return _sessions[pid]
+
+
+def get_api_bucket():
+    """
+    Returns this process's osu!api rate limiter.
+
+    Each process paces itself, so OSU_ACC_API_RATE should be osu!api's limit
+    divided by the number of processes calling it.
+    """
+
+    pid = os.getpid()
+
+    with _lock:
+        if pid not in _buckets:
+            _buckets[pid] = TokenBucket(settings.OSU_ACC_API_RATE, settings.OSU_ACC_API_BURST)
+
+        return _buckets[pid]
+
+
+def get_metrics():
+    """
+    Returns the EndpointMetrics of every endpoint requested by this process.
+    """
+
+    with _lock:
+        return dict(_metrics)
+
+
+def request(endpoint, url, params=None):
+    """
+    Makes a GET request and records its latency.
+
+    Args:
+        endpoint (str): The name of the endpoint, as keyed in OSU_ACC_HTTP_TIMEOUTS.
+        url (str): The URL to request.
+        params (dict): The query parameters.
+
+    Returns:
+        response (requests.Response): The response.
+
+    Raises:
+        requests.RequestException: If the request failed once retries were exhausted.
+    """
+
+    timeout = settings.OSU_ACC_HTTP_TIMEOUTS[endpoint]
+    started = time.perf_counter()
+    failed = True
+
+    try:
+        response = get_session().get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        failed = False
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+
+        with _lock:
+            _metrics.setdefault(endpoint, EndpointMetrics()).add(elapsed, failed)
+
+        logger.debug('GET %s took %.1fms%s', endpoint, elapsed * 1000,
+                     ' and failed' if failed else '')
+
+
+# =============================================================================
+# ENDPOINTS
+# =============================================================================
+
+
+def get_beatmaps(beatmap_hash):
+    """
+    Requests the metadata of the beatmap with the given file hash.
+
+    Args:
+        beatmap_hash (str): The MD5 hash of the beatmap file.
+
+    Returns:
+        (List(dict)): The matching beatmaps, empty if osu!api does not know the hash.
+    """
+
+    waited = get_api_bucket().acquire()
+    if waited:
+        logger.debug('Waited %.1fms for the osu!api rate limit', waited * 1000)
+
+    url = settings.OSU_ACC_API_URL + 'get_beatmaps'
+    response = request('get_beatmaps', url, {'k': OSU_API_KEY, 'h': beatmap_hash})
+
+    return response.json()
+
+
+def get_beatmap_file(beatmap_id):
+    """
+    Downloads a beatmap's .osu file.
+
+    Args:
+        beatmap_id (str): The id of the beatmap, given by osu!api.
+
+    Returns:
+        (bytes): The contents of the file.
+    """
+
+    url = settings.OSU_ACC_BEATMAP_FILE_URL + beatmap_id
+    response = request('beatmap_file', url)
+
+    return response.content
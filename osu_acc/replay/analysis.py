@@ -0,0 +1,413 @@
+"""
+Module for the columnar replay analysis backend.
+
+Every function in here works on whole NumPy arrays at once,
+as held by classes.ReplayFrames and classes.HitObjects.
+"""
+
+import numpy as np
+
+from osu_acc.beatmap import timeline
+from osu_acc.replay import classes
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+# Bits of the keys bitmask that count as a click.
+# K1 and K2 are always reported together with M1 and M2 respectively.
+# Higher bits, such as smoke, are not clicks.
+CLICK_KEYS = 0b1111
+
+
+# =============================================================================
+# CONVERSION METHODS
+# =============================================================================
+
+
+def as_replay_frames(replay_events):
+    """
+    Returns replay_events as a classes.ReplayFrames instance.
+
+    Args:
+        replay_events (classes.ReplayFrames or List(classes.ReplayEvent)): The replay events.
+
+    Returns:
+        (classes.ReplayFrames): The replay events as columns.
+    """
+
+    if isinstance(replay_events, classes.ReplayFrames):
+        return replay_events
+
+    return classes.ReplayFrames(
+        [replay_event.x for replay_event in replay_events],
+        [replay_event.y for replay_event in replay_events],
+        [replay_event.time for replay_event in replay_events],
+        [replay_event.keys for replay_event in replay_events],
+    )
+
+
+def as_hit_objects(hit_objects):
+    """
+    Returns hit_objects as a classes.HitObjects instance.
+
+    Args:
+        hit_objects (classes.HitObjects or List(classes.HitObject)): The hit objects.
+
+    Returns:
+        (classes.HitObjects): The hit objects as columns.
+    """
+
+    if isinstance(hit_objects, classes.HitObjects):
+        return hit_objects
+
+    return classes.HitObjects(
+        [hit_object.x for hit_object in hit_objects],
+        [hit_object.y for hit_object in hit_objects],
+        [hit_object.time for hit_object in hit_objects],
+        [hit_object.obj_type for hit_object in hit_objects],
+    )
+
+
+def as_break_index(break_periods):
+    """
+    Returns break_periods as a classes.BreakIndex instance.
+
+    Args:
+        break_periods (classes.BreakIndex or List(classes.BreakPeriod)): The break periods.
+
+    Returns:
+        (classes.BreakIndex): An interval index over the break periods.
+    """
+
+    if isinstance(break_periods, classes.BreakIndex):
+        return break_periods
+
+    return classes.BreakIndex(
+        [break_period.start for break_period in break_periods],
+        [break_period.end for break_period in break_periods],
+    )
+
+
+# =============================================================================
+# CALCULATION METHODS
+# =============================================================================
+
+
+def get_press_edges(keys):
+    """
+    Returns the indices of the frames where at least one key goes down.
+
+    Holding a key down over several frames only counts as a press on the first frame.
+
+    Args:
+        keys (np.ndarray): The keys bitmask of every frame, in chronological order.
+
+    Returns:
+        (np.ndarray): The indices of the press-down frames.
+    """
+
+    held = np.asarray(keys) & CLICK_KEYS
+    previously_held = np.concatenate(([0], held[:-1]))
+
+    return np.flatnonzero(held & ~previously_held)
+
+
+def get_presses(frames):
+    """
+    Returns only the frames where at least one key goes down.
+
+    Args:
+        frames (classes.ReplayFrames): The replay frames.
+
+    Returns:
+        (classes.ReplayFrames): The press-down frames.
+    """
+
+    return frames.take(get_press_edges(frames.keys))
+
+
+def drop_break_frames(frames, break_index):
+    """
+    Returns the replay frames that do not fall within a break period.
+
+    Args:
+        frames (classes.ReplayFrames): The replay frames.
+        break_index (classes.BreakIndex): The beatmap's break periods.
+
+    Returns:
+        (classes.ReplayFrames): The replay frames outside of every break period.
+    """
+
+    if not len(break_index):
+        return frames
+
+    return frames.take(~break_index.mask(frames.time))
+
+
+def is_cursor_on_note(circle_radius, frames, frame_indices, hit_objects, object_indices):
+    """
+    Returns a boolean array, True where the cursor is on the paired hit object.
+
+    The i-th frame of frame_indices is paired with the i-th hit object of object_indices.
+
+    Args:
+        circle_radius (float): The circle radius in osu!pixels.
+        frames (classes.ReplayFrames): The replay frames.
+        frame_indices (np.ndarray): Indices into frames.
+        hit_objects (classes.HitObjects): The hit objects.
+        object_indices (np.ndarray): Indices into hit_objects.
+
+    Returns:
+        (np.ndarray): Whether each cursor is within its circle or not.
+    """
+
+    dx = frames.x[frame_indices] - hit_objects.x[object_indices]
+    dy = frames.y[frame_indices] - hit_objects.y[object_indices]
+
+    return dx*dx + dy*dy < circle_radius*circle_radius
+
+
+def find_matches(circle_radius, hit_window, frames, hit_objects):
+    """
+    Finds both the 'true' and the 'raw' association of every hit object in one pass.
+
+    Hit objects are walked in chronological order, and each frame is associated
+    with at most one hit object. The 'true' match of a hit object is the earliest
+    frame within its hit window not taken by an earlier hit object.
+    The 'raw' match is the earliest such frame that has the cursor on the note.
+
+    As with notelock, frames that miss the note while it can still be hit
+    are used up, and cannot hit a later hit object either.
+
+    Args:
+        circle_radius (float): The circle radius in osu!pixels.
+        hit_window (float): The 50 hit window in ms.
+        frames (classes.ReplayFrames): The replay frames.
+        hit_objects (classes.HitObjects): The hit objects.
+
+    Returns:
+        (tuple): The 'true' and the 'raw' matches, each an array holding
+        the index of the associated frame for every hit object,
+        or -1 if the hit object was not associated. Spinners are never associated.
+    """
+
+    num_hit_objects = len(hit_objects)
+    true_matches = np.full(num_hit_objects, -1, dtype=np.intp)
+    raw_matches = np.full(num_hit_objects, -1, dtype=np.intp)
+
+    # Window bounds of every hit object, as [lo, hi) indices into frames
+    lo = np.searchsorted(frames.time, hit_objects.time - hit_window, side='left')
+    hi = np.searchsorted(frames.time, hit_objects.time + hit_window, side='right')
+
+    # Spinners do not meaningfully affect accuracy,
+    # and thus will not be associated.
+    counts = np.where(hit_objects.is_spinner(), 0, hi - lo)
+
+    # Flatten every (hit object, frame within its window) pair,
+    # ordered by hit object and then by time.
+    object_indices = np.repeat(np.arange(num_hit_objects), counts)
+    pair_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    frame_indices = np.repeat(lo, counts) + np.arange(len(object_indices)) - pair_starts
+
+    on_note = is_cursor_on_note(circle_radius, frames, frame_indices,
+                                hit_objects, object_indices)
+
+    # The on-note frames within the window of each hit object, in order,
+    # are on_note_frames[on_note_ends[i] - on_note_counts[i]:on_note_ends[i]].
+    on_note_frames = frame_indices[on_note].tolist()
+    on_note_counts = np.bincount(object_indices[on_note], minlength=num_hit_objects)
+    on_note_ends = np.cumsum(on_note_counts).tolist()
+    on_note_counts = on_note_counts.tolist()
+
+    lo = lo.tolist()
+    hi = hi.tolist()
+
+    # Index of the earliest frame not yet used up, for each mode
+    true_next = 0
+    raw_next = 0
+
+    # Which frame each hit object takes depends on the hit objects before it,
+    # so this last step walks the attempted hit objects one by one.
+    for i in np.flatnonzero(counts).tolist():
+        first = max(lo[i], true_next)
+
+        if first < hi[i]:
+            true_matches[i] = first
+            true_next = first + 1
+
+        end = on_note_ends[i]
+        # Every frame within the window of a miss is used up
+        next_after = max(raw_next, hi[i])
+
+        for frame_index in on_note_frames[end - on_note_counts[i]:end]:
+            if frame_index >= raw_next:
+                raw_matches[i] = frame_index
+                next_after = frame_index + 1
+                break
+
+        raw_next = next_after
+
+    return true_matches, raw_matches
+
+
+def associate_hits(mode, circle_radius, hit_window, frames, hit_objects):
+    """
+    Associates every hit object with the index of a replay frame.
+
+    Args:
+        mode (str): Either 'raw' or 'true'.
+        circle_radius (float): The circle radius in osu!pixels.
+        hit_window (float): The 50 hit window in ms.
+        frames (classes.ReplayFrames): The replay frames.
+        hit_objects (classes.HitObjects): The hit objects.
+
+    Returns:
+        matches (np.ndarray): The index of the associated frame for every hit object,
+        or -1 if the hit object was not associated. Spinners are never associated.
+    """
+
+    valid_modes = set(['raw', 'true'])
+
+    if mode not in valid_modes:
+        raise ValueError('Invalid mode {m} passed to associate_hits()'.format(m=mode))
+
+    true_matches, raw_matches = find_matches(circle_radius, hit_window, frames, hit_objects)
+
+    if mode == 'true':
+        return true_matches
+
+    return raw_matches
+
+
+def get_hit_errors(frames, hit_objects, matches):
+    """
+    Returns the hit error of every hit object, NaN where it was not associated.
+
+    Args:
+        frames (classes.ReplayFrames): The replay frames.
+        hit_objects (classes.HitObjects): The hit objects.
+        matches (np.ndarray): The associations, as returned by associate_hits().
+
+    Returns:
+        hit_errors (np.ndarray): The hit errors in ms.
+    """
+
+    hit_errors = np.full(len(hit_objects), np.nan)
+    matched = matches >= 0
+    hit_errors[matched] = frames.time[matches[matched]] - hit_objects.time[matched]
+
+    return hit_errors
+
+
+def get_scores(hit_errors, perf_window, good_window, bad_window):
+    """
+    Returns the score of every hit object: 300, 100, 50, or 0 for a miss.
+
+    Args:
+        hit_errors (np.ndarray): The hit errors, NaN where a hit object was missed.
+        perf_window (float): The 300 hit window in ms.
+        good_window (float): The 100 hit window in ms.
+        bad_window (float): The 50 hit window in ms.
+
+    Returns:
+        scores (np.ndarray): The scores.
+    """
+
+    # NaN compares False against every window, so misses fall through to 0
+    abs_errors = np.abs(hit_errors)
+
+    return np.select(
+        [abs_errors <= perf_window, abs_errors <= good_window, abs_errors <= bad_window],
+        [300, 100, 50],
+        default=0,
+    )
+
+
+def judge(difficulty, frames, hit_objects):
+    """
+    Judges every hit object in a single pass, in both 'raw' and 'true' mode.
+
+    Args:
+        difficulty (classes.BeatmapDifficulty): The beatmap's circle radius and hit windows.
+        frames (classes.ReplayFrames): The replay frames.
+        hit_objects (classes.HitObjects): The hit objects.
+
+    Returns:
+        (classes.Judgements): The judgement record of every hit object.
+    """
+
+    circle_radius = difficulty.circle_radius
+    perf_window = difficulty.perf_window
+    good_window = difficulty.good_window
+    bad_window = difficulty.bad_window
+
+    true_matches, raw_matches = find_matches(circle_radius, bad_window, frames, hit_objects)
+
+    true_errors = get_hit_errors(frames, hit_objects, true_matches)
+    raw_errors = get_hit_errors(frames, hit_objects, raw_matches)
+
+    # Whether the cursor was on the note on the first attempt at it
+    on_note = np.zeros(len(hit_objects), dtype=bool)
+    attempted = np.flatnonzero(true_matches >= 0)
+    on_note[attempted] = is_cursor_on_note(circle_radius, frames, true_matches[attempted],
+                                           hit_objects, attempted)
+
+    return classes.Judgements(
+        judgeable=~hit_objects.is_spinner(),
+        true_frames=true_matches,
+        raw_frames=raw_matches,
+        true_errors=true_errors,
+        raw_errors=raw_errors,
+        on_note=on_note,
+        true_scores=get_scores(true_errors, perf_window, good_window, bad_window),
+        raw_scores=get_scores(raw_errors, perf_window, good_window, bad_window),
+    )
+
+
+def count_judgements(scores, judgeable):
+    """
+    Returns the number of 300s, 100s, 50s and misses.
+
+    Args:
+        scores (np.ndarray): The score of every hit object, as returned by get_scores().
+        judgeable (np.ndarray): A boolean array, False for hit objects that are not judged.
+
+    Returns:
+        (tuple): The number of 300s, 100s, 50s and misses.
+    """
+
+    scores = scores[judgeable]
+
+    num_300 = np.count_nonzero(scores == 300)
+    num_100 = np.count_nonzero(scores == 100)
+    num_50 = np.count_nonzero(scores == 50)
+    num_miss = np.count_nonzero(scores == 0)
+
+    return int(num_300), int(num_100), int(num_50), int(num_miss)
+
+
+def judge_held_events(frames, judgement_timeline):
+    """
+    Judges every slider tick, repeat and end of a beatmap's timeline.
+
+    Each event is held if a click key was down on the last frame at or before it.
+    Both arrays are sorted by time, so this is a single merge of the two.
+
+    Args:
+        frames (classes.ReplayFrames): All replay frames, not only the presses.
+        judgement_timeline (classes.Timeline): The beatmap's judgement timeline.
+
+    Returns:
+        (tuple): The number of held events judged, and the number of them held.
+    """
+
+    event_times = judgement_timeline.time[np.isin(judgement_timeline.kind, timeline.HELD_KINDS)]
+
+    last_frames = np.searchsorted(frames.time, event_times, side='right') - 1
+    has_frame = last_frames >= 0
+    held = np.zeros(len(event_times), dtype=bool)
+    held[has_frame] = frames.keys[last_frames[has_frame]] & CLICK_KEYS != 0
+
+    return len(event_times), int(np.count_nonzero(held))
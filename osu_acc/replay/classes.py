@@ -2,7 +2,10 @@
 A module for shared classes.
 """
 
-from decimal import Decimal
+from bisect import bisect_right
+from math import ceil, sqrt
+
+import numpy as np
 
 
 class Association():
@@ -15,6 +18,8 @@ class Association():
     If the association is not valid, then we associate hit_object with None.
     """
 
+    __slots__ = ('_replay_event', '_hit_object', '_hit_error')
+
 
     def __init__(self, replay_event, hit_object, hit_error):
         self._replay_event = replay_event
@@ -37,11 +42,50 @@ class Association():
         return self._hit_error
 
 
+class BeatmapDifficulty():
+    """
+    Represents the parameters a beatmap's hit objects are judged with.
+
+    The circle radius is in osu!pixels, the hit windows are in ms.
+    """
+
+    __slots__ = ('_circle_radius', '_perf_window', '_good_window', '_bad_window')
+
+
+    def __init__(self, circle_radius, perf_window, good_window, bad_window):
+        self._circle_radius = circle_radius
+        self._perf_window = perf_window
+        self._good_window = good_window
+        self._bad_window = bad_window
+
+
+    @property
+    def circle_radius(self):
+        return self._circle_radius
+
+
+    @property
+    def perf_window(self):
+        return self._perf_window
+
+
+    @property
+    def good_window(self):
+        return self._good_window
+
+
+    @property
+    def bad_window(self):
+        return self._bad_window
+
+
 class BreakPeriod():
     """
     Represents a break period.
     """
 
+    __slots__ = ('_start', '_end')
+
 
     def __init__(self, start, end):
         self._start = start
@@ -58,16 +102,75 @@ class BreakPeriod():
         return self._end
 
 
+class BreakIndex():
+    """
+    Represents all break periods of a beatmap as a sorted interval index.
+
+    Both ends of a break period are inclusive.
+    """
+
+    __slots__ = ('_starts', '_ends', '_start_list')
+
+
+    def __init__(self, starts, ends):
+        order = np.argsort(np.asarray(starts, dtype=np.float64), kind='stable')
+        self._starts = np.asarray(starts, dtype=np.float64)[order]
+        self._ends = np.asarray(ends, dtype=np.float64)[order]
+        self._start_list = self._starts.tolist()
+
+
+    def __len__(self):
+        return len(self._starts)
+
+
+    @property
+    def starts(self):
+        return self._starts
+
+
+    @property
+    def ends(self):
+        return self._ends
+
+
+    def contains(self, time):
+        """
+        Returns True if time falls within a break period.
+        """
+
+        i = bisect_right(self._start_list, time) - 1
+        return i >= 0 and time <= self._ends[i]
+
+
+    def mask(self, times):
+        """
+        Returns a boolean array, True where the time falls within a break period.
+        """
+
+        times = np.asarray(times, dtype=np.float64)
+
+        if not len(self._starts):
+            return np.zeros(len(times), dtype=bool)
+
+        i = np.searchsorted(self._starts, times, side='right') - 1
+        return (i >= 0) & (times <= self._ends[np.maximum(i, 0)])
+
+
 class ReplayEvent():
     """
-    Represents a replay event, but stores time absolutely and ignores key.
+    Represents a replay event, but stores time absolutely.
+
+    keys is the K1/K2/M1/M2 bitmask of the keys held down during the event.
     """
 
+    __slots__ = ('_x', '_y', '_time', '_keys')
+
 
-    def __init__(self, x, y, time):
-        self._x = Decimal(x)
-        self._y = Decimal(y)
-        self._time = time
+    def __init__(self, x, y, time, keys=0):
+        self._x = float(x)
+        self._y = float(y)
+        self._time = float(time)
+        self._keys = int(keys)
 
 
     @property
@@ -85,16 +188,23 @@ class ReplayEvent():
         return self._time
 
 
+    @property
+    def keys(self):
+        return self._keys
+
+
 class HitObject():
     """
     Represents a hit object.
     """
 
+    __slots__ = ('_x', '_y', '_time', '_obj_type')
+
 
     def __init__(self, x, y, time, obj_type):
-        self._x = Decimal(x)
-        self._y = Decimal(y)
-        self._time = time
+        self._x = float(x)
+        self._y = float(y)
+        self._time = float(time)
         self._obj_type = obj_type
 
 
@@ -113,6 +223,11 @@ class HitObject():
         return self._time
 
 
+    @property
+    def obj_type(self):
+        return self._obj_type
+
+
     # =============================================================================
     # Refer to the "Type" section of the link below
     # https://osu.ppy.sh/help/wiki/osu!_File_Formats/Osu_(file_format)#hit-objects
@@ -129,3 +244,621 @@ class HitObject():
 
     def is_spinner(self):
         return self._obj_type & 0b1011 == 0b1000
+
+
+class ReplayFrames():
+    """
+    Represents all replay events of a replay as columns.
+
+    x and y are in osu!pixels, time counts the number of ms
+    from the start of the map, and keys is the K1/K2/M1/M2 bitmask
+    of the keys held down. Frames are sorted by time.
+
+    Indexing hands out a single frame as a classes.ReplayEvent.
+    """
+
+    __slots__ = ('_x', '_y', '_time', '_keys')
+
+
+    def __init__(self, x, y, time, keys):
+        self._x = np.asarray(x, dtype=np.float32)
+        self._y = np.asarray(y, dtype=np.float32)
+        self._time = np.asarray(time, dtype=np.float64)
+        self._keys = np.asarray(keys, dtype=np.int32)
+
+
+    def __len__(self):
+        return len(self._time)
+
+
+    @property
+    def x(self):
+        return self._x
+
+
+    @property
+    def y(self):
+        return self._y
+
+
+    @property
+    def time(self):
+        return self._time
+
+
+    @property
+    def keys(self):
+        return self._keys
+
+
+    def __getitem__(self, index):
+        """
+        Returns the frame at index as a classes.ReplayEvent.
+        """
+
+        return ReplayEvent(self._x[index], self._y[index], self._time[index], self._keys[index])
+
+
+    def __iter__(self):
+        for index in range(len(self._time)):
+            yield self[index]
+
+
+    def take(self, selection):
+        """
+        Returns the frames picked by selection, an index or boolean array, as ReplayFrames.
+        """
+
+        return ReplayFrames(self._x[selection], self._y[selection],
+                            self._time[selection], self._keys[selection])
+
+
+class HitObjects():
+    """
+    Represents all hit objects of a beatmap as columns.
+
+    Indexing hands out a single hit object as a classes.HitObject.
+    """
+
+    __slots__ = ('_x', '_y', '_time', '_obj_type')
+
+
+    def __init__(self, x, y, time, obj_type):
+        self._x = np.asarray(x, dtype=np.float32)
+        self._y = np.asarray(y, dtype=np.float32)
+        self._time = np.asarray(time, dtype=np.float64)
+        self._obj_type = np.asarray(obj_type, dtype=np.int32)
+
+
+    def __len__(self):
+        return len(self._time)
+
+
+    @property
+    def x(self):
+        return self._x
+
+
+    @property
+    def y(self):
+        return self._y
+
+
+    @property
+    def time(self):
+        return self._time
+
+
+    @property
+    def obj_type(self):
+        return self._obj_type
+
+
+    def __getitem__(self, index):
+        """
+        Returns the hit object at index as a classes.HitObject.
+        """
+
+        return HitObject(self._x[index], self._y[index],
+                         self._time[index], int(self._obj_type[index]))
+
+
+    def __iter__(self):
+        for index in range(len(self._time)):
+            yield self[index]
+
+
+    # =============================================================================
+    # Vectorized versions of the type checks on HitObject
+    # =============================================================================
+
+
+    def is_circle(self):
+        return self._obj_type & 0b1 == 0b1
+
+
+    def is_slider(self):
+        return self._obj_type & 0b11 == 0b10
+
+
+    def is_spinner(self):
+        return self._obj_type & 0b1011 == 0b1000
+
+
+class Timeline():
+    """
+    Represents a beatmap's judgement timeline as columns.
+
+    Event kinds are defined in osu_acc.beatmap.timeline.
+    """
+
+    __slots__ = ('_time', '_kind', '_obj_index')
+
+
+    def __init__(self, time, kind, obj_index):
+        self._time = np.asarray(time, dtype=np.float64)
+        self._kind = np.asarray(kind, dtype=np.int32)
+        self._obj_index = np.asarray(obj_index, dtype=np.int32)
+
+
+    def __len__(self):
+        return len(self._time)
+
+
+    @property
+    def time(self):
+        return self._time
+
+
+    @property
+    def kind(self):
+        return self._kind
+
+
+    @property
+    def obj_index(self):
+        return self._obj_index
+
+
+class ReplayHeader():
+    """
+    Represents the header of a replay file, everything but its frames.
+
+    frames_offset and frames_length locate the LZMA compressed frames within the file.
+    """
+
+    __slots__ = ('_game_mode', '_game_version', '_beatmap_hash', '_player_name', '_replay_hash',
+                 '_number_300s', '_number_100s', '_number_50s', '_gekis', '_katus', '_misses',
+                 '_score', '_max_combo', '_mod_combination', '_timestamp', '_frames_offset',
+                 '_frames_length')
+
+
+    def __init__(self, game_mode, game_version, beatmap_hash, player_name, replay_hash,
+                 number_300s, number_100s, number_50s, gekis, katus, misses,
+                 score, max_combo, mod_combination, timestamp, frames_offset, frames_length):
+        self._game_mode = game_mode
+        self._game_version = game_version
+        self._beatmap_hash = beatmap_hash
+        self._player_name = player_name
+        self._replay_hash = replay_hash
+        self._number_300s = number_300s
+        self._number_100s = number_100s
+        self._number_50s = number_50s
+        self._gekis = gekis
+        self._katus = katus
+        self._misses = misses
+        self._score = score
+        self._max_combo = max_combo
+        self._mod_combination = mod_combination
+        self._timestamp = timestamp
+        self._frames_offset = frames_offset
+        self._frames_length = frames_length
+
+
+    @property
+    def game_mode(self):
+        return self._game_mode
+
+
+    @property
+    def game_version(self):
+        return self._game_version
+
+
+    @property
+    def beatmap_hash(self):
+        return self._beatmap_hash
+
+
+    @property
+    def player_name(self):
+        return self._player_name
+
+
+    @property
+    def replay_hash(self):
+        return self._replay_hash
+
+
+    @property
+    def number_300s(self):
+        return self._number_300s
+
+
+    @property
+    def number_100s(self):
+        return self._number_100s
+
+
+    @property
+    def number_50s(self):
+        return self._number_50s
+
+
+    @property
+    def gekis(self):
+        return self._gekis
+
+
+    @property
+    def katus(self):
+        return self._katus
+
+
+    @property
+    def misses(self):
+        return self._misses
+
+
+    @property
+    def score(self):
+        return self._score
+
+
+    @property
+    def max_combo(self):
+        return self._max_combo
+
+
+    @property
+    def mod_combination(self):
+        return self._mod_combination
+
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+
+    @property
+    def frames_offset(self):
+        return self._frames_offset
+
+
+    @property
+    def frames_length(self):
+        return self._frames_length
+
+
+class ParsedReplay():
+    """
+    Represents the parts of a replay file needed to store it.
+
+    The header attributes are named as on ReplayHeader, so either can be
+    passed wherever only the header is read. The replay file itself is kept
+    to be analyzed and stored as is; its frames are not decoded yet.
+    """
+
+    __slots__ = ('_replay_hash', '_beatmap_hash', '_timestamp',
+                 '_number_300s', '_number_100s', '_number_50s', '_misses', '_replay_file')
+
+
+    def __init__(self, replay_hash, beatmap_hash, timestamp,
+                 number_300s, number_100s, number_50s, misses, replay_file):
+        self._replay_hash = replay_hash
+        self._beatmap_hash = beatmap_hash
+        self._timestamp = timestamp
+        self._number_300s = number_300s
+        self._number_100s = number_100s
+        self._number_50s = number_50s
+        self._misses = misses
+        self._replay_file = replay_file
+
+
+    @property
+    def replay_hash(self):
+        return self._replay_hash
+
+
+    @property
+    def beatmap_hash(self):
+        return self._beatmap_hash
+
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+
+    @property
+    def number_300s(self):
+        return self._number_300s
+
+
+    @property
+    def number_100s(self):
+        return self._number_100s
+
+
+    @property
+    def number_50s(self):
+        return self._number_50s
+
+
+    @property
+    def misses(self):
+        return self._misses
+
+
+    @property
+    def replay_file(self):
+        return self._replay_file
+
+
+class Judgements():
+    """
+    Represents the judgement of every hit object of a replay as columns.
+
+    Frame indices are -1 and hit errors are NaN where a hit object was not associated.
+    Scores are 300, 100, 50, or 0 for a miss.
+    """
+
+    __slots__ = ('_judgeable', '_true_frames', '_raw_frames', '_true_errors', '_raw_errors',
+                 '_on_note', '_true_scores', '_raw_scores')
+
+
+    def __init__(self, judgeable, true_frames, raw_frames, true_errors, raw_errors,
+                 on_note, true_scores, raw_scores):
+        self._judgeable = judgeable
+        self._true_frames = true_frames
+        self._raw_frames = raw_frames
+        self._true_errors = true_errors
+        self._raw_errors = raw_errors
+        self._on_note = on_note
+        self._true_scores = true_scores
+        self._raw_scores = raw_scores
+
+
+    def __len__(self):
+        return len(self._judgeable)
+
+
+    @property
+    def judgeable(self):
+        return self._judgeable
+
+
+    @property
+    def true_frames(self):
+        return self._true_frames
+
+
+    @property
+    def raw_frames(self):
+        return self._raw_frames
+
+
+    @property
+    def true_errors(self):
+        return self._true_errors
+
+
+    @property
+    def raw_errors(self):
+        return self._raw_errors
+
+
+    @property
+    def on_note(self):
+        return self._on_note
+
+
+    @property
+    def true_scores(self):
+        return self._true_scores
+
+
+    @property
+    def raw_scores(self):
+        return self._raw_scores
+
+
+class HitErrorStats():
+    """
+    Accumulates hit error statistics in a single pass, in constant memory.
+
+    The overall mean and variance use Welford's online algorithm.
+    Percentiles of absolute hit errors are read off a histogram of 1 ms bins,
+    each error counted in the bin of its nearest whole ms,
+    and the last bin also counting every error beyond it.
+    """
+
+    __slots__ = ('_num_pos', '_min_pos', '_max_pos', '_sum_pos',
+                 '_num_neg', '_min_neg', '_max_neg', '_sum_neg',
+                 '_min_abs', '_max_abs', '_sum_abs',
+                 '_count', '_mean', '_m2', '_histogram')
+
+    # The widest possible 50 hit window, at OD 0, is 200 ms
+    HISTOGRAM_BINS = 201
+
+
+    def __init__(self):
+        self._num_pos = 0
+        self._min_pos = None
+        self._max_pos = None
+        self._sum_pos = 0.0
+
+        self._num_neg = 0
+        self._min_neg = None
+        self._max_neg = None
+        self._sum_neg = 0.0
+
+        self._min_abs = None
+        self._max_abs = None
+        self._sum_abs = 0.0
+
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+        self._histogram = [0] * self.HISTOGRAM_BINS
+
+
+    def add(self, hit_error):
+        """
+        Adds a single hit error, in ms.
+        """
+
+        if hit_error > 0:
+            self._num_pos += 1
+            self._sum_pos += hit_error
+            if self._min_pos is None or hit_error < self._min_pos:
+                self._min_pos = hit_error
+            if self._max_pos is None or hit_error > self._max_pos:
+                self._max_pos = hit_error
+        elif hit_error < 0:
+            self._num_neg += 1
+            self._sum_neg += hit_error
+            if self._min_neg is None or hit_error < self._min_neg:
+                self._min_neg = hit_error
+            if self._max_neg is None or hit_error > self._max_neg:
+                self._max_neg = hit_error
+
+        abs_error = abs(hit_error)
+        self._sum_abs += abs_error
+        if self._min_abs is None or abs_error < self._min_abs:
+            self._min_abs = abs_error
+        if self._max_abs is None or abs_error > self._max_abs:
+            self._max_abs = abs_error
+
+        self._count += 1
+        delta = hit_error - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (hit_error - self._mean)
+
+        self._histogram[min(int(abs_error + 0.5), self.HISTOGRAM_BINS - 1)] += 1
+
+
+    def update(self, hit_errors):
+        """
+        Adds every hit error of an iterable.
+        """
+
+        for hit_error in hit_errors:
+            self.add(hit_error)
+
+
+    @property
+    def count(self):
+        return self._count
+
+
+    @property
+    def num_pos(self):
+        return self._num_pos
+
+
+    @property
+    def min_pos(self):
+        return self._min_pos
+
+
+    @property
+    def max_pos(self):
+        return self._max_pos
+
+
+    @property
+    def avg_pos(self):
+        return self._sum_pos / self._num_pos if self._num_pos else None
+
+
+    @property
+    def num_neg(self):
+        return self._num_neg
+
+
+    @property
+    def min_neg(self):
+        return self._min_neg
+
+
+    @property
+    def max_neg(self):
+        return self._max_neg
+
+
+    @property
+    def avg_neg(self):
+        return self._sum_neg / self._num_neg if self._num_neg else None
+
+
+    @property
+    def min_abs(self):
+        return self._min_abs
+
+
+    @property
+    def max_abs(self):
+        return self._max_abs
+
+
+    @property
+    def avg_abs(self):
+        return self._sum_abs / self._count if self._count else None
+
+
+    @property
+    def mean(self):
+        return self._mean if self._count else None
+
+
+    @property
+    def std(self):
+        """
+        The population standard deviation of the hit errors.
+        """
+
+        return sqrt(self._m2 / self._count) if self._count else None
+
+
+    @property
+    def unstable_rate(self):
+        """
+        The unstable rate, as shown in game: ten times the standard deviation.
+        """
+
+        std = self.std
+        return 10 * std if std is not None else None
+
+
+    def percentile(self, q):
+        """
+        Returns the q-th percentile of the absolute hit errors, rounded to the nearest ms.
+
+        Args:
+            q (float): The percentile, ranging from 0 to 100.
+        """
+
+        if not self._count:
+            return None
+
+        target = max(1, ceil(q / 100 * self._count))
+        cumulative = 0
+
+        for abs_error, num_errors in enumerate(self._histogram):
+            cumulative += num_errors
+            if cumulative >= target:
+                return float(abs_error)
+
+        return float(self.HISTOGRAM_BINS - 1)
@@ -2,26 +2,130 @@
 A module that contains handler functions, typically called from a view.
 """
 
-from secrets import OSU_API_KEY
+import logging
+from datetime import timedelta
 
-import requests
-import osrparse as osrp
+from django.conf import settings
+from django.core.cache import cache
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
 
-from osu_acc.replay.models import Replay
-from osu_acc.beatmap.models import Beatmap
+from osu_acc import locks
+from osu_acc import osu_api
+from osu_acc.replay import osr
+from osu_acc.replay import util
+from osu_acc.replay.models import IngestJob, Replay
 import osu_acc.replay.query as query
 
 # =============================================================================
 # CONSTANTS
 # =============================================================================
 
-OSU_API_ENDPOINT = 'https://osu.ppy.sh/api/get_beatmaps'
+# Cache key of the reason a beatmap hash was rejected
+REJECTED_BEATMAP_KEY = 'rejected-beatmap:{h}'
+
+# Lock key of the resolution of a beatmap hash
+BEATMAP_LOCK_KEY = 'beatmap:{h}'
+
+# Error recorded on, and shown for, a job that failed unexpectedly.
+# The details are logged instead, as they may expose internals.
+INGEST_ERROR = 'An unexpected error occurred'
+
+# Cache key of a replay's analytics context, by analysis version
+REPLAY_CONTEXT_KEY = 'replay-context:{r}:{v}'
+
+# Fields shown on the analytics page
+BEATMAP_CONTEXT_FIELDS = (
+    'song_artist',
+    'song_title',
+    'beatmap_id',
+    'beatmap_creator',
+    'beatmap_cs',
+    'beatmap_od',
+)
+
+REPLAY_CONTEXT_FIELDS = (
+    'play_date',
+    'analyzed_at',
+    'raw_accuracy',
+    'num_raw_300',
+    'num_raw_100',
+    'num_raw_50',
+    'num_raw_miss',
+    'true_accuracy',
+    'num_true_300',
+    'num_true_100',
+    'num_true_50',
+    'num_true_miss',
+    'num_slider_ticks',
+    'num_slider_ticks_held',
+    'num_pos_hit_error',
+    'num_neg_hit_error',
+    'min_neg_hit_error',
+    'max_neg_hit_error',
+    'avg_neg_hit_error',
+    'min_pos_hit_error',
+    'max_pos_hit_error',
+    'avg_pos_hit_error',
+    'min_abs_hit_error',
+    'max_abs_hit_error',
+    'avg_abs_hit_error',
+    'std_hit_error',
+    'unstable_rate',
+    'p50_abs_hit_error',
+    'p90_abs_hit_error',
+    'p99_abs_hit_error',
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class RejectedReplay(Exception):
+    """
+    Raised when an uploaded replay cannot be stored.
+    """
+    pass
+
+
+def get_replay_context_key(replay_id):
+    """
+    Returns the cache key of a replay's context.
+    """
+    return REPLAY_CONTEXT_KEY.format(r=replay_id, v=settings.OSU_ACC_ANALYSIS_VERSION)
+
+
+def get_replay_etag(ctx):
+    """
+    Returns the strong ETag of a replay's analytics page, given its context.
+
+    Replays are keyed by their content hash, so only a reanalysis can change the page
+    of a replay. Reanalysis stores a new analyzed_at and evicts the cached context,
+    so the ETag changes with it, whether or not the analysis version was bumped.
+    """
+    analyzed_at = ctx['analyzed_at']
+    analyzed = analyzed_at.strftime('%Y%m%d%H%M%S%f') if analyzed_at else '0'
+
+    return '"{r}-{v}-{a}"'.format(r=ctx['replay_id'], v=settings.OSU_ACC_ANALYSIS_VERSION,
+                                  a=analyzed)
+
+
+def get_replay_last_modified(ctx):
+    """
+    Returns when a replay was last analyzed, given its context,
+    or None for replays analyzed before it was stored.
+    """
+    return ctx['analyzed_at']
 
 
 def get_replay_context(replay_id):
     """
     Returns all the context variables to pass to template given a replay ID.
 
+    Contexts are cached for OSU_ACC_REPLAY_CONTEXT_TTL seconds,
+    so repeat views of a replay do not touch the DB.
+
     Args:
         replay_id (str): The replay ID.
 
@@ -29,83 +133,284 @@ def get_replay_context(replay_id):
         ctx (dict): The context.
     """
 
-    replay = Replay.objects.get(replay_id=replay_id)
+    cache_key = get_replay_context_key(replay_id)
+    ctx = cache.get(cache_key)
+
+    if ctx is not None:
+        return ctx
+
+    # Only load the fields shown, leaving out the large hit_errors array
+    replay = get_object_or_404(
+        Replay.objects
+        .select_related('beatmap')
+        .only(*REPLAY_CONTEXT_FIELDS,
+              *('beatmap__' + field for field in BEATMAP_CONTEXT_FIELDS)),
+        replay_id=replay_id,
+    )
 
     ctx = {}
 
     ctx['replay_id'] = replay_id
-    ctx['play_date'] = replay.play_date
 
-    ctx['song_artist'] = replay.beatmap.song_artist
-    ctx['song_title'] = replay.beatmap.song_title
+    for field in BEATMAP_CONTEXT_FIELDS:
+        ctx[field] = getattr(replay.beatmap, field)
 
-    ctx['beatmap_id'] = replay.beatmap.beatmap_id
-    ctx['beatmap_creator'] = replay.beatmap.beatmap_creator
-    ctx['beatmap_cs'] = replay.beatmap.beatmap_cs
-    ctx['beatmap_od'] = replay.beatmap.beatmap_od
+    for field in REPLAY_CONTEXT_FIELDS:
+        ctx[field] = getattr(replay, field)
 
-    ctx['raw_accuracy'] = replay.raw_accuracy
-    ctx['num_raw_300'] = replay.num_raw_300
-    ctx['num_raw_100'] = replay.num_raw_100
-    ctx['num_raw_50'] = replay.num_raw_50
-    ctx['num_raw_miss'] = replay.num_raw_miss
+    cache.set(cache_key, ctx, settings.OSU_ACC_REPLAY_CONTEXT_TTL)
 
-    ctx['true_accuracy'] = replay.true_accuracy
-    ctx['num_true_300'] = replay.num_true_300
-    ctx['num_true_100'] = replay.num_true_100
-    ctx['num_true_50'] = replay.num_true_50
-    ctx['num_true_miss'] = replay.num_true_miss
+    return ctx
 
-    ctx['num_pos_hit_error'] = replay.num_pos_hit_error
-    ctx['num_neg_hit_error'] = replay.num_neg_hit_error
 
-    ctx['min_neg_hit_error'] = replay.min_neg_hit_error
-    ctx['max_neg_hit_error'] = replay.max_neg_hit_error
-    ctx['avg_neg_hit_error'] = replay.avg_neg_hit_error
+def get_beatmap_metadata(beatmap_hash):
+    """
+    Requests a beatmap's metadata from osu!api.
 
-    ctx['min_pos_hit_error'] = replay.min_pos_hit_error
-    ctx['max_pos_hit_error'] = replay.max_pos_hit_error
-    ctx['avg_pos_hit_error'] = replay.avg_pos_hit_error
+    Args:
+        beatmap_hash (str): The MD5 hash of the beatmap file.
+
+    Returns:
+        json_resp (dict): The beatmap's metadata, or None if osu!api does not know it.
+    """
+    # Returns a JSON list with one element containing our beatmap info
+    beatmaps = osu_api.get_beatmaps(beatmap_hash)
 
-    ctx['min_abs_hit_error'] = replay.min_abs_hit_error
-    ctx['max_abs_hit_error'] = replay.max_abs_hit_error
-    ctx['avg_abs_hit_error'] = replay.avg_abs_hit_error
+    if not beatmaps:
+        return None
 
-    return ctx
+    return beatmaps[0]
+
+
+def is_beatmap_too_long(json_resp):
+    """
+    Returns True if a beatmap is too long for its replays to be stored.
+
+    Times are stored with up to 9 digits, so anything longer than
+    999,999.99ms (16m 40s) is rejected.
+
+    Args:
+        json_resp (dict): The beatmap's metadata from osu!api.
+    """
+    return int(json_resp['total_length']) >= 1000
+
+
+def resolve_beatmap(beatmap_hash):
+    """
+    Returns the beatmap of a replay, creating it from osu!api if it is not stored yet.
+
+    Stored beatmaps are found by their file hash without calling osu!api.
+    Hashes osu!api rejected are remembered for OSU_ACC_REJECTED_BEATMAP_TTL seconds,
+    so they are not requested again either. A beatmap stored under the hash of
+    an earlier version of its file is updated to the version osu!api serves.
+
+    Args:
+        beatmap_hash (str): The MD5 hash of the beatmap file.
+
+    Returns:
+        beatmap (Beatmap): The beatmap, with its related models loaded.
+
+    Raises:
+        RejectedReplay: If the beatmap is unknown to osu!api or too long.
+    """
+    beatmap = query.select_beatmap_by_md5(beatmap_hash)
+
+    if beatmap is not None:
+        return beatmap
+
+    cache_key = REJECTED_BEATMAP_KEY.format(h=beatmap_hash)
+    reason = cache.get(cache_key)
+
+    if reason is not None:
+        raise RejectedReplay(reason)
+
+    # Concurrent uploads of a new beatmap wait here for the first one to resolve it
+    with locks.single_flight(BEATMAP_LOCK_KEY.format(h=beatmap_hash)):
+        beatmap = query.select_beatmap_by_md5(beatmap_hash)
+
+        if beatmap is not None:
+            return beatmap
+
+        reason = cache.get(cache_key)
 
+        if reason is not None:
+            raise RejectedReplay(reason)
 
-def handle_replay(replay):
+        # Make a call to osu!api to request beatmap metadata
+        json_resp = get_beatmap_metadata(beatmap_hash)
+
+        if json_resp is None:
+            reason = 'Unknown beatmap'
+        elif is_beatmap_too_long(json_resp):
+            reason = 'Beatmap is longer than 16:40'
+
+        if reason is not None:
+            cache.set(cache_key, reason, settings.OSU_ACC_REJECTED_BEATMAP_TTL)
+            raise RejectedReplay(reason)
+
+        beatmap = query.select_beatmap_by_id(json_resp['beatmap_id'])
+
+        # If there a Beatmap model of this Replay's beatmap does not exist, create it
+        if beatmap is None:
+            return query.get_or_create_beatmap_entry(json_resp)
+
+        if beatmap.beatmap_md5 is None:
+            query.set_beatmap_md5(json_resp['beatmap_id'], beatmap_hash)
+        elif beatmap.beatmap_md5 != beatmap_hash:
+            # The beatmap was updated since it was stored, so replays
+            # of the version osu!api now serves are judged against it
+            logger.warning('Beatmap %s was updated, replacing version %s with %s',
+                           json_resp['beatmap_id'], beatmap.beatmap_md5, beatmap_hash)
+            return query.update_beatmap_entry(json_resp)
+
+        return beatmap
+
+
+def ingest_replay(replay_file):
     """
-    Given an uploaded osu! replay file, retrieve the data
+    Given the contents of an osu! replay file, retrieve the data
     necessary to create a Replay model and write it to DB.
 
     Args:
-        replay: A replay file.
+        replay_file (bytes): The contents of the replay file.
 
     Returns:
-        Nothing.
+        (str): The replay ID.
+
+    Raises:
+        RejectedReplay: If the replay cannot be stored.
     """
-    # Parse the local replay file and extract data
-    parsed_replay = osrp.parse_replay_file(replay.temporary_file_path())
-    beatmap_hash  = parsed_replay.beatmap_hash
+    # Only the header is read until the replay is known to be worth decoding
+    try:
+        header = osr.read_header(replay_file)
+    except osr.InvalidReplay:
+        raise RejectedReplay('Not a valid replay file')
 
-    # Make a call to osu!api to request beatmap metadata
-    payload  = {'k': OSU_API_KEY, 'h': beatmap_hash}
-    response = requests.get(OSU_API_ENDPOINT, payload)
+    if header.game_mode != osr.STANDARD:
+        raise RejectedReplay('Only osu!standard replays are supported')
+
+    if query.replay_exists(header.replay_hash):
+        return header.replay_hash
+
+    try:
+        beatmap = resolve_beatmap(header.beatmap_hash)
+    except RejectedReplay as e:
+        logger.warning('Rejected replay %s of beatmap %s: %s',
+                       header.replay_hash, header.beatmap_hash, e)
+        raise
+
+    try:
+        replay_events = util.convert_replay_file_to_frames(replay_file, header)
+    except osr.InvalidReplay:
+        raise RejectedReplay('Not a valid replay file')
+
+    query.create_replay_entry(beatmap, header, replay_events, replay_file)
+
+    return header.replay_hash
 
-    # Returns a JSON list with one element containing our beatmap info
-    json_resp = response.json()[0]
 
-    # If the song is longer than 999,999.99ms (16m 40s), reject
-    if int(json_resp['total_length']) >= 1000:
-        # TODO: Write a proper exception for this.
-        print('Do not replays of maps longer than 16:40.')
-        return
+# =============================================================================
+# INGEST JOBS
+# =============================================================================
+
+def get_stored_replay_id(replay_file):
+    """
+    Given the contents of an osu! replay file, check whether it is already stored.
 
-    # If there a Beatmap model of this Replay's beatmap does not exist, create it
-    if not Beatmap.objects.filter(beatmap_id=json_resp['beatmap_id']).exists():
-        query.create_beatmap_entry(json_resp)
-    
-    query.create_replay_entry(json_resp, parsed_replay)
+    Only the header is read, so a re-upload costs a single primary key lookup.
 
-    return parsed_replay.replay_hash
+    Args:
+        replay_file (bytes): The contents of the replay file.
+
+    Returns:
+        (str): The replay ID, or None if the replay is not stored
+        or the file is not a valid replay.
+    """
+    try:
+        header = osr.read_header(replay_file)
+    except osr.InvalidReplay:
+        # Left for the ingest job to reject
+        return None
+
+    if not query.replay_exists(header.replay_hash):
+        return None
+
+    return header.replay_hash
+
+
+def enqueue_replay(replay_file):
+    """
+    Given the contents of an osu! replay file, queue it to be ingested by a worker.
+
+    Args:
+        replay_file (bytes): The contents of the replay file.
+
+    Returns:
+        (int): The ID of the ingest job.
+    """
+    return query.create_ingest_job(replay_file).id
+
+
+def process_ingest_job(job):
+    """
+    Ingests the replay of a claimed job, and records the outcome on the job.
+
+    Rejected replays fail right away. Other errors are retried with exponential
+    backoff until the job has been attempted OSU_ACC_INGEST_MAX_ATTEMPTS times.
+
+    Args:
+        job (IngestJob): A job claimed with query.claim_ingest_job().
+    """
+    try:
+        replay_id = ingest_replay(bytes(job.replay_file))
+    except RejectedReplay as e:
+        job.status = IngestJob.FAILED
+        job.error = str(e)
+    except Exception:
+        logger.exception('Ingest job %d failed on attempt %d', job.id, job.attempts)
+        job.error = INGEST_ERROR
+
+        if job.attempts >= settings.OSU_ACC_INGEST_MAX_ATTEMPTS:
+            job.status = IngestJob.FAILED
+        else:
+            delay = settings.OSU_ACC_INGEST_RETRY_DELAY * 2 ** (job.attempts - 1)
+            job.status = IngestJob.QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+    else:
+        job.status = IngestJob.DONE
+        job.replay_id = replay_id
+        job.error = ''
+
+        # The replay file is stored on the replay from here on
+        job.replay_file = b''
+
+    job.save()
+
+
+def get_job_context(job_id):
+    """
+    Returns the status of an ingest job, as served by the job status endpoint.
+
+    Args:
+        job_id (int): The ID of the ingest job.
+
+    Returns:
+        ctx (dict): The context.
+    """
+
+    job = get_object_or_404(IngestJob.objects.defer('replay_file'), id=job_id)
+
+    ctx = {}
+
+    ctx['job_id'] = job.id
+    ctx['status'] = job.status
+    ctx['attempts'] = job.attempts
+    ctx['max_attempts'] = settings.OSU_ACC_INGEST_MAX_ATTEMPTS
+    ctx['error'] = job.error or None
+    ctx['replay_id'] = job.replay_id or None
+    ctx['replay_url'] = None
+
+    if job.status == IngestJob.DONE:
+        ctx['replay_url'] = reverse('replay-analytics', args=[job.replay_id])
+
+    return ctx
@@ -0,0 +1,274 @@
+"""
+A module to import replay files in bulk.
+
+Replays are read from a directory or a zip archive, and their headers parsed,
+in a pool of worker processes. Each replay file is then sent as is to a worker
+that decodes its frames and analyzes it, and replays are written in batches
+with bulk_create().
+Each beatmap is resolved once per import, however many of its replays
+are imported, and only beatmaps not stored yet are requested from osu!api.
+"""
+
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import transaction
+from django.utils import timezone
+
+from osu_acc.replay import classes
+from osu_acc.replay import handlers
+from osu_acc.replay import osr
+from osu_acc.replay import query
+from osu_acc.replay import util
+from osu_acc.replay.models import Replay
+
+
+logger = logging.getLogger(__name__)
+
+REPLAY_EXTENSION = '.osr'
+
+
+# =============================================================================
+# WORKER METHODS
+# =============================================================================
+
+
+def find_replay_files(path):
+    """
+    Lists every replay file in a directory, searched recursively, or in a zip archive.
+
+    Args:
+        path (str): The path of the directory or zip archive.
+
+    Returns:
+        sources (List(tuple)): An (archive, name) pair for every replay file.
+        archive is None for a directory, name is then the path of the file.
+    """
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+
+        return [(path, name) for name in sorted(names)
+                if name.lower().endswith(REPLAY_EXTENSION)]
+
+    if not os.path.isdir(path):
+        raise ValueError('{p} is neither a directory nor a zip archive'.format(p=path))
+
+    sources = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.lower().endswith(REPLAY_EXTENSION):
+                sources.append((None, os.path.join(root, name)))
+
+    return sorted(sources)
+
+
+def read_replay_file(source):
+    """
+    Returns the contents of a replay file, as listed by find_replay_files().
+    """
+
+    archive, name = source
+
+    if archive is None:
+        with open(name, 'rb') as f:
+            return f.read()
+
+    with zipfile.ZipFile(archive) as zf:
+        return zf.read(name)
+
+
+def parse_replay(source):
+    """
+    Reads a single replay file and parses its header.
+
+    Runs in a worker process, so it only takes and returns picklable data.
+    Frames are left to util.analyze_beatmap_replays(), so they are only decoded
+    once, in the worker that analyzes them.
+
+    Args:
+        source (tuple): The replay file, as listed by find_replay_files().
+
+    Returns:
+        (classes.ParsedReplay): The parsed replay, or None if it is not
+        an osu!standard replay or cannot be read or parsed.
+    """
+
+    try:
+        replay_file = read_replay_file(source)
+        header = osr.read_header(replay_file)
+    except (OSError, zipfile.BadZipFile, osr.InvalidReplay) as e:
+        logger.warning('Could not read replay file %s: %s', source[1], e)
+        return None
+
+    if header.game_mode != osr.STANDARD:
+        return None
+
+    return classes.ParsedReplay(
+        header.replay_hash,
+        header.beatmap_hash,
+        header.timestamp,
+        header.number_300s,
+        header.number_100s,
+        header.number_50s,
+        header.misses,
+        replay_file,
+    )
+
+
+# =============================================================================
+# IMPORT METHODS
+# =============================================================================
+
+
+def resolve_beatmap(beatmap_hash):
+    """
+    Returns the beatmap of a replay, as handlers.resolve_beatmap() does,
+    or None if replays of it are rejected.
+    """
+
+    try:
+        return handlers.resolve_beatmap(beatmap_hash)
+    except handlers.RejectedReplay:
+        return None
+
+
+def write_replays(parsed_replays, beatmaps, results):
+    """
+    Writes a batch of analyzed replays in a single transaction.
+
+    Args:
+        parsed_replays (List(classes.ParsedReplay)): The replays.
+        beatmaps (dict): The Beatmap of every beatmap hash.
+        results (dict): The analysis fields of every replay hash.
+
+    Returns:
+        (int): The number of replays written. Replays stored by a concurrent
+        import or ingest worker in the meantime are skipped, and not counted.
+    """
+
+    replay_entries = []
+
+    # Every replay of the batch is stamped with the same analyzed_at,
+    # so the rows this batch inserted can be told from those it skipped
+    written_at = timezone.now()
+
+    # Frames are not stored, see query.get_replay_data()
+    for parsed_replay in parsed_replays:
+        beatmap = beatmaps[parsed_replay.beatmap_hash]
+        replay_fields = query.get_replay_header_fields(parsed_replay, beatmap)
+        replay_fields = {**replay_fields, **results[parsed_replay.replay_hash]}
+        replay_fields['replay_file'] = parsed_replay.replay_file
+        replay_fields['analyzed_at'] = written_at
+        replay_entries.append(Replay(**replay_fields))
+
+    with transaction.atomic():
+        Replay.objects.bulk_create(replay_entries, ignore_conflicts=True)
+
+        return (Replay.objects
+                .filter(replay_id__in=[r.replay_hash for r in parsed_replays],
+                        analyzed_at=written_at)
+                .count())
+
+
+def import_replays(path, workers=None, batch_size=500, progress=None):
+    """
+    Imports every replay file in a directory or zip archive.
+
+    Replays already stored, of unknown beatmaps, of other game modes
+    or that cannot be parsed are skipped.
+
+    Args:
+        path (str): The path of the directory or zip archive.
+        workers (int): The number of worker processes, defaults to the number of CPUs.
+        batch_size (int): The number of replays parsed and written at once.
+        progress (callable): Called with the running counts after every batch.
+
+    Returns:
+        counts (dict): The number of replays imported, skipped,
+        and the time elapsed in seconds.
+    """
+
+    sources = find_replay_files(path)
+
+    # Beatmaps are resolved once per import, None for those rejected
+    beatmaps = {}
+    beatmap_columns = {}
+    seen = set()
+
+    counts = {
+        'found': len(sources),
+        'imported': 0,
+        'duplicate': 0,
+        'unparsable': 0,
+        'rejected': 0,
+        'elapsed': 0.0,
+    }
+    started = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch_start in range(0, len(sources), batch_size):
+            batch_sources = sources[batch_start:batch_start + batch_size]
+            batch = []
+
+            for parsed_replay in executor.map(parse_replay, batch_sources):
+                if parsed_replay is None:
+                    counts['unparsable'] += 1
+                elif parsed_replay.replay_hash in seen:
+                    counts['duplicate'] += 1
+                else:
+                    seen.add(parsed_replay.replay_hash)
+                    batch.append(parsed_replay)
+
+            stored = set(Replay.objects
+                         .filter(replay_id__in=[r.replay_hash for r in batch])
+                         .values_list('replay_id', flat=True))
+            counts['duplicate'] += len(stored)
+            batch = [r for r in batch if r.replay_hash not in stored]
+
+            for beatmap_hash in {r.beatmap_hash for r in batch} - beatmaps.keys():
+                beatmap = resolve_beatmap(beatmap_hash)
+                beatmaps[beatmap_hash] = beatmap
+                if beatmap is not None:
+                    beatmap_columns[beatmap_hash] = query.get_beatmap_columns(beatmap)
+
+            accepted = [r for r in batch if beatmaps[r.beatmap_hash] is not None]
+            counts['rejected'] += len(batch) - len(accepted)
+
+            # Group the batch by beatmap, so each beatmap is sent to a worker once.
+            # Replay files are sent as is, and decoded by the worker analyzing them.
+            tasks = {}
+            for parsed_replay in accepted:
+                tasks.setdefault(parsed_replay.beatmap_hash, []).append(
+                    (parsed_replay.replay_hash, parsed_replay.replay_file))
+
+            work = [(beatmap_columns[beatmap_hash], replays)
+                    for beatmap_hash, replays in tasks.items()]
+            results = {}
+            for batch_results in executor.map(util.analyze_beatmap_replays, work):
+                results.update(batch_results)
+
+            # Replays whose frames cannot be decoded have no results
+            analyzed = [r for r in accepted if r.replay_hash in results]
+            counts['unparsable'] += len(accepted) - len(analyzed)
+
+            if analyzed:
+                written = write_replays(analyzed, beatmaps, results)
+                counts['imported'] += written
+                counts['duplicate'] += len(analyzed) - written
+
+            counts['elapsed'] = time.perf_counter() - started
+
+            logger.info('Imported %d/%d replays in %.1fs',
+                        counts['imported'], counts['found'], counts['elapsed'])
+
+            if progress is not None:
+                progress(counts)
+
+    counts['elapsed'] = time.perf_counter() - started
+
+    return counts
@@ -0,0 +1,57 @@
+"""
+A management command to import a directory or zip archive of replay files.
+
+Usage: python manage.py import_replays PATH [--workers N] [--batch-size N]
+"""
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from osu_acc import osu_api
+from osu_acc.replay import importer
+
+
+class Command(BaseCommand):
+    help = 'Imports every .osr replay file in a directory or zip archive.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+                            help='Directory, searched recursively, or zip archive of replays.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of replays parsed and written at once.')
+
+
+    def handle(self, *args, **options):
+        try:
+            counts = importer.import_replays(options['path'],
+                                             workers=options['workers'],
+                                             batch_size=options['batch_size'],
+                                             progress=self.write_progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {n} of {f} replays in {t:.1f}s ({r:.1f} replays/s), '
+            'skipped {d} duplicate, {u} unparsable, {x} of rejected beatmaps'.format(
+                n=counts['imported'], f=counts['found'], t=counts['elapsed'],
+                r=self.get_rate(counts), d=counts['duplicate'],
+                u=counts['unparsable'], x=counts['rejected'])))
+
+        for endpoint, metrics in sorted(osu_api.get_metrics().items()):
+            self.stdout.write('{e}: {n} requests, {x} failed, avg {a:.1f}ms, max {m:.1f}ms'.format(
+                e=endpoint, n=metrics.num_requests, x=metrics.num_errors,
+                a=metrics.avg_seconds * 1000, m=metrics.max_seconds * 1000))
+
+
+    def write_progress(self, counts):
+        self.stdout.write('{n} replays imported, {r:.1f} replays/s'.format(
+            n=counts['imported'], r=self.get_rate(counts)))
+
+
+    @staticmethod
+    def get_rate(counts):
+        return counts['imported'] / counts['elapsed'] if counts['elapsed'] else 0
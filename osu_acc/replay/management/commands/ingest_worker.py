@@ -0,0 +1,53 @@
+"""
+A management command to run a worker ingesting uploaded replays.
+
+Usage: python manage.py ingest_worker [--once] [--poll-interval SECONDS]
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from osu_acc.replay import handlers
+from osu_acc.replay import query
+
+
+class Command(BaseCommand):
+    help = 'Processes queued replay uploads. Run as many workers as needed.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no job is due, instead of polling for more.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before polling again when no job is due.')
+
+
+    def handle(self, *args, **options):
+        num_done = 0
+
+        try:
+            while True:
+                # As Django does around every request, so a long-running worker
+                # drops connections past CONN_MAX_AGE or left broken by an error
+                close_old_connections()
+
+                job = query.claim_ingest_job(settings.OSU_ACC_INGEST_STALE_AFTER)
+
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                handlers.process_ingest_job(job)
+                num_done += 1
+
+                self.stdout.write('Job {j} {s} after {a} attempt(s)'.format(
+                    j=job.id, s=job.status, a=job.attempts))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS('Processed {n} jobs'.format(n=num_done)))
@@ -0,0 +1,202 @@
+"""
+A management command to recompute the analysis of stored replays.
+
+Usage: python manage.py reanalyze [--beatmap ID ...] [--since DATE] [--until DATE]
+                                  [--chunk-size N] [--workers N] [--progress-file PATH]
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import cache
+from django.db import transaction
+
+from osu_acc.beatmap.models import Beatmap
+from osu_acc.replay import handlers
+from osu_acc.replay import query
+from osu_acc.replay import util
+from osu_acc.replay.models import Replay
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the accuracy and hit error fields of stored replays.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--beatmap', action='append', dest='beatmap_ids', default=[],
+                            help='Only reanalyze replays of this beatmap ID. Can be repeated.')
+        parser.add_argument('--since', type=self.parse_date,
+                            help='Only reanalyze replays played on or after this date (YYYY-MM-DD).')
+        parser.add_argument('--until', type=self.parse_date,
+                            help='Only reanalyze replays played on or before this date (YYYY-MM-DD).')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of replays loaded and written back at once.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes.')
+        parser.add_argument('--progress-file',
+                            help='File recording the last replay reanalyzed. '
+                                 'If it exists, reanalysis resumes after that replay.')
+
+
+    @staticmethod
+    def parse_date(value):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError('Invalid date {d}, expected YYYY-MM-DD'.format(d=value))
+
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        progress_file = options['progress_file']
+
+        replays = Replay.objects.select_related('replay_data').order_by('replay_id')
+
+        if options['beatmap_ids']:
+            replays = replays.filter(beatmap_id__in=options['beatmap_ids'])
+        if options['since']:
+            replays = replays.filter(play_date__date__gte=options['since'])
+        if options['until']:
+            replays = replays.filter(play_date__date__lte=options['until'])
+
+        last_replay_id = self.read_progress(progress_file)
+        if last_replay_id:
+            self.stdout.write('Resuming after replay {r}'.format(r=last_replay_id))
+
+        # Beatmap columns are built once and shared by every chunk
+        beatmap_cache = {}
+
+        num_done = 0
+        num_skipped = 0
+        started = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                chunk = replays
+                if last_replay_id:
+                    chunk = chunk.filter(replay_id__gt=last_replay_id)
+                chunk = list(chunk[:chunk_size])
+
+                if not chunk:
+                    break
+
+                self.load_beatmaps(beatmap_cache, {replay.beatmap_id for replay in chunk})
+
+                # Group the chunk by beatmap, so each beatmap is sent to a worker once
+                tasks = {}
+                for replay in chunk:
+                    frames = self.get_replay_source(replay)
+
+                    if frames is None:
+                        num_skipped += 1
+                        continue
+
+                    tasks.setdefault(replay.beatmap_id, []).append((replay.replay_id, frames))
+
+                work = [(beatmap_cache[beatmap_id], batch) for beatmap_id, batch in tasks.items()]
+                results = {}
+                for batch_results in executor.map(util.analyze_beatmap_replays, work):
+                    results.update(batch_results)
+
+                self.write_results(chunk, results)
+
+                # Replays whose replay file could not be decoded are left out of the results
+                num_skipped += sum(len(batch) for batch in tasks.values()) - len(results)
+                num_done += len(results)
+                last_replay_id = chunk[-1].replay_id
+                self.write_progress(progress_file, last_replay_id)
+
+                elapsed = time.perf_counter() - started
+                self.stdout.write('{n} replays reanalyzed, {r:.1f} replays/s'.format(
+                    n=num_done, r=num_done / elapsed if elapsed else 0))
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            'Reanalyzed {n} replays in {t:.1f}s ({r:.1f} replays/s), skipped {s}'.format(
+                n=num_done, t=elapsed, r=num_done / elapsed if elapsed else 0, s=num_skipped)))
+
+
+    @staticmethod
+    def get_replay_source(replay):
+        """
+        Returns what a worker needs to analyze a replay, or None if it cannot be judged.
+
+        Replays stored with their replay file are sent as is, so that decoding
+        their frames happens in the workers. Older replays have their ReplayData.
+        """
+
+        if replay.replay_data_id is None:
+            return bytes(replay.replay_file)
+
+        frames = util.convert_replay_data_model_to_frames(replay.replay_data)
+
+        # Replays stored before key states were kept cannot be judged
+        if len(frames.keys) != len(frames.time):
+            return None
+
+        return frames
+
+
+    def load_beatmaps(self, beatmap_cache, beatmap_ids):
+        """
+        Builds the analysis columns of every beatmap in beatmap_ids not yet in beatmap_cache.
+        """
+
+        missing = beatmap_ids - beatmap_cache.keys()
+        beatmaps = (Beatmap.objects
+                    .select_related('break_period', 'hit_object', 'timeline')
+                    .filter(beatmap_id__in=missing))
+
+        for beatmap in beatmaps:
+            beatmap_cache[beatmap.beatmap_id] = query.get_beatmap_columns(beatmap)
+
+
+    @staticmethod
+    def write_results(chunk, results):
+        """
+        Writes the reanalyzed fields of a chunk back with a single batched bulk_update.
+        """
+
+        updated = []
+        fields = set()
+
+        for replay in chunk:
+            if replay.replay_id not in results:
+                continue
+
+            for field, value in results[replay.replay_id].items():
+                setattr(replay, field, value)
+                fields.add(field)
+
+            updated.append(replay)
+
+        if updated:
+            with transaction.atomic():
+                Replay.objects.bulk_update(updated, sorted(fields), batch_size=len(updated))
+
+            cache.delete_many([handlers.get_replay_context_key(replay.replay_id)
+                               for replay in updated])
+
+
+    @staticmethod
+    def read_progress(progress_file):
+        if not progress_file or not os.path.exists(progress_file):
+            return None
+
+        with open(progress_file, 'r') as f:
+            return f.read().strip() or None
+
+
+    @staticmethod
+    def write_progress(progress_file, last_replay_id):
+        if not progress_file:
+            return
+
+        # Write to a temporary file first, so an interrupted run never leaves it half written
+        temporary_file = progress_file + '.tmp'
+        with open(temporary_file, 'w') as f:
+            f.write(last_replay_id)
+        os.replace(temporary_file, progress_file)
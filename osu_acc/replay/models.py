@@ -1,26 +1,30 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField
 
 from osu_acc.beatmap.models import Beatmap
+from osu_acc.fields import PackedArrayField
 
 
 class ReplayData(models.Model):
     """
-    Represents a modified version of osrparse.Replay.play_data.
+    Represents the frames of a replay file.
     
     Modifications:
         * time counts the number of ms from the start of the map the event occurs.
-        * No key combination field.
+        * keys only holds the K1/K2/M1/M2 bitmask.
     """
     
     # Let Django automatically generate primary key
 
-    # Reference parent Replay
-    replay_id = models.CharField(max_length=64)
+    # Reference parent Replay, one per replay
+    replay_id = models.CharField(max_length=64, unique=True)
 
-    x_coords = ArrayField(models.DecimalField(max_digits=5, decimal_places=2))
-    y_coords = ArrayField(models.DecimalField(max_digits=5, decimal_places=2))
-    hit_object_times = ArrayField(models.DecimalField(max_digits=9, decimal_places=2))
+    # Packed arrays, loaded as NumPy arrays
+    x_coords = PackedArrayField(dtype='<f4', compress=True)
+    y_coords = PackedArrayField(dtype='<f4', compress=True)
+    hit_object_times = PackedArrayField(dtype='<i4', delta=True, compress=True)
+    keys = PackedArrayField(dtype='<i2', compress=True, default=list)
 
 
 class Replay(models.Model):
@@ -31,10 +35,18 @@ class Replay(models.Model):
     beatmap = models.ForeignKey(Beatmap, on_delete=models.CASCADE)
 
     # ONE-TO-ONE RELATIONS
-    replay_data = models.OneToOneField(ReplayData, on_delete=models.CASCADE)
+    # Null until the frames are first needed, see query.get_replay_data()
+    replay_data = models.OneToOneField(ReplayData, on_delete=models.CASCADE, null=True)
+
+    # The uploaded .osr file, its LZMA compressed frames included.
+    # Empty for replays ingested before it was stored, which always have replay_data.
+    replay_file = models.BinaryField(default=b'')
 
     play_date = models.DateTimeField()
 
+    # Null for replays analyzed before it was stored
+    analyzed_at = models.DateTimeField(null=True)
+
     # STANDARD DATA
     pp = models.DecimalField(max_digits=6, decimal_places=2)
     raw_accuracy = models.DecimalField(max_digits=4, decimal_places=2)
@@ -51,20 +63,77 @@ class Replay(models.Model):
     num_true_50 = models.PositiveSmallIntegerField()
     num_true_miss = models.PositiveSmallIntegerField()
 
+    # SLIDER DATA
+    # Null when the beatmap has no judgement timeline
+    num_slider_ticks = models.PositiveIntegerField(null=True)
+    num_slider_ticks_held = models.PositiveIntegerField(null=True)
+
     # HIT ERRORS
     hit_errors = ArrayField(models.DecimalField(max_digits=5, decimal_places=2))
 
     num_pos_hit_error = models.PositiveSmallIntegerField()
     num_neg_hit_error = models.PositiveSmallIntegerField()
 
-    min_neg_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
-    max_neg_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
-    avg_neg_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
+    # Null when there is no hit error to base the metric on
+    min_neg_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    max_neg_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    avg_neg_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+
+    min_pos_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    max_pos_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    avg_pos_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+
+    min_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    max_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    avg_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+
+    std_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    unstable_rate = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+
+    p50_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    p90_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    p99_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+
+
+class IngestJob(models.Model):
+    """
+    Represents an uploaded replay file waiting to be, or having been, ingested.
+
+    Jobs are claimed and processed by the ingest_worker management command.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # Let Django automatically generate primary key
+
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=QUEUED)
+
+    # The uploaded replay file, as is
+    replay_file = models.BinaryField()
+
+    # Set once the replay is ingested
+    replay_id = models.CharField(max_length=64, blank=True, default='')
+
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
-    min_pos_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
-    max_pos_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
-    avg_pos_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
+    # Failed attempts are retried no earlier than this
+    run_after = models.DateTimeField(default=timezone.now)
 
-    min_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
-    max_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
-    avg_abs_hit_error = models.DecimalField(max_digits=5, decimal_places=2)
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
@@ -0,0 +1,217 @@
+"""
+A module to read .osr replay files from memory.
+
+The header is read on its own, so a replay can be checked and looked up
+before its frames are decompressed. Frames are then decoded incrementally,
+a chunk of the LZMA stream at a time, straight into NumPy arrays.
+
+The file format is described at the following link.
+https://osu.ppy.sh/help/wiki/osu!_File_Formats/Osr_(file_format)
+"""
+
+import lzma
+import struct
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from osu_acc.replay import classes
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+STANDARD = 0
+
+# Time delta of the last frame, which stores the RNG seed rather than an input
+SEED_FRAME_DELTA = -12345
+
+# .NET ticks count 100ns intervals since this instant, in UTC
+TICKS_EPOCH = datetime(1, 1, 1, tzinfo=timezone.utc)
+
+# Size of the chunks of the LZMA stream decompressed at once
+CHUNK_SIZE = 64 * 1024
+
+GAME_MODE_AND_VERSION = struct.Struct('<bi')
+SCORE_STATS = struct.Struct('<hhhhhhihbi')
+TIMESTAMP_AND_LENGTH = struct.Struct('<qi')
+
+
+class InvalidReplay(ValueError):
+    """
+    Raised when a replay file cannot be read.
+    """
+    pass
+
+
+# =============================================================================
+# HEADER
+# =============================================================================
+
+
+def get_byte_view(data):
+    """
+    Returns data, bytes or any buffer, as a memoryview indexed by unsigned byte.
+
+    psycopg2 returns bytea columns as memoryviews of chars, whose items are bytes.
+    """
+
+    return memoryview(data).cast('B')
+
+
+def read_uleb128(data, offset):
+    """
+    Returns an unsigned LEB128 integer read at offset, and the offset past it.
+    """
+
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+
+        if not byte & 0x80:
+            return value, offset
+
+        shift += 7
+
+
+def read_string(data, offset):
+    """
+    Returns a string read at offset, and the offset past it.
+
+    Strings are either a single 0x00 byte, or 0x0b followed by
+    the ULEB128 encoded length and the UTF-8 encoded string.
+    """
+
+    if data[offset] == 0x00:
+        return '', offset + 1
+
+    length, offset = read_uleb128(data, offset + 1)
+    end = offset + length
+
+    return bytes(data[offset:end]).decode('utf-8'), end
+
+
+def read_header(data):
+    """
+    Reads the header of a replay file, without touching its frames.
+
+    Args:
+        data (bytes or memoryview): The contents of the replay file.
+
+    Returns:
+        (classes.ReplayHeader): The header.
+
+    Raises:
+        InvalidReplay: If the header is truncated or malformed.
+    """
+
+    data = get_byte_view(data)
+
+    try:
+        game_mode, game_version = GAME_MODE_AND_VERSION.unpack_from(data, 0)
+        offset = GAME_MODE_AND_VERSION.size
+
+        beatmap_hash, offset = read_string(data, offset)
+        player_name, offset = read_string(data, offset)
+        replay_hash, offset = read_string(data, offset)
+
+        (number_300s, number_100s, number_50s, gekis, katus, misses,
+         score, max_combo, _, mod_combination) = SCORE_STATS.unpack_from(data, offset)
+        offset += SCORE_STATS.size
+
+        # Life bar graph, unused
+        _, offset = read_string(data, offset)
+
+        ticks, frames_length = TIMESTAMP_AND_LENGTH.unpack_from(data, offset)
+        offset += TIMESTAMP_AND_LENGTH.size
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise InvalidReplay('Truncated or malformed replay header')
+
+    if offset + frames_length > len(data):
+        raise InvalidReplay('Truncated replay frames')
+
+    timestamp = TICKS_EPOCH + timedelta(microseconds=ticks // 10)
+
+    return classes.ReplayHeader(game_mode, game_version, beatmap_hash, player_name,
+                                replay_hash, number_300s, number_100s, number_50s,
+                                gekis, katus, misses, score, max_combo, mod_combination,
+                                timestamp, offset, frames_length)
+
+
+# =============================================================================
+# FRAMES
+# =============================================================================
+
+
+def parse_frame_records(text):
+    """
+    Parses complete 'w|x|y|z' records, separated by commas, into a (n, 4) array.
+    """
+
+    values = np.fromstring(text.replace('|', ','), dtype=np.float64, sep=',')
+
+    if len(values) % 4:
+        raise InvalidReplay('Malformed replay frames')
+
+    return values.reshape(-1, 4)
+
+
+def iter_frame_records(data, header):
+    """
+    Decompresses the frames of a replay file a chunk at a time.
+
+    Args:
+        data (bytes or memoryview): The contents of the replay file.
+        header (classes.ReplayHeader): The header, as read by read_header().
+
+    Yields:
+        (np.ndarray): A (n, 4) array of the time delta, x, y and keys of each frame.
+    """
+
+    view = get_byte_view(data)[header.frames_offset:header.frames_offset + header.frames_length]
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_AUTO)
+    remainder = ''
+
+    try:
+        for start in range(0, len(view), CHUNK_SIZE):
+            text = remainder + decompressor.decompress(view[start:start + CHUNK_SIZE]).decode('ascii')
+
+            # Keep the last, possibly partial, record for the next chunk
+            end = text.rfind(',')
+            remainder = text[end + 1:]
+
+            if end >= 0:
+                yield parse_frame_records(text[:end])
+    except (lzma.LZMAError, EOFError, UnicodeDecodeError):
+        raise InvalidReplay('Malformed replay frames')
+
+    if remainder:
+        yield parse_frame_records(remainder)
+
+
+def decode_frame_columns(data, header):
+    """
+    Decodes the frames of a replay file into columns.
+
+    The RNG seed frame is dropped.
+
+    Args:
+        data (bytes or memoryview): The contents of the replay file.
+        header (classes.ReplayHeader): The header, as read by read_header().
+
+    Returns:
+        (tuple): The time delta, x, y and keys of every frame, in file order.
+    """
+
+    chunks = list(iter_frame_records(data, header))
+    records = np.concatenate(chunks) if chunks else np.empty((0, 4))
+
+    if len(records) and records[-1, 0] == SEED_FRAME_DELTA:
+        records = records[:-1]
+
+    return records[:, 0], records[:, 1], records[:, 2], records[:, 3].astype(np.int32)
@@ -2,99 +2,221 @@
 A module to handle queries on the DB.
 """
 
+from datetime import timedelta
 from decimal import Decimal
-from requests import get
 
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from osu_acc import osu_api
+from osu_acc.replay import analysis
 from osu_acc.replay import util
 from osu_acc.replay import classes
-from osu_acc.replay.models import Replay, ReplayData
-from osu_acc.beatmap.models import Beatmap, BreakPeriod, TimingPoint, HitObject
+from osu_acc.replay.models import IngestJob, Replay, ReplayData
+from osu_acc.beatmap import parser
+from osu_acc.beatmap import store
+from osu_acc.beatmap import timeline
+from osu_acc.beatmap.models import Beatmap, BreakPeriod, TimingPoint, HitObject, Timeline
 
 
 # =============================================================================
 # REPLAY MODELS
 # =============================================================================
 
-def create_replay_data_entry(replay_id, replay_events):
+def build_replay_data_fields(frames):
     """
-    Given a list of classes.ReplayEvents, create and save a models.ReplayData instance.
+    Given a classes.ReplayFrames instance, build the fields of a models.ReplayData instance.
 
     Args:
-        replay_events (List(classes.ReplayEvent)): The replay data.
+        frames (classes.ReplayFrames): The replay data.
+
+    Returns:
+        replay_data_fields (dict): A dictionary keyed as the fields on the ReplayData model,
+        all but replay_id.
     """
-    if ReplayData.objects.filter(replay_id=replay_id).exists():
-        return
 
     replay_data_fields = {}
 
-    replay_data_fields['replay_id'] = replay_id
-    replay_data_fields['x_coords'] = []
-    replay_data_fields['y_coords'] = []
-    replay_data_fields['hit_object_times'] = []
+    replay_data_fields['x_coords'] = frames.x
+    replay_data_fields['y_coords'] = frames.y
+    replay_data_fields['hit_object_times'] = frames.time
+    replay_data_fields['keys'] = frames.keys & analysis.CLICK_KEYS
+
+    return replay_data_fields
+
+
+def get_or_create_replay_data_entry(replay_id, frames):
+    """
+    Given a classes.ReplayFrames instance, create and save a models.ReplayData instance,
+    unless the replay already has one.
+
+    replay_id is unique, so concurrent callers end up with the same instance.
 
-    for replay_event in replay_events:
-        replay_data_fields['x_coords'].append(replay_event.x)
-        replay_data_fields['y_coords'].append(replay_event.y)
-        replay_data_fields['hit_object_times'].append(replay_event.time)
+    Args:
+        replay_id (str): The hash of the replay, read off its header.
+        frames (classes.ReplayFrames): The replay data.
 
-    replay_data_entry = ReplayData(**replay_data_fields)
-    replay_data_entry.save()
+    Returns:
+        replay_data_entry (ReplayData): The stored ReplayData instance.
+    """
+
+    replay_data_entry, _ = ReplayData.objects.get_or_create(
+        replay_id=replay_id,
+        defaults=build_replay_data_fields(frames),
+    )
+
+    return replay_data_entry
 
 
 def select_replay_data_field(replay_id, field):
     """
     Returns the value of the field of a specific ReplayData entry.
 
+    The ReplayData is materialized from the replay file if it was not yet.
+
     Equivalent to: SELECT field FROM replay_replaydata WHERE replay_id = replay_id;
 
     Args:
-        replay_id (str): The hash of the replay, given by osrparse.
+        replay_id (str): The hash of the replay, read off its header.
 
     Returns:
         field: The field requested.
-        Is of type: str, List(Decimal).
+        Is of type: np.ndarray.
     """
 
     valid_keys = set([
         'x_coords',
         'y_coords',
         'hit_object_times',
+        'keys',
     ])
 
     if field not in valid_keys:
         # Raise a proper exception
         return None
 
-    replay = Replay.objects.get(replay_id=replay_id)
-    return getattr(replay, field)
+    replay = Replay.objects.select_related('replay_data').get(replay_id=replay_id)
+    return getattr(get_replay_data(replay), field)
 
 
-def create_replay_entry(json_resp, parsed_replay):
+def get_replay_frames(replay):
     """
-    Create and save a Replay instance.
+    Returns the frames of a replay, decoding them from its replay file if they were never stored.
 
     Args:
-        json_resp (dict): The result of the osu!api call as a dictionary.
-        parsed_replay (osrparse.Replay): The parsed replay.
+        replay (Replay): The replay, ideally fetched with select_related('replay_data').
+
+    Returns:
+        (classes.ReplayFrames): The replay frames.
     """
 
-    if Replay.objects.filter(replay_id=parsed_replay.replay_hash).exists():
-        return
+    if replay.replay_data_id is not None:
+        return util.convert_replay_data_model_to_frames(replay.replay_data)
 
-    replay_fields = {}
+    return util.convert_replay_file_to_frames(replay.replay_file)
+
+
+def get_replay_data(replay):
+    """
+    Returns the ReplayData of a replay, materializing it from its replay file on first use.
+
+    Frames are only needed by a few features, so they are not stored on ingestion.
+
+    Args:
+        replay (Replay): The replay, ideally fetched with select_related('replay_data').
+
+    Returns:
+        (ReplayData): The replay's ReplayData instance.
+    """
+
+    if replay.replay_data_id is not None:
+        return replay.replay_data
+
+    frames = util.convert_replay_file_to_frames(replay.replay_file)
+
+    with transaction.atomic():
+        replay.replay_data = get_or_create_replay_data_entry(replay.replay_id, frames)
+
+        # Only the first of concurrent callers links the ReplayData
+        (Replay.objects
+         .filter(replay_id=replay.replay_id, replay_data__isnull=True)
+         .update(replay_data=replay.replay_data))
+
+    return replay.replay_data
+
+
+def replay_exists(replay_id):
+    """
+    Returns whether a replay is already stored.
+
+    Args:
+        replay_id (str): The hash of the replay, read off its header.
+    """
+
+    return Replay.objects.filter(replay_id=replay_id).exists()
+
+
+def create_replay_entry(beatmap, header, replay_events, replay_file):
+    """
+    Create and save a Replay instance.
+
+    Only the replay file is stored, its frames are materialized on demand
+    by get_replay_data().
+
+    Args:
+        beatmap (Beatmap): The replay's beatmap, with its related models loaded.
+        header (classes.ReplayHeader): The header of the replay file.
+        replay_events (classes.ReplayFrames): The frames of the replay file.
+        replay_file (bytes): The contents of the replay file.
+
+    Returns:
+        replay_entry (Replay): The Replay instance, which is not stored
+        if a concurrent caller stored the same replay first.
+    """
 
     # GETTING ARGUMENTS AND CONVERTING TYPES
-    circle_size = Decimal(json_resp['diff_size'])
-    overall_diff = Decimal(json_resp['diff_overall'])
-    break_periods_model = select_beatmap_field(json_resp['beatmap_id'], 'break_period')
-    break_periods = util.convert_beatmap_break_periods_to_class(break_periods_model)
-    replay_events = util.convert_osrp_play_data_to_class(parsed_replay.play_data)
-    hit_objects_model = select_beatmap_field(json_resp['beatmap_id'], 'hit_object')
-    hit_objects = util.convert_hit_object_model_to_class(hit_objects_model)
+    circle_size, overall_diff, break_periods, hit_objects, judgement_timeline = \
+        get_beatmap_columns(beatmap)
 
     # POPULATING FIELD DICTIONARY
+    replay_fields = get_replay_header_fields(header, beatmap)
+
+    analysis_fields = util.analyze_replay(circle_size,
+                                          overall_diff,
+                                          break_periods,
+                                          replay_events,
+                                          hit_objects,
+                                          judgement_timeline)
+    replay_fields = {**replay_fields, **analysis_fields}
+    replay_fields['replay_file'] = replay_file
+
+    # Create an instance of a Replay model.
+    # INSERT ... ON CONFLICT DO NOTHING, so a concurrent worker storing the same replay
+    # since replay_exists() was checked is not an error.
+    replay_entry = Replay(**replay_fields)
+    Replay.objects.bulk_create([replay_entry], ignore_conflicts=True)
+
+    return replay_entry
+
+
+def get_replay_header_fields(parsed_replay, beatmap):
+    """
+    Returns the Replay fields read off a replay file's header, rather than analyzed.
+
+    Args:
+        parsed_replay (classes.ReplayHeader): The header of the replay file, or any object
+                                              with the same header attributes.
+        beatmap (Beatmap): The replay's beatmap.
+
+    Returns:
+        replay_fields (dict): A dictionary keyed as the fields on the Replay model.
+    """
+
+    replay_fields = {}
+
     replay_fields['replay_id'] = parsed_replay.replay_hash
-    replay_fields['beatmap'] = Beatmap.objects.get(beatmap_id=json_resp['beatmap_id'])
+    replay_fields['beatmap'] = beatmap
     replay_fields['play_date'] = parsed_replay.timestamp
 
     replay_fields['ap'] = 0.00
@@ -109,33 +231,34 @@ def create_replay_entry(json_resp, parsed_replay):
                                                       replay_fields['num_raw_50'],
                                                       replay_fields['num_raw_miss'])
 
+    return replay_fields
 
-    true_acc_fields = util.get_true_accuracy_fields(circle_size,
-                                                    overall_diff,
-                                                    break_periods,
-                                                    replay_events,
-                                                    hit_objects)
-    replay_fields = {**replay_fields, **true_acc_fields}
-    replay_fields['true_accuracy'] = util.get_accuracy(replay_fields['num_true_300'],
-                                                       replay_fields['num_true_100'],
-                                                       replay_fields['num_true_50'],
-                                                       replay_fields['num_true_miss'])
 
-    create_replay_data_entry(parsed_replay.replay_hash, replay_events)
-    replay_fields['replay_data'] = ReplayData.objects.get(replay_id=parsed_replay.replay_hash)
+def get_beatmap_columns(beatmap):
+    """
+    Returns everything the analysis needs of a beatmap, as picklable columns.
 
-    replay_fields['hit_errors'] = util.get_hit_errors(circle_size,
-                                                      overall_diff,
-                                                      break_periods,
-                                                      replay_events,
-                                                      hit_objects)
+    Args:
+        beatmap (Beatmap): The beatmap, ideally fetched with its related models
+                           through select_related().
+                           Beatmaps ingested before timelines were compiled have none.
 
-    hit_error_data = util.calc_hit_error_data(replay_fields['hit_errors'])
-    replay_fields = {**replay_fields, **hit_error_data}
+    Returns:
+        (tuple): The circle size, overall difficulty, classes.BreakIndex,
+        classes.HitObjects and classes.Timeline (or None) of the beatmap.
+    """
 
-    # Create an instance of a Replay model
-    replay_entry = Replay(**replay_fields)
-    replay_entry.save()
+    judgement_timeline = None
+    if beatmap.timeline is not None:
+        judgement_timeline = util.convert_timeline_model_to_columns(beatmap.timeline)
+
+    return (
+        float(beatmap.beatmap_cs),
+        float(beatmap.beatmap_od),
+        util.convert_beatmap_break_periods_to_index(beatmap.break_period),
+        util.convert_hit_object_model_to_columns(beatmap.hit_object),
+        judgement_timeline,
+    )
 
 
 def select_replay_field(replay_id, field):
@@ -145,7 +268,7 @@ def select_replay_field(replay_id, field):
     Equivalent to: SELECT field FROM replay_replay WHERE replay_id = replay_id;
 
     Args:
-        replay_id (str): The hash of the replay, given by osrparse.
+        replay_id (str): The hash of the replay, read off its header.
 
     Returns:
         query_set[field]: The field requested.
@@ -168,6 +291,8 @@ def select_replay_field(replay_id, field):
         'num_true_100',
         'num_true_50',
         'num_true_miss',
+        'num_slider_ticks',
+        'num_slider_ticks_held',
         'hit_errors',
         'min_neg_hit_error',
         'max_neg_hit_error',
@@ -178,14 +303,19 @@ def select_replay_field(replay_id, field):
         'min_abs_hit_error',
         'max_abs_hit_error',
         'avg_abs_hit_error',
+        'std_hit_error',
+        'unstable_rate',
+        'p50_abs_hit_error',
+        'p90_abs_hit_error',
+        'p99_abs_hit_error',
     ])
 
     if field not in valid_keys:
         # Raise a proper exception
         return None
 
-    replaydata = ReplayData.objects.get(replay_id=replay_id)
-    return getattr(replaydata, field)
+    replay = Replay.objects.only(field).get(replay_id=replay_id)
+    return getattr(replay, field)
 
 
 # =============================================================================
@@ -193,7 +323,7 @@ def select_replay_field(replay_id, field):
 # =============================================================================
 
 
-def create_break_period_entry(bm_id, data):
+def create_break_period_entry(bm_id, break_fields):
     """
     Create and save a BreakPeriod entry.
 
@@ -201,45 +331,13 @@ def create_break_period_entry(bm_id, data):
 
     Args:
         bm_id (str): The id of the beatmap associated.
-        data (List(str)): The beatmap data as a list of strings.
+        break_fields (dict): The break periods, as parsed by parser.parse_beatmap().
 
     Returns:
-        break_period_entry(BreakPeriod): The created BreakPeriod instance.
+        break_entry (BreakPeriod): The created BreakPeriod instance.
     """
 
-    if BreakPeriod.objects.filter(beatmap_id=bm_id).exists():
-        return
-
-    # Syntax: 2,start,end
-    # The start and end fields are both an integral number of milliseconds,
-    # from the beginning of the song,
-    # defining the start and end point of the break period, respectively.
-
-    break_fields = {}
-    break_fields['beatmap_id'] = bm_id
-    break_fields['starts'] = []
-    break_fields['ends'] = []
-
-    is_break = False
-
-    for line in data:
-        if 'Break Periods' in line.strip():
-            is_break = True
-            continue
-
-        if is_break:
-            # Next subsection, storyboarding, begins with the line
-            # '//Storyboard Layer 0 (Background)\n'
-            if 'Storyboard' in line.strip():
-                is_break = False
-            else:
-                start = int(line.split(',')[1])
-                break_fields['starts'].append(start)
-                end = int(line.split(',')[2])
-                break_fields['ends'].append(end)
-
-    break_entry = BreakPeriod(**break_fields)
-    break_entry.save()
+    return BreakPeriod.objects.create(beatmap_id=bm_id, **break_fields)
 
 
 def select_break_period_field(beatmap_id, field):
@@ -266,7 +364,7 @@ def select_break_period_field(beatmap_id, field):
     return getattr(break_period, field)
 
 
-def create_timing_point_entry(bm_id, data):
+def create_timing_point_entry(bm_id, timing_point_fields):
     """
     Create and save a TimingPoint entry.
 
@@ -274,43 +372,13 @@ def create_timing_point_entry(bm_id, data):
 
     Args:
         bm_id (str): The id of the beatmap associated.
-        data (List(str)): The beatmap data as a list of strings.
+        timing_point_fields (dict): The timing points, as parsed by parser.parse_beatmap().
 
     Returns:
-        timing_point_model(TimingPoint): The created TimingPoint instance.
-    """
-    if TimingPoint.objects.filter(beatmap_id=bm_id).exists():
-        return
-
-    # Syntax: Offset, Milliseconds per Beat, Meter, 
-    #         Sample Set, Sample Index, Volume, Inherited, Kiai Mode
-    # For our purposes, we only need the first three fields.
-    # We will also convert all ms/beat values to positive.
-    timing_point_fields = {}
-    timing_point_fields['beatmap_id'] = bm_id
-    timing_point_fields['offsets'] = []
-    timing_point_fields['ms_per_beats'] = []
-
-    is_timing_point = False
-
-    for line in data:
-        if line.strip() == '[TimingPoints]':
-            is_timing_point = True
-            continue
-
-        if is_timing_point:
-            # There is always an empty line before the start of the next section
-            # Use it to identify when the current section ends
-            if not line.strip():
-                is_timing_point = False
-            else:
-                offset = int(line.split(',')[0])
-                timing_point_fields['offsets'].append(offset)
-                ms_per_beat = Decimal(line.split(',')[1])
-                timing_point_fields['ms_per_beats'].append(round(ms_per_beat, 2))
-
-    timing_point_entry = TimingPoint(**timing_point_fields)
-    timing_point_entry.save()
+        timing_point_entry (TimingPoint): The created TimingPoint instance.
+    """
+
+    return TimingPoint.objects.create(beatmap_id=bm_id, **timing_point_fields)
 
 
 def select_timing_point_field(beatmap_id, field):
@@ -340,7 +408,7 @@ def select_timing_point_field(beatmap_id, field):
     return getattr(timingpoint, field)
 
 
-def create_hit_object_entry(bm_id, data):
+def create_hit_object_entry(bm_id, hit_object_fields):
     """
     Create and save a HitObject entry.
 
@@ -348,45 +416,13 @@ def create_hit_object_entry(bm_id, data):
 
     Args:
         bm_id (str): The id of the beatmap associated.
-        data (List(str)): The beatmap data as a list of strings.
+        hit_object_fields (dict): The hit objects, as parsed by parser.parse_beatmap().
 
     Returns:
-        hit_object_model(HitObject): The created HitObject instance.
-    """
-    if HitObject.objects.filter(beatmap_id=bm_id).exists():
-        return
-
-    # Syntax: x,y,time,type,hitSound...,extras
-    # For our purposes, we only need the time field
-    hit_object_fields = {}
-    hit_object_fields['beatmap_id'] = bm_id
-    hit_object_fields['x_coords'] = []
-    hit_object_fields['y_coords'] = []
-    hit_object_fields['hit_object_times'] = []
-    hit_object_fields['hit_object_types'] = []
-
-    is_hit_object = False
-
-    for line in data:
-        if line.strip() == '[HitObjects]':
-            is_hit_object = True
-            continue
-
-        if is_hit_object:
-            if not line.strip():
-                is_hit_object = False
-            else:
-                x = line.split(',')[0]
-                hit_object_fields['x_coords'].append(x)
-                y = line.split(',')[1]
-                hit_object_fields['y_coords'].append(y)
-                obj_time = line.split(',')[2]
-                hit_object_fields['hit_object_times'].append(obj_time)
-                obj_type = line.split(',')[3]
-                hit_object_fields['hit_object_types'].append(obj_type)
-
-    hit_object_entry = HitObject(**hit_object_fields)
-    hit_object_entry.save()
+        hit_object_entry (HitObject): The created HitObject instance.
+    """
+
+    return HitObject.objects.create(beatmap_id=bm_id, **hit_object_fields)
 
 
 def select_hit_object_field(beatmap_id, field):
@@ -417,33 +453,91 @@ def select_hit_object_field(beatmap_id, field):
     return getattr(hitobject, field)
 
 
-def create_beatmap_entry(json_resp):
+def create_timeline_entry(bm_id, hit_object_model, timing_point_model,
+                          slider_multiplier, slider_tick_rate):
     """
-    Given a beatmap's API response as JSON,
-    populate the database with the appropriate information.
+    Compile and save a Timeline entry.
+
+    Equivalent to: INSERT INTO beatmap_timeline (fields) VALUES (values);
+
+    Args:
+        bm_id (str): The id of the beatmap associated.
+        hit_object_model (HitObject): The beatmap's hit objects.
+        timing_point_model (TimingPoint): The beatmap's timing points.
+        slider_multiplier (Decimal): The beatmap's base slider velocity.
+        slider_tick_rate (Decimal): The beatmap's number of slider ticks per beat.
+
+    Returns:
+        timeline_entry (Timeline): The created Timeline instance.
+    """
+
+    timeline_fields = timeline.compile_timeline(hit_object_model, timing_point_model,
+                                                slider_multiplier, slider_tick_rate)
+
+    return Timeline.objects.create(beatmap_id=bm_id, **timeline_fields)
+
+
+def get_difficulty_settings(difficulty):
+    """
+    Returns the slider settings from the [Difficulty] section of a beatmap file.
+
+    Args:
+        difficulty (dict): The [Difficulty] section, as parsed by parser.parse_beatmap().
+
+    Returns:
+        settings (dict): The SliderMultiplier and SliderTickRate, as Decimals.
+    """
+
+    settings = {
+        'SliderMultiplier': Decimal('1.4'),
+        'SliderTickRate': Decimal('1'),
+    }
+
+    for key in settings:
+        if key in difficulty:
+            settings[key] = Decimal(difficulty[key])
+
+    return settings
+
+
+def get_beatmap_file(json_resp):
+    """
+    Returns a beatmap's file, parsed, downloading it only if it is not stored yet.
 
     Args:
         json_resp (dict): The response from osu!api
+
+    Returns:
+        parsed_beatmap (dict): The parsed sections, as returned by parser.parse_beatmap().
     """
-    bm_id = json_resp['beatmap_id']
 
-    if Beatmap.objects.filter(beatmap_id=bm_id).exists():
-        return
+    beatmap_store = store.get_beatmap_store()
+    content = beatmap_store.get(json_resp['file_md5'])
 
-    # Download beatmap file
-    OSU_BEATMAP_ENDPOINT = 'https://osu.ppy.sh/osu/'
-    response = get(OSU_BEATMAP_ENDPOINT + bm_id)
+    if content is None:
+        content = osu_api.get_beatmap_file(json_resp['beatmap_id'])
+        beatmap_store.put(content)
 
-    with open(bm_id + '.osu', 'wb') as f:
-        f.write(response.content)
+    # Parse beatmap file in a single pass
+    return parser.parse_beatmap_file(content)
 
-    with open(bm_id + '.osu', 'r') as f:
-        data = f.readlines()
 
-    # Parse beatmap file for required data
+def build_beatmap_fields(json_resp, parsed_beatmap):
+    """
+    Builds the fields of a Beatmap read off its API response and file, all but its related models.
+
+    Args:
+        json_resp (dict): The response from osu!api
+        parsed_beatmap (dict): The parsed beatmap file.
+
+    Returns:
+        beatmap_fields (dict): A dictionary keyed as the fields on the Beatmap model.
+    """
+
     beatmap_fields = {}
 
-    beatmap_fields['beatmap_id'] = bm_id
+    beatmap_fields['beatmap_id'] = json_resp['beatmap_id']
+    beatmap_fields['beatmap_md5'] = json_resp['file_md5']
 
     beatmap_fields['song_title'] = json_resp['title']
     beatmap_fields['song_artist'] = json_resp['artist']
@@ -452,17 +546,170 @@ def create_beatmap_entry(json_resp):
     beatmap_fields['beatmap_cs'] = Decimal(json_resp['diff_size'])
     beatmap_fields['beatmap_od'] = Decimal(json_resp['diff_overall'])
 
-    # Create and get model fields
-    create_break_period_entry(bm_id, data)
-    beatmap_fields['break_period'] = BreakPeriod.objects.get(beatmap_id=bm_id)
-    create_timing_point_entry(bm_id, data)
-    beatmap_fields['timing_point'] = TimingPoint.objects.get(beatmap_id=bm_id)
-    create_hit_object_entry(bm_id, data)
-    beatmap_fields['hit_object'] = HitObject.objects.get(beatmap_id=bm_id)
+    difficulty_settings = get_difficulty_settings(parsed_beatmap['Difficulty'])
+    beatmap_fields['slider_multiplier'] = round(difficulty_settings['SliderMultiplier'], 2)
+    beatmap_fields['slider_tick_rate'] = round(difficulty_settings['SliderTickRate'], 1)
+
+    return beatmap_fields
+
+
+def create_beatmap_entry(json_resp):
+    """
+    Given a beatmap's API response as JSON,
+    populate the database with the appropriate information.
+
+    The created instances are reused as they are, rather than fetched back,
+    so call this within a transaction to create the beatmap as a whole or not at all.
+
+    Args:
+        json_resp (dict): The response from osu!api
+
+    Returns:
+        beatmap_entry (Beatmap): The created Beatmap instance, with its related models.
+    """
+    bm_id = json_resp['beatmap_id']
+
+    parsed_beatmap = get_beatmap_file(json_resp)
+    beatmap_fields = build_beatmap_fields(json_resp, parsed_beatmap)
+    difficulty_settings = get_difficulty_settings(parsed_beatmap['Difficulty'])
+
+    # Create model fields
+    beatmap_fields['break_period'] = create_break_period_entry(bm_id,
+                                                               parsed_beatmap['break_period'])
+    beatmap_fields['timing_point'] = create_timing_point_entry(bm_id,
+                                                               parsed_beatmap['timing_point'])
+    beatmap_fields['hit_object'] = create_hit_object_entry(bm_id, parsed_beatmap['hit_object'])
+    beatmap_fields['timeline'] = create_timeline_entry(bm_id,
+                                                       beatmap_fields['hit_object'],
+                                                       beatmap_fields['timing_point'],
+                                                       difficulty_settings['SliderMultiplier'],
+                                                       difficulty_settings['SliderTickRate'])
 
     # Create Beatmap model instance and save to DB
     beatmap_entry = Beatmap(**beatmap_fields)
-    beatmap_entry.save()
+    beatmap_entry.save(force_insert=True)
+
+    return beatmap_entry
+
+
+def update_beatmap_entry(json_resp):
+    """
+    Replaces a stored beatmap with the version of its file osu!api now serves.
+
+    The beatmap and its related models are updated in place, as beatmap_md5 is
+    unique and deleting the related models would cascade to the beatmap's replays.
+    Replays analyzed against the previous version keep their results.
+
+    Args:
+        json_resp (dict): The response from osu!api
+
+    Returns:
+        beatmap_entry (Beatmap): The updated Beatmap instance, with its related models.
+    """
+    bm_id = json_resp['beatmap_id']
+
+    parsed_beatmap = get_beatmap_file(json_resp)
+    beatmap_fields = build_beatmap_fields(json_resp, parsed_beatmap)
+    difficulty_settings = get_difficulty_settings(parsed_beatmap['Difficulty'])
+
+    # Unsaved instances, only to compile the timeline from
+    hit_object_model = HitObject(beatmap_id=bm_id, **parsed_beatmap['hit_object'])
+    timing_point_model = TimingPoint(beatmap_id=bm_id, **parsed_beatmap['timing_point'])
+    timeline_fields = timeline.compile_timeline(hit_object_model, timing_point_model,
+                                                difficulty_settings['SliderMultiplier'],
+                                                difficulty_settings['SliderTickRate'])
+
+    with transaction.atomic():
+        BreakPeriod.objects.filter(beatmap_id=bm_id).update(**parsed_beatmap['break_period'])
+        TimingPoint.objects.filter(beatmap_id=bm_id).update(**parsed_beatmap['timing_point'])
+        HitObject.objects.filter(beatmap_id=bm_id).update(**parsed_beatmap['hit_object'])
+
+        # Beatmaps stored before timelines were compiled have none yet
+        beatmap_fields['timeline'], _ = Timeline.objects.update_or_create(
+            beatmap_id=bm_id, defaults=timeline_fields)
+
+        Beatmap.objects.filter(beatmap_id=bm_id).update(**beatmap_fields)
+
+    return select_beatmap_by_id(bm_id)
+
+
+def get_or_create_beatmap_entry(json_resp):
+    """
+    Creates a beatmap as create_beatmap_entry() does, unless it is already stored.
+
+    Beatmaps are resolved under a lock per file hash, but a beatmap may be resolved
+    under several hashes at once, one for each version of its file. beatmap_id is
+    unique on the Beatmap and each of its related models, so all but the first
+    of such callers fail to insert and get the stored beatmap instead.
+
+    Args:
+        json_resp (dict): The response from osu!api
+
+    Returns:
+        beatmap_entry (Beatmap): The stored Beatmap instance, with its related models.
+    """
+
+    try:
+        with transaction.atomic():
+            return create_beatmap_entry(json_resp)
+    except IntegrityError:
+        beatmap_entry = select_beatmap_by_id(json_resp['beatmap_id'])
+
+        if beatmap_entry is None:
+            raise
+
+        return beatmap_entry
+
+
+def select_beatmap_by_id(beatmap_id):
+    """
+    Returns the beatmap with the given id, with its related models.
+
+    Equivalent to: SELECT * FROM beatmap_beatmap WHERE beatmap_id = beatmap_id;
+
+    Args:
+        beatmap_id (str): The id of the beatmap, given by osu!api.
+
+    Returns:
+        (Beatmap): The beatmap, or None if it is not stored.
+    """
+
+    return (Beatmap.objects
+            .select_related('break_period', 'hit_object', 'timeline')
+            .filter(beatmap_id=beatmap_id)
+            .first())
+
+
+def select_beatmap_by_md5(beatmap_md5):
+    """
+    Returns the beatmap with the given .osu file hash, with its related models.
+
+    Equivalent to: SELECT * FROM beatmap_beatmap WHERE beatmap_md5 = beatmap_md5;
+
+    Args:
+        beatmap_md5 (str): The MD5 hash of the beatmap file, as referenced by replays.
+
+    Returns:
+        (Beatmap): The beatmap, or None if it is not stored.
+    """
+
+    return (Beatmap.objects
+            .select_related('break_period', 'hit_object', 'timeline')
+            .filter(beatmap_md5=beatmap_md5)
+            .first())
+
+
+def set_beatmap_md5(beatmap_id, beatmap_md5):
+    """
+    Stores the .osu file hash of a beatmap ingested before it was stored.
+
+    Equivalent to: UPDATE beatmap_beatmap SET beatmap_md5 = beatmap_md5
+                   WHERE beatmap_id = beatmap_id AND beatmap_md5 IS NULL;
+    """
+
+    (Beatmap.objects
+     .filter(beatmap_id=beatmap_id, beatmap_md5__isnull=True)
+     .update(beatmap_md5=beatmap_md5))
 
 
 def select_beatmap_field(beatmap_id, field):
@@ -483,10 +730,14 @@ def select_beatmap_field(beatmap_id, field):
         'break_period',
         'timing_point',
         'hit_object',
+        'timeline',
+        'beatmap_md5',
         'beatmap_creator',
         'beatmap_difficulty',
         'beatmap_cs',
         'beatmap_od',
+        'slider_multiplier',
+        'slider_tick_rate',
         'song_title',
         'song_artist',
     ])
@@ -497,3 +748,57 @@ def select_beatmap_field(beatmap_id, field):
 
     beatmap = Beatmap.objects.get(beatmap_id=beatmap_id)
     return getattr(beatmap, field)
+
+
+# =============================================================================
+# INGEST JOBS
+# =============================================================================
+
+def create_ingest_job(replay_file):
+    """
+    Create and save a queued IngestJob instance.
+
+    Args:
+        replay_file (bytes): The contents of the uploaded replay file.
+
+    Returns:
+        (IngestJob): The job.
+    """
+
+    return IngestJob.objects.create(replay_file=replay_file)
+
+
+def claim_ingest_job(stale_after):
+    """
+    Claims the oldest job due to run, and marks it as running.
+
+    Rows are locked with SKIP LOCKED, so concurrent workers never claim the same job.
+    Running jobs not updated for stale_after seconds are assumed to belong
+    to a dead worker and can be claimed again.
+
+    Args:
+        stale_after (int): The number of seconds after which a running job is stale.
+
+    Returns:
+        job (IngestJob): The claimed job, or None if no job is due.
+    """
+
+    now = timezone.now()
+    due = Q(status=IngestJob.QUEUED, run_after__lte=now)
+    stale = Q(status=IngestJob.RUNNING, updated_at__lt=now - timedelta(seconds=stale_after))
+
+    with transaction.atomic():
+        job = (IngestJob.objects
+               .select_for_update(skip_locked=True)
+               .filter(due | stale)
+               .order_by('id')
+               .first())
+
+        if job is None:
+            return None
+
+        job.status = IngestJob.RUNNING
+        job.attempts += 1
+        job.save(update_fields=['status', 'attempts', 'updated_at'])
+
+    return job
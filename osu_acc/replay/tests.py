@@ -1,3 +1,757 @@
-from django.test import TestCase
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from osu_acc import osu_api
+from osu_acc.beatmap import store
+from osu_acc.beatmap.models import Beatmap, BreakPeriod, TimingPoint, HitObject
+from osu_acc.replay import analysis
+from osu_acc.replay import classes
+from osu_acc.replay import handlers
+from osu_acc.replay import importer
+from osu_acc.replay import osr
+from osu_acc.replay import query
+from osu_acc.replay import util
+from osu_acc.replay.models import IngestJob, Replay, ReplayData
+
+REPLAY_DIR = os.path.join(settings.BASE_DIR, 'test', 'replays')
+REPLAY_PATH = os.path.join(REPLAY_DIR, 'pepsi-man.osr')
+
+# Replay hash, 300s, 100s, 50s, misses, number of frames and time of the last frame
+REPLAY_FIXTURES = {
+    'croatian-rhapsody.osr': ('780eb08902b53ae4cf665f5285a57d32', 712, 19, 0, 0, 89199, 212853),
+    'grimoire-of-alice.osr': ('c8b5594e110d98aee7a06952edaeedd8', 1571, 164, 5, 9, 22160, 309795),
+    'own-phrases.osr': ('0f9648c9b3e2907f8c92acd1649cd47f', 1463, 47, 13, 10, 23454, 318573),
+    'pepsi-man.osr': ('6d0c9b394a670ec6c62db72898ea0ae5', 120, 2, 1, 0, 3312, 48772),
+    'sendan-life.osr': ('4ccbfc8b6434b1f612d043c0833f5ec9', 4, 9, 0, 255, 5370, 81167),
+}
+
+BEATMAP_FILE = b'''osu file format v14
+
+[Difficulty]
+SliderMultiplier:1.4
+SliderTickRate:1
+
+[Events]
+2,10000,15000
+
+[TimingPoints]
+0,500,4,2,1,60,1,0
+
+[HitObjects]
+256,192,1000,1,0,0:0:0:0:
+100,100,2000,2,0,B|200:100,1,140
+256,192,3000,12,0,5000,0:0:0:0:
+'''
+
+
+class ReadReplayFileTest(SimpleTestCase):
+    """
+    Reads the test replays, as uploaded and as loaded back from the DB.
+    """
+
+
+    def read_fixture(self, name):
+        with open(os.path.join(REPLAY_DIR, name), 'rb') as f:
+            return f.read()
+
+
+    def test_fixtures(self):
+        for name, expected in REPLAY_FIXTURES.items():
+            replay_hash, n300, n100, n50, misses, num_frames, last_time = expected
+            replay_file = self.read_fixture(name)
+
+            with self.subTest(name=name):
+                header = osr.read_header(replay_file)
+                self.assertEqual(header.game_mode, osr.STANDARD)
+                self.assertEqual(header.replay_hash, replay_hash)
+                self.assertEqual(header.timestamp.utcoffset(), timedelta(0))
+                self.assertEqual((header.number_300s, header.number_100s,
+                                  header.number_50s, header.misses), (n300, n100, n50, misses))
+
+                frames = util.convert_replay_file_to_frames(replay_file, header)
+                self.assertEqual(len(frames.x), num_frames)
+                self.assertEqual(frames.time[-1], last_time)
+                self.assertTrue(np.all(np.diff(frames.time) >= 0))
+
+
+    def test_memoryview_of_chars(self):
+        # As psycopg2 returns bytea columns
+        replay_file = self.read_fixture('pepsi-man.osr')
+        stored_file = memoryview(replay_file).cast('c')
+
+        frames = util.convert_replay_file_to_frames(replay_file)
+        stored_frames = util.convert_replay_file_to_frames(stored_file)
+
+        self.assertEqual(osr.read_header(stored_file).replay_hash,
+                         REPLAY_FIXTURES['pepsi-man.osr'][0])
+        np.testing.assert_array_equal(stored_frames.time, frames.time)
+        np.testing.assert_array_equal(stored_frames.keys, frames.keys)
+
+
+    def test_truncated(self):
+        replay_file = self.read_fixture('pepsi-man.osr')
+        header = osr.read_header(replay_file)
+
+        for data in (b'', replay_file[:10], replay_file[:header.frames_offset + 100]):
+            with self.assertRaises(osr.InvalidReplay):
+                util.convert_replay_file_to_frames(data)
+
+
+def create_beatmap(beatmap_hash):
+    """
+    Stores a beatmap of two circles under beatmap_hash, as if it was resolved before.
+    """
+
+    Beatmap.objects.create(
+        beatmap_id='1',
+        beatmap_md5=beatmap_hash,
+        break_period=BreakPeriod.objects.create(beatmap_id='1', starts=[], ends=[]),
+        timing_point=TimingPoint.objects.create(beatmap_id='1',
+                                                offsets=[0],
+                                                ms_per_beats=[500]),
+        hit_object=HitObject.objects.create(beatmap_id='1',
+                                            x_coords=[256, 100],
+                                            y_coords=[192, 100],
+                                            hit_object_times=[1000, 2000],
+                                            hit_object_types=[1, 1],
+                                            hit_object_slides=[1, 1],
+                                            hit_object_lengths=[0, 0],
+                                            hit_object_end_times=[1000, 2000]),
+        beatmap_creator='Creator',
+        beatmap_difficulty='Version',
+        beatmap_cs=4,
+        beatmap_od=8,
+        song_title='Title',
+        song_artist='Artist',
+    )
+
+
+class AnalysisTest(SimpleTestCase):
+    """
+    Checks the building blocks of the columnar analysis backend, without a database.
+    """
+
+
+    def test_press_edges(self):
+        # K1 held over two frames, then K2, then K1 on top of K2, then smoke alone
+        keys = [0, 5, 5, 0, 10, 15, 16, 0, 1]
+        np.testing.assert_array_equal(analysis.get_press_edges(keys), [1, 4, 5, 8])
+
+
+    def test_break_index(self):
+        # Given out of order, both ends inclusive
+        break_index = classes.BreakIndex([5000, 1000], [6000, 2000])
+        times = [999, 1000, 1500, 2000, 2001, 4999, 5000, 6000, 6001]
+        expected = [False, True, True, True, False, False, True, True, False]
+
+        np.testing.assert_array_equal(break_index.mask(times), expected)
+        self.assertEqual([break_index.contains(time) for time in times], expected)
+
+        empty_index = classes.BreakIndex([], [])
+        np.testing.assert_array_equal(empty_index.mask(times), [False] * len(times))
+        self.assertFalse(empty_index.contains(1000))
+
+
+    def test_count_judgements(self):
+        scores = np.array([300, 100, 50, 0, 0, 300])
+        judgeable = np.array([True, True, True, True, False, True])
+
+        self.assertEqual(analysis.count_judgements(scores, judgeable), (2, 1, 1, 1))
+
+
+    def test_hit_windows(self):
+        for overall_diff, expected in ((8, (32, 76, 120)),
+                                       (5, (50, 100, 150)),
+                                       (Decimal('8.5'), (29, 72, 115))):
+            with self.subTest(overall_diff=overall_diff):
+                windows = [util.get_hit_window(overall_diff, score) for score in ('300', '100', '50')]
+
+                for window, expected_window in zip(windows, expected):
+                    self.assertIsInstance(window, float)
+                    self.assertAlmostEqual(window, expected_window)
+
+
+    def test_list_engine_agrees(self):
+        # Random circles, sliders and spinners, with random presses
+        # in and out of a break, judged by both engines
+        rng = random.Random(0)
+        break_periods = [classes.BreakPeriod(1500, 2000)]
+
+        for _ in range(200):
+            times = sorted(rng.randrange(3000) for _ in range(rng.randrange(1, 30)))
+            hit_objects = [classes.HitObject(rng.randrange(512), rng.randrange(384),
+                                             float(time), rng.choice([1, 2, 12]))
+                           for time in times]
+
+            times = sorted(rng.randrange(3200) for _ in range(rng.randrange(1, 80)))
+            replay_events = [classes.ReplayEvent(rng.randrange(512), rng.randrange(384),
+                                                 float(time), rng.choice([0, 1, 5, 10]))
+                             for time in times]
+
+            judgements = util.judge_replay(4, 8, break_periods, replay_events, hit_objects)
+            judged = judgements.judgeable
+
+            for mode, hit_errors in (('true', judgements.true_errors),
+                                     ('raw', judgements.raw_errors)):
+                associations = util.associate_hits(mode, 4, 8, break_periods,
+                                                   replay_events, hit_objects)
+                expected = [np.nan if association.hit_error is None else association.hit_error
+                            for association in associations]
+
+                np.testing.assert_array_equal(hit_errors[judged], expected)
+
+
+class HitErrorStatsTest(SimpleTestCase):
+    """
+    Checks the single-pass hit error statistics against their textbook definitions.
+    """
+
+
+    def test_empty(self):
+        stats = classes.HitErrorStats()
+        stats.update([])
+
+        self.assertEqual(stats.count, 0)
+        for value in (stats.mean, stats.std, stats.unstable_rate, stats.avg_abs,
+                      stats.avg_pos, stats.avg_neg, stats.min_abs, stats.percentile(50)):
+            self.assertIsNone(value)
+
+
+    def test_moments(self):
+        hit_errors = [-30.5, -12, -3, 0, 4, 8.25, 16, 41]
+        stats = classes.HitErrorStats()
+        stats.update(hit_errors)
+
+        self.assertAlmostEqual(stats.mean, np.mean(hit_errors))
+        self.assertAlmostEqual(stats.std, np.std(hit_errors))
+        self.assertAlmostEqual(stats.unstable_rate, 10 * np.std(hit_errors))
+
+        self.assertEqual((stats.num_pos, stats.num_neg), (4, 3))
+        self.assertEqual((stats.min_neg, stats.max_neg), (-30.5, -3))
+        self.assertEqual((stats.min_pos, stats.max_pos), (4, 41))
+        self.assertAlmostEqual(stats.avg_abs, np.mean(np.abs(hit_errors)))
+
+
+    def test_percentiles(self):
+        stats = classes.HitErrorStats()
+        stats.update(range(-50, 50))
+
+        # Nearest rank over the absolute errors 0, 1, 1, 2, 2, ..., 49, 49, 50
+        self.assertEqual(stats.percentile(0), 0)
+        self.assertEqual(stats.percentile(50), 25)
+        self.assertEqual(stats.percentile(90), 45)
+        self.assertEqual(stats.percentile(100), 50)
+
+
+    def test_percentiles_round_to_nearest_ms(self):
+        for hit_error, expected in ((12.4, 12), (-12.6, 13), (12.5, 13), (250, 200)):
+            with self.subTest(hit_error=hit_error):
+                stats = classes.HitErrorStats()
+                stats.add(hit_error)
+                self.assertEqual(stats.percentile(50), expected)
+
+
+class FindMatchesTest(SimpleTestCase):
+    """
+    Judges short, hand-built patterns, where each press hits at most one hit object.
+    """
+
+
+    def setUp(self):
+        # CS4 and OD8: a 36.48 osu!pixel radius, and 32, 76 and 120 ms hit windows
+        self.difficulty = util.get_beatmap_difficulty(4, 8)
+
+
+    def tap(self, *presses):
+        """
+        Returns frames pressing K1 at each (time, x, y), and releasing it 10 ms later.
+        """
+
+        frames = []
+
+        for time, x, y in presses:
+            frames.append((time, x, y, 5))
+            frames.append((time + 10, x, y, 0))
+
+        time, x, y, keys = zip(*frames)
+        return classes.ReplayFrames(x, y, time, keys)
+
+
+    def circles(self, *positions):
+        time, x, y = zip(*positions)
+        return classes.HitObjects(x, y, time, [1] * len(positions))
+
+
+    def test_stream(self):
+        # A 1/4 stream at 180 BPM, tapped on time
+        positions = [(1000 + 83*i, 100 + 20*i, 100) for i in range(6)]
+        frames = self.tap(*positions)
+        presses = analysis.get_presses(frames)
+
+        judgements = analysis.judge(self.difficulty, presses, self.circles(*positions))
+
+        np.testing.assert_array_equal(judgements.true_errors, [0] * 6)
+        np.testing.assert_array_equal(judgements.raw_errors, [0] * 6)
+        self.assertEqual(analysis.count_judgements(judgements.raw_scores, judgements.judgeable),
+                         (6, 0, 0, 0))
+
+
+    def test_jump(self):
+        # Jumps 100 ms apart, each hit 40 ms late
+        positions = [(1000, 50, 50), (1100, 450, 330), (1200, 50, 330), (1300, 450, 50)]
+        frames = self.tap(*[(time + 40, x, y) for time, x, y in positions])
+        presses = analysis.get_presses(frames)
+
+        judgements = analysis.judge(self.difficulty, presses, self.circles(*positions))
+
+        np.testing.assert_array_equal(judgements.raw_errors, [40] * 4)
+        self.assertEqual(analysis.count_judgements(judgements.raw_scores, judgements.judgeable),
+                         (0, 4, 0, 0))
+
+
+    def test_notelock(self):
+        # The first press misses the first circle, and is used up rather than
+        # hitting the second circle, which then takes the third press
+        positions = [(1000, 50, 50), (1100, 450, 330)]
+        frames = self.tap((1000, 450, 330), (1050, 50, 50), (1150, 450, 330))
+        presses = analysis.get_presses(frames)
+
+        judgements = analysis.judge(self.difficulty, presses, self.circles(*positions))
+
+        np.testing.assert_array_equal(judgements.true_errors, [0, -50])
+        np.testing.assert_array_equal(judgements.raw_errors, [50, 50])
+        np.testing.assert_array_equal(judgements.on_note, [False, False])
+
+
+    def test_debug_trace(self):
+        positions = [(1000, 50, 50), (1100, 450, 330)]
+        replay_events = [classes.ReplayEvent(450, 330, 1130, 5)]
+        hit_objects = [classes.HitObject(x, y, time, 1) for time, x, y in positions]
+
+        with self.assertLogs('osu_acc.replay.util', 'DEBUG') as logs:
+            util.judge_replay(4, 8, [], replay_events, hit_objects)
+
+        self.assertIn('DEBUG:osu_acc.replay.util:Did not associate HitObject at 1000.0 '
+                      'with any ReplayEvent mode=raw', logs.output)
+        self.assertIn('DEBUG:osu_acc.replay.util:Associated ReplayEvent at 1130.0 '
+                      'with HitObject at 1100.0 mode=raw', logs.output)
+
+
+class IngestReplayQueryCountTest(TestCase):
+    """
+    Pins the number of queries an upload costs, so ingestion stays round-trip-minimal.
+    """
+
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(REPLAY_PATH, 'rb') as f:
+            cls.replay_file = f.read()
+
+        cls.beatmap_hash = osr.read_header(cls.replay_file).beatmap_hash
+
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+
+        patcher = mock.patch.object(store, 'get_beatmap_store',
+                                    return_value=store.BeatmapStore(self.store_dir, 1024 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def get_json_resp(self):
+        return {
+            'beatmap_id': '1',
+            'file_md5': self.beatmap_hash,
+            'title': 'Title',
+            'artist': 'Artist',
+            'creator': 'Creator',
+            'version': 'Version',
+            'diff_size': '4',
+            'diff_overall': '8',
+            'total_length': '60',
+        }
+
+
+    def test_upload_of_stored_beatmap(self):
+        create_beatmap(self.beatmap_hash)
+
+        # SELECT whether the replay exists, SELECT the beatmap by hash, INSERT Replay.
+        # Frames are not stored until they are needed.
+        with mock.patch('osu_acc.osu_api.get_beatmaps') as get_beatmaps:
+            with self.assertNumQueries(3):
+                replay_id = handlers.ingest_replay(self.replay_file)
+
+        get_beatmaps.assert_not_called()
+
+        replay = Replay.objects.get(replay_id=replay_id)
+        self.assertIsNone(replay.replay_data)
+        self.assertEqual(bytes(replay.replay_file), self.replay_file)
+
+
+    def test_frames_of_stored_replay(self):
+        create_beatmap(self.beatmap_hash)
+        replay_id = handlers.ingest_replay(self.replay_file)
+        frames = util.convert_replay_file_to_frames(self.replay_file)
+
+        # The replay file is decoded as loaded from the DB, then its frames are stored
+        replay = Replay.objects.get(replay_id=replay_id)
+        np.testing.assert_array_equal(query.get_replay_frames(replay).time, frames.time)
+        query.get_replay_data(replay)
+
+        replay_data = ReplayData.objects.get(replay_id=replay_id)
+        np.testing.assert_array_equal(replay_data.x_coords, frames.x)
+        np.testing.assert_array_equal(replay_data.hit_object_times, frames.time)
+        self.assertEqual(Replay.objects.get(replay_id=replay_id).replay_data_id, replay_data.id)
+
+
+    def test_upload_of_new_beatmap(self):
+        # SELECT whether the replay exists, SELECT the beatmap by hash, SELECT the cached
+        # rejection, then within the single flight: SAVEPOINT, the advisory lock,
+        # SELECT by hash and the cached rejection again, SELECT by id, SAVEPOINT,
+        # INSERT BreakPeriod, TimingPoint, HitObject, Timeline and Beatmap,
+        # RELEASE SAVEPOINT twice. Then INSERT Replay.
+        with mock.patch('osu_acc.osu_api.get_beatmaps', return_value=[self.get_json_resp()]), \
+             mock.patch('osu_acc.osu_api.get_beatmap_file', return_value=BEATMAP_FILE):
+            with self.assertNumQueries(17):
+                replay_id = handlers.ingest_replay(self.replay_file)
+
+        replay = Replay.objects.select_related('beatmap').get(replay_id=replay_id)
+        self.assertEqual(replay.beatmap.beatmap_md5, self.beatmap_hash)
+        self.assertIsNotNone(replay.num_slider_ticks)
+
+
+    def test_reupload(self):
+        create_beatmap(self.beatmap_hash)
+        replay_id = handlers.ingest_replay(self.replay_file)
+
+        # SELECT whether the replay exists, before anything else is done with the file
+        with self.assertNumQueries(1):
+            self.assertEqual(handlers.get_stored_replay_id(self.replay_file), replay_id)
+
+        upload = SimpleUploadedFile('replay.osr', self.replay_file)
+        response = self.client.post('/replay/', {'replay_file': upload})
+
+        self.assertRedirects(response, '/replay/{}/'.format(replay_id),
+                             fetch_redirect_response=False)
+        self.assertFalse(IngestJob.objects.exists())
+
+
+    def test_beatmap_created_concurrently(self):
+        create_beatmap(self.beatmap_hash)
+
+        # As if another worker created the beatmap under another hash of its file
+        with mock.patch('osu_acc.osu_api.get_beatmap_file', return_value=BEATMAP_FILE):
+            beatmap = query.get_or_create_beatmap_entry(self.get_json_resp())
+
+        self.assertEqual(beatmap.beatmap_id, '1')
+        self.assertEqual(BreakPeriod.objects.filter(beatmap_id='1').count(), 1)
+        self.assertEqual(Beatmap.objects.count(), 1)
+
+
+    def test_upload_of_updated_beatmap(self):
+        # A replay of the beatmap, stored under the hash of an earlier version of its file
+        create_beatmap(self.beatmap_hash)
+        replay_id = handlers.ingest_replay(self.replay_file)
+        Beatmap.objects.update(beatmap_md5='0' * 32)
+
+        with mock.patch('osu_acc.osu_api.get_beatmaps', return_value=[self.get_json_resp()]), \
+             mock.patch('osu_acc.osu_api.get_beatmap_file', return_value=BEATMAP_FILE), \
+             self.assertLogs('osu_acc.replay.handlers', 'WARNING'):
+            beatmap = handlers.resolve_beatmap(self.beatmap_hash)
+
+        # Updated in place, so replays of the earlier version are kept
+        self.assertEqual(beatmap.beatmap_md5, self.beatmap_hash)
+        np.testing.assert_array_equal(beatmap.hit_object.hit_object_times, [1000, 2000, 3000])
+        self.assertEqual(beatmap.break_period.starts, [10000])
+        self.assertEqual(len(beatmap.timeline.event_times), 5)
+        self.assertEqual(Beatmap.objects.get().beatmap_md5, self.beatmap_hash)
+        self.assertTrue(Replay.objects.filter(replay_id=replay_id).exists())
+
+
+    def test_etag_changes_on_reanalysis(self):
+        create_beatmap(self.beatmap_hash)
+        replay_id = handlers.ingest_replay(self.replay_file)
+
+        response = self.client.get('/replay/{}/'.format(replay_id))
+        etag = response['ETag']
+
+        # The context is looked up in the cache once, for the ETag, Last-Modified and page
+        with self.assertNumQueries(1):
+            response = self.client.get('/replay/{}/'.format(replay_id))
+        self.assertEqual(response['ETag'], etag)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/replay/{}/'.format(replay_id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # As the reanalyze command writes results back
+        Replay.objects.filter(replay_id=replay_id).update(analyzed_at=timezone.now())
+        cache.delete(handlers.get_replay_context_key(replay_id))
+
+        response = self.client.get('/replay/{}/'.format(replay_id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class ImportReplaysTest(TestCase):
+    """
+    Imports a directory of replays, some of which cannot be read, decoded or stored.
+    """
+
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(REPLAY_PATH, 'rb') as f:
+            cls.replay_file = f.read()
+
+        cls.header = osr.read_header(cls.replay_file)
+
+
+    def setUp(self):
+        self.import_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.import_dir)
+
+        create_beatmap(self.header.beatmap_hash)
+
+
+    def write_file(self, name, content):
+        with open(os.path.join(self.import_dir, name), 'wb') as f:
+            f.write(content)
+
+
+    def test_import(self):
+        # Another replay, whose header reads but whose frames are cut short
+        truncated_frames = self.replay_file[:self.header.frames_offset + 100]
+        truncated_frames += bytes(len(self.replay_file) - len(truncated_frames))
+        truncated_frames = truncated_frames.replace(self.header.replay_hash.encode(), b'0' * 32)
+
+        self.write_file('replay.osr', self.replay_file)
+        self.write_file('copy.osr', self.replay_file)
+        self.write_file('header.osr', self.replay_file[:10])
+        self.write_file('frames.osr', truncated_frames)
+        # Unreadable, as if it was removed while importing
+        os.symlink(os.path.join(self.import_dir, 'removed'),
+                   os.path.join(self.import_dir, 'removed.osr'))
+
+        counts = importer.import_replays(self.import_dir, workers=1)
+
+        self.assertEqual(counts['found'], 5)
+        self.assertEqual(counts['imported'], 1)
+        self.assertEqual(counts['duplicate'], 1)
+        self.assertEqual(counts['unparsable'], 3)
+        self.assertEqual(Replay.objects.get().replay_id, self.header.replay_hash)
+
+
+    def test_import_of_corrupt_archive(self):
+        archive_path = os.path.join(self.import_dir, 'replays.zip')
+
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('replay.osr', self.replay_file)
+            archive.writestr('corrupt.osr', self.replay_file)
+
+        # Flip a byte of the last member's data, so it fails its CRC check
+        with open(archive_path, 'r+b') as f:
+            content = bytearray(f.read())
+            offset = content.rindex(self.replay_file[:16]) + len(self.replay_file) // 2
+            content[offset] ^= 0xff
+            f.seek(0)
+            f.write(content)
+
+        counts = importer.import_replays(archive_path, workers=1)
+
+        self.assertEqual(counts['found'], 2)
+        self.assertEqual(counts['imported'], 1)
+        self.assertEqual(counts['unparsable'], 1)
+
+
+    def test_write_replays_counts_only_inserted_rows(self):
+        replay = importer.parse_replay((None, REPLAY_PATH))
+        beatmaps = {self.header.beatmap_hash: Beatmap.objects.get()}
+        results = util.analyze_beatmap_replays(
+            (query.get_beatmap_columns(beatmaps[self.header.beatmap_hash]),
+             [(replay.replay_hash, replay.replay_file)]))
+
+        self.assertEqual(importer.write_replays([replay], beatmaps, dict(results)), 1)
+
+        # As if a concurrent import stored the replay after the batch was checked
+        self.assertEqual(importer.write_replays([replay], beatmaps, dict(results)), 0)
+        self.assertEqual(Replay.objects.count(), 1)
+
+
+class IngestJobTest(TestCase):
+    """
+    Runs queued jobs through the ingest worker.
+    """
+
+
+    def test_unexpected_error(self):
+        job_id = handlers.enqueue_replay(b'replay')
+
+        with mock.patch.object(handlers, 'ingest_replay',
+                               side_effect=RuntimeError('/srv/osu_acc/secret')), \
+             mock.patch('osu_acc.replay.management.commands.ingest_worker.close_old_connections') \
+                as close_old_connections, \
+             self.assertLogs('osu_acc.replay.handlers', 'ERROR') as logs:
+            call_command('ingest_worker', '--once', stdout=io.StringIO())
+
+        # The details are logged, not shown on the job, which is retried later
+        job = IngestJob.objects.get(id=job_id)
+        self.assertEqual(job.status, IngestJob.QUEUED)
+        self.assertEqual(job.error, handlers.INGEST_ERROR)
+        self.assertIn('/srv/osu_acc/secret', logs.output[0])
+
+        # Before claiming the job, and before finding no other job due
+        self.assertEqual(close_old_connections.call_count, 2)
+
+
+class TokenBucketTest(SimpleTestCase):
+    """
+    Paces calls through a token bucket, on a fake clock.
+    """
+
+
+    def setUp(self):
+        self.now = 100.0
+
+        patcher = mock.patch.object(osu_api, 'time')
+        fake_time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        fake_time.monotonic.side_effect = lambda: self.now
+        fake_time.sleep.side_effect = self.sleep
+
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+    def test_burst_then_rate(self):
+        bucket = osu_api.TokenBucket(rate=2, capacity=3)
+
+        # A full bucket lets a burst through at once
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0, 0, 0])
+
+        # Then calls are held to 2 per second
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        self.assertAlmostEqual(self.now, 101.0)
+
+
+    def test_refill_up_to_capacity(self):
+        bucket = osu_api.TokenBucket(rate=2, capacity=3)
+
+        for _ in range(3):
+            bucket.acquire()
+
+        # Idle for long enough to refill well past capacity
+        self.now += 60
+
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+
+
+class ResolveBeatmapConcurrencyTest(TransactionTestCase):
+    """
+    Resolves a new beatmap from several threads at once, which request it from osu!api once.
+    """
+
+
+    def setUp(self):
+        with open(REPLAY_PATH, 'rb') as f:
+            self.beatmap_hash = osr.read_header(f.read()).beatmap_hash
+
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+
+        patcher = mock.patch.object(store, 'get_beatmap_store',
+                                    return_value=store.BeatmapStore(self.store_dir, 1024 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def get_beatmaps(self, beatmap_hash):
+        # Slow enough that every thread arrives while the first is still resolving
+        time.sleep(0.2)
+
+        return [{
+            'beatmap_id': '1',
+            'file_md5': beatmap_hash,
+            'title': 'Title',
+            'artist': 'Artist',
+            'creator': 'Creator',
+            'version': 'Version',
+            'diff_size': '4',
+            'diff_overall': '8',
+            'total_length': '60',
+        }]
+
+
+    def resolve_beatmap(self, results):
+        try:
+            results.append(handlers.resolve_beatmap(self.beatmap_hash).beatmap_id)
+        finally:
+            connection.close()
+
+
+    def test_single_flight(self):
+        results = []
+
+        with mock.patch('osu_acc.osu_api.get_beatmaps', side_effect=self.get_beatmaps) \
+                as get_beatmaps, \
+             mock.patch('osu_acc.osu_api.get_beatmap_file', return_value=BEATMAP_FILE):
+            threads = [threading.Thread(target=self.resolve_beatmap, args=(results,))
+                       for _ in range(4)]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, ['1'] * 4)
+        self.assertEqual(get_beatmaps.call_count, 1)
+        self.assertEqual(Beatmap.objects.count(), 1)
+
+
+class UploadPageTest(TestCase):
+    """
+    Follows an upload from the form to the job's progress page.
+    """
+
+
+    def test_upload_redirects_to_progress_page(self):
+        with open(REPLAY_PATH, 'rb') as f:
+            upload = SimpleUploadedFile('replay.osr', f.read())
+
+        response = self.client.post('/replay/', {'replay_file': upload})
+        job = IngestJob.objects.get()
+        progress_url = '/replay/jobs/{}/progress/'.format(job.id)
+        self.assertRedirects(response, progress_url, fetch_redirect_response=False)
+
+        response = self.client.get(progress_url)
+        self.assertContains(response, '/replay/jobs/{}/'.format(job.id))
+
+        # Once the job is done, the page moves on to the analytics page
+        IngestJob.objects.filter(id=job.id).update(status=IngestJob.DONE, replay_id='abc')
+        response = self.client.get(progress_url)
+        self.assertRedirects(response, '/replay/abc/', fetch_redirect_response=False)
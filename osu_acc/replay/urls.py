@@ -4,5 +4,7 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='replay-index'),
+    path('jobs/<int:job_id>/', views.job_status, name='replay-job-status'),
+    path('jobs/<int:job_id>/progress/', views.job_progress, name='replay-job-progress'),
     path('<str:replay_id>/', views.analytics, name='replay-analytics'),
 ]
@@ -2,10 +2,20 @@
 Module for helper methods that calculate certain parameters or other stuff.
 """
 
+import logging
+import time
 from decimal import Decimal
-from math import sqrt
+from functools import lru_cache
 
+import numpy as np
+from django.utils import timezone
+
+from osu_acc.replay import analysis
 from osu_acc.replay import classes
+from osu_acc.replay import osr
+
+
+logger = logging.getLogger(__name__)
 
 
 # =============================================================================
@@ -31,31 +41,43 @@ def convert_beatmap_break_periods_to_class(break_model):
     return break_periods
 
 
-def convert_osrp_play_data_to_class(play_data):
+def convert_beatmap_break_periods_to_index(break_model):
     """
-    Converts a list of osrparse.ReplayEvents to a list of replay.classes.ReplayEvents.
+    Converts a BreakPeriod model to a classes.BreakIndex instance.
 
     Args:
-        play_data (List(osrparse.ReplayEvent)): osrparse.ReplayEvents.
+        break_model (beatmap.models.BreakPeriod): An instance of the BreakPeriod model.
 
     Returns:
-        replay_events (List(classes.ReplayEvent)): A list of ReplayEvent instances.
+        (classes.BreakIndex): An interval index over all break periods in the beatmap.
     """
 
-    replay_events = []
-    size = len(play_data)
+    return classes.BreakIndex(break_model.starts, break_model.ends)
 
-    time_elapsed = 0
 
-    for i in range(size):
-        x = play_data[i].x
-        y = play_data[i].y
-        time_elapsed += play_data[i].time_since_previous_action
-        time = time_elapsed
+def get_key_presses(replay_events):
+    """
+    Returns only the replay events where at least one key goes down.
 
-        replay_events.append(classes.ReplayEvent(x, y, time))
+    Args:
+        replay_events (List(classes.ReplayEvent)): Replay events, in chronological order.
 
-    return replay_events
+    Returns:
+        presses (List(classes.ReplayEvent)): The press-down replay events.
+    """
+
+    presses = []
+    previously_held = 0
+
+    for replay_event in replay_events:
+        held = replay_event.keys & analysis.CLICK_KEYS
+
+        if held & ~previously_held:
+            presses.append(replay_event)
+
+        previously_held = held
+
+    return presses
 
 
 def convert_hit_object_model_to_class(hit_object_model):
@@ -83,6 +105,104 @@ def convert_hit_object_model_to_class(hit_object_model):
     return hit_objects
 
 
+def convert_frame_columns_to_frames(deltas, x, y, keys):
+    """
+    Converts columns of replay events, in file order, to a classes.ReplayFrames instance.
+
+    Absolute times are the cumulative sum of each event's time delta.
+
+    Args:
+        deltas (array-like): The time since the previous event, of each event.
+        x (array-like): The x coordinate of each event.
+        y (array-like): The y coordinate of each event.
+        keys (array-like): The keys held during each event.
+
+    Returns:
+        (classes.ReplayFrames): The replay events as columns, sorted by time.
+    """
+
+    time = np.cumsum(np.asarray(deltas, dtype=np.float64))
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32)
+    keys = np.asarray(keys, dtype=np.int32)
+
+    # A few replay events have negative deltas, so sort them back into order
+    order = np.argsort(time, kind='stable')
+
+    return classes.ReplayFrames(x[order], y[order], time[order], keys[order])
+
+
+def convert_replay_file_to_frames(replay_file, header=None):
+    """
+    Decodes the frames of a replay file to a classes.ReplayFrames instance.
+
+    Args:
+        replay_file (bytes or memoryview): The contents of the replay file.
+        header (classes.ReplayHeader): The header of the file, if it was already read.
+
+    Returns:
+        (classes.ReplayFrames): The replay data as columns.
+
+    Raises:
+        osr.InvalidReplay: If the replay file is malformed.
+    """
+
+    if header is None:
+        header = osr.read_header(replay_file)
+
+    return convert_frame_columns_to_frames(*osr.decode_frame_columns(replay_file, header))
+
+
+def convert_replay_data_model_to_frames(replay_data_model):
+    """
+    Converts a ReplayData model to a classes.ReplayFrames instance.
+
+    Args:
+        replay_data_model (replay.models.ReplayData): An instance of the ReplayData model.
+
+    Returns:
+        (classes.ReplayFrames): The replay data as columns.
+    """
+
+    return classes.ReplayFrames(replay_data_model.x_coords,
+                                replay_data_model.y_coords,
+                                replay_data_model.hit_object_times,
+                                replay_data_model.keys)
+
+
+def convert_timeline_model_to_columns(timeline_model):
+    """
+    Converts a Timeline model to a classes.Timeline instance.
+
+    Args:
+        timeline_model (beatmap.models.Timeline): An instance of the Timeline model.
+
+    Returns:
+        (classes.Timeline): The judgement timeline as columns.
+    """
+
+    return classes.Timeline(timeline_model.event_times,
+                            timeline_model.event_kinds,
+                            timeline_model.event_objects)
+
+
+def convert_hit_object_model_to_columns(hit_object_model):
+    """
+    Converts a HitObject model to a classes.HitObjects instance.
+
+    Args:
+        hit_object_models (beatmap.models.HitObject): An instance of the HitObject model.
+
+    Returns:
+        (classes.HitObjects): The hit objects as columns.
+    """
+
+    return classes.HitObjects(hit_object_model.x_coords,
+                              hit_object_model.y_coords,
+                              hit_object_model.hit_object_times,
+                              hit_object_model.hit_object_types)
+
+
 # =============================================================================
 # CALCULATION METHODS
 # =============================================================================
@@ -126,6 +246,23 @@ def get_accuracy(a, b, c, d):
     return round(raw, 2)
 
 
+def to_decimal(value):
+    """
+    Converts a float from the analysis to a Decimal with 2 decimal places.
+
+    Analysis runs on native floats throughout,
+    so this is only called when results are handed to a model.
+
+    Args:
+        value (float): The value.
+
+    Returns:
+        (Decimal): The value, rounded to 2 decimal places.
+    """
+
+    return Decimal(value).quantize(Decimal('0.01'))
+
+
 def get_circle_radius(circle_size):
     """
     Given a beatmap's CS difficulty, return the circle radius in pixels.
@@ -153,16 +290,38 @@ def get_circle_radius(circle_size):
         (float): The radius of the circle.
     """
 
-    return 32 * (1 - Decimal(0.7) * (circle_size - 5) / 5)
+    return 32 * (1 - 0.7 * (float(circle_size) - 5) / 5)
 
 
-def is_cursor_on_note(circle_size, replay_event, hit_object):
+@lru_cache(maxsize=256)
+def get_beatmap_difficulty(circle_size, overall_diff):
     """
-    Returns True if the player's cursor is on a beatmap object.
+    Returns the circle radius and hit windows of a beatmap, as native floats.
 
-    Calculated using the Pythagorean Theorem.
+    Results are cached, so each beatmap's parameters are only computed once.
 
     Args:
+        circle_size (Decimal or float): The beatmap's circle size difficulty.
+        overall_diff (Decimal or float): The beatmap's overall difficulty.
+
+    Returns:
+        (classes.BeatmapDifficulty): The circle radius and hit windows.
+    """
+
+    return classes.BeatmapDifficulty(get_circle_radius(circle_size),
+                                     get_hit_window(overall_diff, '300'),
+                                     get_hit_window(overall_diff, '100'),
+                                     get_hit_window(overall_diff, '50'))
+
+
+def is_cursor_within(circle_radius, replay_event, hit_object):
+    """
+    Returns True if the player's cursor is within circle_radius of a beatmap object.
+
+    Compares squared distances, so no square root is taken.
+
+    Args:
+        circle_radius (float): The circle radius in osu!pixels.
         replay_event (classes.ReplayEvent): The current player input.
         hit_object (classes.HitObject): The current hit object.
 
@@ -170,140 +329,377 @@ def is_cursor_on_note(circle_size, replay_event, hit_object):
         Whether the cursor is within the circle or not.
     """
 
-    r = get_circle_radius(circle_size)
     dx = replay_event.x - hit_object.x
     dy = replay_event.y - hit_object.y
 
-    return sqrt(dx**2 + dy**2) < r
+    return dx*dx + dy*dy < circle_radius*circle_radius
+
+
+def is_cursor_on_note(circle_size, replay_event, hit_object):
+    """
+    Returns True if the player's cursor is on a beatmap object.
+
+    Calculated using the Pythagorean Theorem.
+
+    Args:
+        circle_size (Decimal or float): The beatmap's circle size difficulty.
+        replay_event (classes.ReplayEvent): The current player input.
+        hit_object (classes.HitObject): The current hit object.
+
+    Returns:
+        Whether the cursor is within the circle or not.
+    """
+
+    return is_cursor_within(get_circle_radius(circle_size), replay_event, hit_object)
 
 
 def associate_hits(mode, circle_size, overall_diff, break_periods, replay_events, hit_objects):
     """
-    Returns a list of tuples, associating a ReplayEvent with a HitObject
+    Returns a list of associations, associating a ReplayEvent with a HitObject.
+
+    Both replay events and hit objects are walked in chronological order,
+    so the whole pass runs in O(replay events + hit objects) rather than
+    scanning every replay event for every hit object.
+    The start of each hit object's window only ever moves forward,
+    and only the replay events inside a window are inspected.
+
+    Only replay events where a key goes down are considered as hits,
+    and each of them hits at most one hit object. As with notelock,
+    replay events that miss a note while it can still be hit are used up as well.
 
     Args:
         mode (str): Either 'raw' or 'true'.
-        circle_size (Decimal): The beatmap's circle size.
-        overall_diff (Decimal): The beatmap's overall difficulty.
-        break_periods (List(BreakPeriod)): A list of all break periods in a beatmap.
-        replay_events (List(ReplayEvent)): A list of all osrparse.ReplayEvents.
+        circle_size (Decimal or float): The beatmap's circle size.
+        overall_diff (Decimal or float): The beatmap's overall difficulty.
+        break_periods (classes.BreakIndex or List(BreakPeriod)): All break periods in a beatmap.
+        replay_events (List(ReplayEvent)): A list of all replay events.
         hit_object (List(HitObject)): A list of all hit object in a beatmap.
 
     Returns:
-        associations (List(tuple)): A list of associations.
-        Each association is a 3-tuple of the form (ReplayEvent, HitObject, hit_error)
+        associations (List(classes.Association)): A list of associations, one per
+        non-spinner hit object, in chronological order.
     """
 
-    print('associate_hits() called')
-
     valid_modes = set(['raw', 'true'])
 
     if mode not in valid_modes:
-        # TODO: Raise a proper exception.
-        print('Error: Invalid mode {m} passed to associate_hits()'.format(m=mode))
-        return
+        raise ValueError('Invalid mode {m} passed to associate_hits()'.format(m=mode))
 
     associations = []
-    hit_window = get_hit_window(overall_diff, '50')
+    difficulty = get_beatmap_difficulty(circle_size, overall_diff)
+    circle_radius = difficulty.circle_radius
+    hit_window = difficulty.bad_window
+
+    # The replay's trailing RNG seed frame and the occasional negative
+    # time delta leave the replay events almost, but not entirely, sorted.
+    # Sorting an almost sorted list is close to linear.
+    replay_events = sorted(replay_events, key=lambda replay_event: replay_event.time)
+
+    # Only clicks can hit a note, and replay inputs within a break
+    # are never associated, so drop everything else before the walk.
+    break_index = analysis.as_break_index(break_periods)
+    replay_events = [replay_event for replay_event in get_key_presses(replay_events)
+                     if not break_index.contains(replay_event.time)]
+    num_replay_events = len(replay_events)
+
+    # Index of the earliest replay event not yet used up
+    # by an earlier hit object or before its hit window.
+    window_start = 0
+
+    # Checked once, so disabled debug output costs nothing per hit object
+    is_debug = logger.isEnabledFor(logging.DEBUG)
 
     # Associate each hit object with the earliest replay input
     # that falls within the object's hit window.
     for hit_object in hit_objects:
-        is_note_associated = False
-        is_note_hit = False
-        is_note_attempted = False
-
         # Spinners do not meaningfully affect accuracy,
         # and thus will not be associated.
-        if hit_object.is_spinner:
-            print('HitObject is a spinner.')
+        if hit_object.is_spinner():
             continue
 
-        for replay_event in replay_events:
-            # If current replay input is within a break,
-            # then continue to the next input.
-            for break_period in break_periods:
-                if replay_event.time in range(break_period.start, break_period.end+1):
-                    print('ReplayEvent at {t1} within break period {t2} - {t3}'.format(t1=replay_event.time, t2=break_period.start, t3=break_period.end))
-                    continue
+        earliest_time = hit_object.time - hit_window
+        latest_time = hit_object.time + hit_window
+
+        while (window_start < num_replay_events
+               and replay_events[window_start].time < earliest_time):
+            window_start += 1
+
+        association = None
+        i = window_start
 
-            curr_inp_time = replay_event.time
-            curr_obj_time = hit_object.time
-            curr_hit_error = curr_inp_time - curr_obj_time
+        while i < num_replay_events and replay_events[i].time <= latest_time:
+            replay_event = replay_events[i]
+            i += 1
 
-            if curr_hit_error > hit_window:
-                print('Current hit error of {he} exceeds hit window of {hw}'.format(he=curr_hit_error, hw=hit_window))
+            curr_hit_error = replay_event.time - hit_object.time
+
+            if mode == 'true' or is_cursor_within(circle_radius, replay_event, hit_object):
+                association = classes.Association(replay_event, hit_object, curr_hit_error)
                 break
 
-            if abs(curr_hit_error) <= hit_window:
-                # Set flags
-                is_note_attempted = True
-                is_note_hit = is_cursor_on_note(circle_size, replay_event, hit_object)
+        # Later hit objects start past every replay event used up by this one
+        window_start = i
 
-                # Make association and append
-                curr = classes.Association(replay_event, hit_object, curr_hit_error)
-                associations.append(curr)
+        if association is None:
+            association = classes.Association(None, hit_object, None)
 
-            if (mode == 'raw' and is_note_hit) or (mode == 'true' and is_note_attempted):
-                print('Associated ReplayEvent at {t1} with HitObject at {t2}'.format(t1=replay_event.time, t2=hit_object.time))
-                curr = classes.Association(replay_event, hit_object, curr_hit_error)
-                associations.append(curr)
-                is_note_associated = True
+        if is_debug:
+            if association.replay_event is None:
+                logger.debug('Did not associate HitObject at %s with any ReplayEvent',
+                             hit_object.time)
             else:
-                print('Did not associate ReplayEvent at {t1} with HitObject at {t2}'.format(t1=replay_event.time, t2=hit_object.time))
-
-            replay_event_counter += 1
+                logger.debug('Associated ReplayEvent at %s with HitObject at %s',
+                             association.replay_event.time, hit_object.time)
 
-        if not is_note_associated:
-            print('Did not associate HitObject at {t} with any ReplayEvent'.format(t=hit_object.time))
-            curr = classes.Association(None, hit_object, None)
-            associations.append(curr)
-        print('')
+        associations.append(association)
 
     return associations
 
 
-def get_true_accuracy_fields(circle_size, overall_diff, break_periods, replay_events, hit_objects):
+def judge_replay(circle_size, overall_diff, break_periods, replay_events, hit_objects):
     """
-    Returns the number of true 300s, 100s, 50s and misses as a dictionary.
+    Judges every hit object of a replay in a single pass.
+
+    Both the raw and the true results, as well as the hit errors,
+    can be derived from the returned record without another pass.
 
     Args:
-        circle_size (Decimal): The beatmap's circle size difficulty.
-        overall_diff (Decimal): The beatmap's overall difficulty.
-        break_periods (List(BreakPeriod)): A list of all break periods in a beatmap.
-        replay_events (List(classes.ReplayEvent)): A list of all replay events.
-        hit_object (List(classes.HitObject)): A list of all hit object in a beatmap.
+        circle_size (Decimal or float): The beatmap's circle size difficulty.
+        overall_diff (Decimal or float): The beatmap's overall difficulty.
+        break_periods (classes.BreakIndex or List(BreakPeriod)): All break periods in a beatmap.
+        replay_events (classes.ReplayFrames or List(classes.ReplayEvent)): All replay events.
+        hit_objects (classes.HitObjects or List(classes.HitObject)): All hit objects in a beatmap.
 
     Returns:
-        fields (dict): A dictionary containing the number of each hit type.
+        (classes.Judgements): The judgement record of every hit object.
+    """
+
+    started = time.perf_counter()
+
+    frames = analysis.as_replay_frames(replay_events)
+    presses = analysis.get_presses(frames)
+    presses = analysis.drop_break_frames(presses, analysis.as_break_index(break_periods))
+    hit_objects = analysis.as_hit_objects(hit_objects)
+
+    judgements = analysis.judge(get_beatmap_difficulty(circle_size, overall_diff),
+                                presses, hit_objects)
+
+    # Checked once, so disabled debug output costs nothing per hit object
+    if logger.isEnabledFor(logging.DEBUG):
+        log_associations(presses, hit_objects, judgements)
+
+    num_judged = int(np.count_nonzero(judgements.judgeable))
+    num_matched = int(np.count_nonzero(judgements.raw_frames >= 0))
+
+    logger.info('Judged replay objects=%d frames=%d presses=%d matched=%d misses=%d elapsed_ms=%.1f',
+                num_judged, len(frames), len(presses), num_matched, num_judged - num_matched,
+                (time.perf_counter() - started) * 1000)
+
+    return judgements
+
+
+def log_associations(presses, hit_objects, judgements):
+    """
+    Logs the raw and true association of every judged hit object at DEBUG level.
+
+    Args:
+        presses (classes.ReplayFrames): The press-down frames the hit objects were judged against.
+        hit_objects (classes.HitObjects): The hit objects.
+        judgements (classes.Judgements): The judgement record of the hit objects.
+    """
+
+    press_times = presses.time.tolist()
+    raw_frames = judgements.raw_frames.tolist()
+    true_frames = judgements.true_frames.tolist()
+
+    for i in np.flatnonzero(judgements.judgeable).tolist():
+        hit_object_time = hit_objects.time[i]
+
+        for mode, frame_index in (('raw', raw_frames[i]), ('true', true_frames[i])):
+            if frame_index < 0:
+                logger.debug('Did not associate HitObject at %s with any ReplayEvent mode=%s',
+                             hit_object_time, mode)
+            else:
+                logger.debug('Associated ReplayEvent at %s with HitObject at %s mode=%s',
+                             press_times[frame_index], hit_object_time, mode)
+
+
+def get_judgement_fields(mode, judgements):
+    """
+    Returns the number of 300s, 100s, 50s and misses of a judgement record as a dictionary.
+
+    Args:
+        mode (str): Either 'raw' or 'true'.
+        judgements (classes.Judgements): The judgement record, as returned by judge_replay().
+
+    Returns:
+        fields (dict): A dictionary containing the number of each hit type,
+        keyed as the fields on the Replay model.
+    """
+
+    valid_modes = set(['raw', 'true'])
+
+    if mode not in valid_modes:
+        raise ValueError('Invalid mode {m} passed to get_judgement_fields()'.format(m=mode))
+
+    scores = judgements.true_scores if mode == 'true' else judgements.raw_scores
+    counts = analysis.count_judgements(scores, judgements.judgeable)
+
+    fields = {}
+    fields['num_{m}_300'.format(m=mode)] = counts[0]
+    fields['num_{m}_100'.format(m=mode)] = counts[1]
+    fields['num_{m}_50'.format(m=mode)] = counts[2]
+    fields['num_{m}_miss'.format(m=mode)] = counts[3]
+
+    return fields
+
+
+def get_judgement_hit_errors(judgements):
+    """
+    Returns the hit errors of a judgement record.
+
+    Args:
+        judgements (classes.Judgements): The judgement record, as returned by judge_replay().
+
+    Returns:
+        An array containing all hit errors in chronological order.
+        Missed hit objects have no hit error and are left out.
+    """
+
+    hit_errors = judgements.raw_errors
+    return hit_errors[~np.isnan(hit_errors)].tolist()
+
+
+def get_slider_fields(replay_events, judgement_timeline):
+    """
+    Returns the number of slider ticks, repeats and ends, and how many were held, as a dictionary.
+
+    Args:
+        replay_events (classes.ReplayFrames or List(classes.ReplayEvent)): All replay events.
+        judgement_timeline (classes.Timeline): The beatmap's judgement timeline.
+
+    Returns:
+        fields (dict): A dictionary keyed as the fields on the Replay model.
     """
 
+    frames = analysis.as_replay_frames(replay_events)
+    num_ticks, num_held = analysis.judge_held_events(frames, judgement_timeline)
+
     fields = {}
-    fields['num_true_300'] = 0
-    fields['num_true_100'] = 0
-    fields['num_true_50'] = 0
-    fields['num_true_miss'] = 0
-
-    perf_window = get_hit_window(overall_diff, '300')
-    good_window = get_hit_window(overall_diff, '100')
-    bad_window = get_hit_window(overall_diff, '50')
-
-    associations = associate_hits('true', circle_size, overall_diff,
-                                  break_periods, replay_events, hit_objects)
-
-    for association in associations:
-        if association.hit_error is None:
-            fields['num_true_miss'] += 1
-        elif abs(association.hit_error) <= perf_window:
-            fields['num_true_300'] += 1
-        elif abs(association.hit_error) <= good_window:
-            fields['num_true_100'] += 1
-        elif abs(association.hit_error) <= bad_window:
-            fields['num_true_50'] += 1
+    fields['num_slider_ticks'] = num_ticks
+    fields['num_slider_ticks_held'] = num_held
 
     return fields
 
 
+def analyze_replay(circle_size, overall_diff, break_periods, replay_events, hit_objects,
+                   judgement_timeline=None):
+    """
+    Runs the whole analysis of a replay and returns its results as Replay model fields.
+
+    Only fields derived from the analysis are returned, not those read off the replay file.
+    Analysis runs on floats, results are converted to Decimal only here.
+
+    Args:
+        circle_size (Decimal or float): The beatmap's circle size difficulty.
+        overall_diff (Decimal or float): The beatmap's overall difficulty.
+        break_periods (classes.BreakIndex or List(BreakPeriod)): All break periods in a beatmap.
+        replay_events (classes.ReplayFrames or List(classes.ReplayEvent)): All replay events.
+        hit_objects (classes.HitObjects or List(classes.HitObject)): All hit objects in a beatmap.
+        judgement_timeline (classes.Timeline): The beatmap's judgement timeline, if it has one.
+
+    Returns:
+        fields (dict): A dictionary keyed as the fields on the Replay model.
+    """
+
+    # Judge every hit object once, and derive everything else from the record
+    judgements = judge_replay(circle_size, overall_diff, break_periods, replay_events, hit_objects)
+
+    fields = get_judgement_fields('true', judgements)
+    fields['true_accuracy'] = get_accuracy(fields['num_true_300'],
+                                           fields['num_true_100'],
+                                           fields['num_true_50'],
+                                           fields['num_true_miss'])
+
+    if judgement_timeline is not None:
+        fields = {**fields, **get_slider_fields(replay_events, judgement_timeline)}
+
+    hit_errors = get_judgement_hit_errors(judgements)
+
+    hit_error_data = calc_hit_error_data(hit_errors)
+    hit_error_data = {
+        key: to_decimal(value) if isinstance(value, float) else value
+        for key, value in hit_error_data.items()
+    }
+    fields['hit_errors'] = [to_decimal(hit_error) for hit_error in hit_errors]
+    fields = {**fields, **hit_error_data}
+
+    fields['analyzed_at'] = timezone.now()
+
+    return fields
+
+
+def analyze_beatmap_replays(task):
+    """
+    Analyzes a batch of replays of the same beatmap.
+
+    Meant to run in a worker process, so it only takes and returns picklable data.
+    Replays may be passed as the contents of their replay file, so that decoding
+    their frames happens in the worker as well.
+
+    Args:
+        task (tuple): The beatmap's columns, as built by query.get_beatmap_columns(),
+                      and a list of (replay_id, frames) pairs, frames being either
+                      a classes.ReplayFrames instance or the contents of the replay file.
+
+    Returns:
+        results (List(tuple)): A list of (replay_id, fields) pairs,
+        fields being keyed as the fields on the Replay model.
+        Replays whose replay file cannot be decoded are left out.
+    """
+
+    beatmap_columns, replays = task
+    circle_size, overall_diff, break_index, hit_objects, judgement_timeline = beatmap_columns
+
+    results = []
+
+    for replay_id, frames in replays:
+        if isinstance(frames, bytes):
+            try:
+                frames = convert_replay_file_to_frames(frames)
+            except osr.InvalidReplay as e:
+                logger.warning('Could not decode the frames of replay %s: %s', replay_id, e)
+                continue
+
+        fields = analyze_replay(circle_size, overall_diff, break_index,
+                                frames, hit_objects, judgement_timeline)
+        results.append((replay_id, fields))
+
+    return results
+
+
+def get_true_accuracy_fields(circle_size, overall_diff, break_periods, replay_events, hit_objects):
+    """
+    Returns the number of true 300s, 100s, 50s and misses as a dictionary.
+
+    Prefer judge_replay() followed by get_judgement_fields()
+    when the hit errors are needed as well.
+
+    Args:
+        circle_size (Decimal or float): The beatmap's circle size difficulty.
+        overall_diff (Decimal or float): The beatmap's overall difficulty.
+        break_periods (classes.BreakIndex or List(BreakPeriod)): All break periods in a beatmap.
+        replay_events (classes.ReplayFrames or List(classes.ReplayEvent)): All replay events.
+        hit_objects (classes.HitObjects or List(classes.HitObject)): All hit objects in a beatmap.
+
+    Returns:
+        fields (dict): A dictionary containing the number of each hit type.
+    """
+
+    judgements = judge_replay(circle_size, overall_diff, break_periods, replay_events, hit_objects)
+    return get_judgement_fields('true', judgements)
+
+
 def get_hit_window(overall_diff, score):
     """
     Returns the maximum amount of time, in milliseconds, that an input candeivate
@@ -313,7 +709,7 @@ def get_hit_window(overall_diff, score):
     https://osu.ppy.sh/help/wiki/osu!_File_Formats/Osu_(file_format)#overall-difficulty
 
     Args:
-        od (Decimal): The beatmap's overall difficulty.
+        od (Decimal or float): The beatmap's overall difficulty.
         score (str): The score.
 
     Returns:
@@ -327,12 +723,14 @@ def get_hit_window(overall_diff, score):
         # TODO: Raise a proper exception.
         return None
 
+    overall_diff = float(overall_diff)
+
     if score == '300':
-        hit_window = Decimal(50 + 30 * (5 - overall_diff) / 5)
+        hit_window = 50 + 30 * (5 - overall_diff) / 5
     if score == '100':
-        hit_window = Decimal(100 + 40 * (5 - overall_diff) / 5)
+        hit_window = 100 + 40 * (5 - overall_diff) / 5
     if score == '50':
-        hit_window = Decimal(150 + 50 * (5 - overall_diff) / 5)
+        hit_window = 150 + 50 * (5 - overall_diff) / 5
 
     return hit_window
 
@@ -342,66 +740,65 @@ def get_hit_errors(circle_size, overall_diff, break_periods, replay_events, hit_
     Given an input replay play data and its beatmap's hit objects' times,
     return a list of hit errors.
 
+    Prefer judge_replay() followed by get_judgement_hit_errors()
+    when the accuracy fields are needed as well.
+
     Args:
-        circle_size (Decimal): The beatmap's circle size difficulty.
-        overall_diff (Decimal): The beatmap's overall difficulty.
-        break_periods (List(BreakPeriod)): A list of all break periods in a beatmap.
-        replay_events (List(classes.ReplayEvent)): A list of all replay events.
-        hit_object (List(classes.HitObject)): A list of all hit object in a beatmap.
+        circle_size (Decimal or float): The beatmap's circle size difficulty.
+        overall_diff (Decimal or float): The beatmap's overall difficulty.
+        break_periods (classes.BreakIndex or List(BreakPeriod)): All break periods in a beatmap.
+        replay_events (classes.ReplayFrames or List(classes.ReplayEvent)): All replay events.
+        hit_objects (classes.HitObjects or List(classes.HitObject)): All hit objects in a beatmap.
 
     Returns:
         An array containing all hit errors in chronological order.
+        Missed hit objects have no hit error and are left out.
     """
 
-    associations = associate_hits('raw', circle_size, overall_diff,
-                                  break_periods, replay_events, hit_objects)
-
-    return [association.hit_error for association in associations]
+    judgements = judge_replay(circle_size, overall_diff, break_periods, replay_events, hit_objects)
+    return get_judgement_hit_errors(judgements)
 
 
 def calc_hit_error_data(hit_errors):
     """
     Calculates various metrics regarding hit errors.
 
+    Every metric is gathered in a single pass over the hit errors.
+    Metrics without any hit error to base them on, such as the
+    average negative hit error of a replay without early hits, are None.
+
     Args:
-        hit_errors (List(float)): A list of all hit errors.
+        hit_errors (Iterable(float)): All hit errors.
 
     Returns:
         A dictionary containing all relevant hit error metrics.
     """
 
+    stats = classes.HitErrorStats()
+    stats.update(hit_errors)
+
     data = {}
 
-    pos_errors, neg_errors, abs_errors = [], [], []
-
-    for error in hit_errors:
-        if error > 0:
-            pos_errors.append(error)
-        elif error < 0:
-            neg_errors.append(error)
-        abs_errors.append(abs(error))
-
-    # Just for now...
-    if not pos_errors:
-        pos_errors.append(Decimal(1.00))
-    if not neg_errors:
-        neg_errors.append(Decimal(-1.00))
-    if not abs_errors:
-        abs_errors.append(Decimal(0.00))
-
-    data['min_pos_hit_error'] = min(pos_errors)
-    data['max_pos_hit_error'] = max(pos_errors)
-    data['avg_pos_hit_error'] = sum(pos_errors) / len(pos_errors)
-
-    data['min_neg_hit_error'] = min(neg_errors)
-    data['max_neg_hit_error'] = max(neg_errors)
-    data['avg_neg_hit_error'] = sum(neg_errors) / len(neg_errors)
-
-    data['min_abs_hit_error'] = min(abs_errors)
-    data['max_abs_hit_error'] = max(abs_errors)
-    data['avg_abs_hit_error'] = sum(abs_errors) / len(abs_errors)
-
-    data['num_pos_hit_error'] = len(pos_errors)
-    data['num_neg_hit_error'] = len(neg_errors)
+    data['min_pos_hit_error'] = stats.min_pos
+    data['max_pos_hit_error'] = stats.max_pos
+    data['avg_pos_hit_error'] = stats.avg_pos
+
+    data['min_neg_hit_error'] = stats.min_neg
+    data['max_neg_hit_error'] = stats.max_neg
+    data['avg_neg_hit_error'] = stats.avg_neg
+
+    data['min_abs_hit_error'] = stats.min_abs
+    data['max_abs_hit_error'] = stats.max_abs
+    data['avg_abs_hit_error'] = stats.avg_abs
+
+    data['num_pos_hit_error'] = stats.num_pos
+    data['num_neg_hit_error'] = stats.num_neg
+
+    data['std_hit_error'] = stats.std
+    data['unstable_rate'] = stats.unstable_rate
+
+    data['p50_abs_hit_error'] = stats.percentile(50)
+    data['p90_abs_hit_error'] = stats.percentile(90)
+    data['p99_abs_hit_error'] = stats.percentile(99)
 
     return data
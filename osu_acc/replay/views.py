@@ -1,5 +1,7 @@
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
+from django.urls import reverse
+from django.views.decorators.http import condition
 
 from osu_acc.replay import handlers
 from osu_acc.replay.forms import ReplayForm
@@ -12,17 +14,76 @@ def index(request):
     if request.method == 'POST':
         form = ReplayForm(request.POST, request.FILES)
         if form.is_valid():
-            replay_id = handlers.handle_replay(request.FILES['replay_file'])
-            return HttpResponseRedirect('/replay/{}/'.format(replay_id))
+            replay_file = request.FILES['replay_file'].read()
+
+            # Re-uploads go straight to the stored replay
+            replay_id = handlers.get_stored_replay_id(replay_file)
+            if replay_id is not None:
+                return HttpResponseRedirect(reverse('replay-analytics', args=[replay_id]))
+
+            # Ingestion happens in the ingest_worker process
+            job_id = handlers.enqueue_replay(replay_file)
+            return HttpResponseRedirect(reverse('replay-job-progress', args=[job_id]))
     else:
         form = ReplayForm()
 
     return render(request, 'index.html', {'form': form})
 
 
+def get_replay_context(request, replay_id):
+    """
+    Returns a replay's context, fetched once per request.
+
+    The ETag, the Last-Modified date and the page itself are all derived from it,
+    and each cache lookup is a query with a DatabaseCache.
+    """
+    if not hasattr(request, 'replay_context'):
+        request.replay_context = handlers.get_replay_context(replay_id)
+
+    return request.replay_context
+
+
+def get_replay_etag(request, replay_id):
+    """
+    ETag function of the analytics view
+    """
+    return handlers.get_replay_etag(get_replay_context(request, replay_id))
+
+
+def get_replay_last_modified(request, replay_id):
+    """
+    Last-Modified function of the analytics view
+    """
+    return handlers.get_replay_last_modified(get_replay_context(request, replay_id))
+
+
+@condition(etag_func=get_replay_etag, last_modified_func=get_replay_last_modified)
 def analytics(request, replay_id):
     """
     View function for /replay/<replay_id>
     """
-    ctx = handlers.get_replay_context(replay_id)
+    ctx = get_replay_context(request, replay_id)
     return render(request, 'analytics.html', ctx)
+
+
+def job_progress(request, job_id):
+    """
+    View function for /replay/jobs/<job_id>/progress
+
+    The page polls job_status, and moves on to the analytics page once the job is done.
+    """
+    ctx = handlers.get_job_context(job_id)
+
+    if ctx['replay_url'] is not None:
+        return HttpResponseRedirect(ctx['replay_url'])
+
+    ctx['status_url'] = reverse('replay-job-status', args=[job_id])
+    return render(request, 'job.html', ctx)
+
+
+def job_status(request, job_id):
+    """
+    View function for /replay/jobs/<job_id>, the JSON status of an ingest job
+    """
+    ctx = handlers.get_job_context(job_id)
+    return JsonResponse(ctx)
@@ -134,7 +134,104 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
-# File Upload
-# Force to write replay files to disk
-# This allows osrparse to parse them
-FILE_UPLOAD_MAX_MEMORY_SIZE = 0
+# Logging
+# https://docs.djangoproject.com/en/2.1/topics/logging/
+
+# Set to 'DEBUG' to trace individual associations during analysis.
+OSU_ACC_LOG_LEVEL = 'INFO'
+
+# Fraction of records below INFO that are kept once debug output is on.
+OSU_ACC_LOG_SAMPLE_RATE = 0.01
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sample': {
+            '()': 'osu_acc.log.SamplingFilter',
+            'rate': OSU_ACC_LOG_SAMPLE_RATE,
+        },
+    },
+    'formatters': {
+        'simple': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'filters': ['sample'],
+            'formatter': 'simple',
+        },
+    },
+    'loggers': {
+        'osu_acc': {
+            'handlers': ['console'],
+            'level': OSU_ACC_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
+
+# Ingestion
+
+# Number of times an ingest job is attempted before it is marked as failed.
+OSU_ACC_INGEST_MAX_ATTEMPTS = 3
+
+# Seconds to wait before retrying a failed attempt, doubled on every attempt.
+OSU_ACC_INGEST_RETRY_DELAY = 30
+
+# Seconds after which a running job is assumed to belong to a dead worker.
+OSU_ACC_INGEST_STALE_AFTER = 600
+
+# Seconds a beatmap hash rejected by osu!api is remembered for,
+# instead of being requested again on every upload.
+OSU_ACC_REJECTED_BEATMAP_TTL = 60 * 60
+
+# HTTP Client
+# Point these at a local stub server to run ingestion offline.
+OSU_ACC_API_URL = 'https://osu.ppy.sh/api/'
+OSU_ACC_BEATMAP_FILE_URL = 'https://osu.ppy.sh/osu/'
+
+# (connect, read) timeouts in seconds, per endpoint.
+OSU_ACC_HTTP_TIMEOUTS = {
+    'get_beatmaps': (3.05, 10),
+    'beatmap_file': (3.05, 30),
+}
+
+# Retries of a failed request, waiting backoff * 2^(retry - 1) seconds in between.
+OSU_ACC_HTTP_RETRIES = 3
+OSU_ACC_HTTP_BACKOFF = 0.5
+
+# Sustained calls per second to osu!api, and bursts allowed on top, per process.
+OSU_ACC_API_RATE = 10
+OSU_ACC_API_BURST = 20
+
+# Keep-alive connections kept open per host.
+OSU_ACC_HTTP_POOL_SIZE = 10
+
+# Cache
+# Shared by every web and worker process, so that the reanalyze command
+# can evict the analytics contexts served by the web processes.
+# Create the table with: python manage.py createcachetable
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'osu_acc_cache',
+    }
+}
+
+# Part of the cache keys and ETags of analytics pages. Bumping it drops every cached page
+# at once. Replays rewritten by the reanalyze command get new ETags either way.
+OSU_ACC_ANALYSIS_VERSION = 1
+
+# Seconds a replay's analytics context stays cached.
+OSU_ACC_REPLAY_CONTEXT_TTL = 24 * 60 * 60
+
+# Beatmap Store
+
+# Directory downloaded .osu files are kept in, keyed by their MD5 hash.
+OSU_ACC_BEATMAP_STORE_DIR = os.path.join(BASE_DIR, 'beatmaps')
+
+# Size past which the least recently used .osu files are evicted.
+OSU_ACC_BEATMAP_STORE_MAX_BYTES = 256 * 1024 * 1024